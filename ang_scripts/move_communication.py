@@ -1,12 +1,19 @@
-from copy import deepcopy
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 import json
+import multiprocessing
+import os
 import sys
+import time
 import traceback
 
 import django
-from django.db import transaction
+from django.db import connections, transaction
 
+from angelman.clinical_data.archive import BackupArchive, backup_record
+from angelman.clinical_data.transform import MoveSection, Plan
+from angelman.patient_indexes import rebuild_patient_indexes
 from rdrf.models.definition.models import ClinicalData
 from rdrf.models.definition.models import Registry
 from registry.patients.models import Patient
@@ -22,11 +29,54 @@ SPEECH_SECTION = "ANGBEHDEVSPEECHLANGUAGE"
 COMM_SECTION = "ANGBEHDEVCOMMUNICATION"
 SECTIONS = [SPEECH_SECTION, COMM_SECTION]
 
+PLAN = Plan([MoveSection(section_code, OLD_FORM, NEW_FORM) for section_code in SECTIONS])
+
+BACKUP_ARCHIVE = "comms_update_backup.jsonl.gz"
+BACKUP_FLUSH_SIZE = 500
+
 
 class Stats:
     errors = 0
     ids_processed = []
     ids_skipped = []
+    chunk_timings = []
+    started = None
+    finished = None
+
+    @classmethod
+    def merge(cls, chunk_result):
+        cls.errors += chunk_result["errors"]
+        cls.ids_processed.extend(chunk_result["ids_processed"])
+        cls.ids_skipped.extend(chunk_result["ids_skipped"])
+        cls.chunk_timings.append((chunk_result["first_id"],
+                                  chunk_result["last_id"],
+                                  chunk_result["count"],
+                                  chunk_result["seconds"]))
+
+    @classmethod
+    def report(cls):
+        total_skipped = len(cls.ids_skipped)
+        total_processed = len(cls.ids_processed)
+        print("stats total processed = %s" % total_processed)
+        print("stats total skipped = %s" % total_skipped)
+        print("stats total errors = %s" % cls.errors)
+        for first_id, last_id, count, seconds in cls.chunk_timings:
+            print("stats chunk pids %s-%s: %s patients in %.2fs" % (first_id, last_id, count, seconds))
+        if cls.started is not None and cls.finished is not None:
+            elapsed = cls.finished - cls.started
+            total = total_processed + total_skipped
+            rate = total / elapsed if elapsed > 0 else 0.0
+            print("stats elapsed = %.2fs throughput = %.1f patients/sec" % (elapsed, rate))
+
+
+class PatientIds:
+    """
+    Collects the ids a Munger processed or skipped, so a chunk does not share the process wide Stats
+    """
+
+    def __init__(self):
+        self.ids_processed = []
+        self.ids_skipped = []
 
 
 class NoData(Exception):
@@ -55,33 +105,11 @@ class Logger:
         return "%s pid %s:" % (t, pid)
 
 
-def get_form(data, form_name):
-    for form_dict in data["forms"]:
-        if form_dict["name"] == form_name:
-            return form_dict
-
-
-def get_section(form_dict, section_code):
-    if "sections" in form_dict:
-        for section_dict in form_dict["sections"]:
-            if section_dict["code"] == section_code:
-                return section_dict
-
-
-def form_exists(data, form_name):
-    return len([f["name"] for f in data["forms"] if f["name"] == form_name]) == 1
-
-
-def add_form(data, form_name):
-    form_dict = {"name": form_name,
-                 "sections": []}
-    data["forms"].append(form_dict)
-    return form_dict
-
-
 class Munger:
-    def __init__(self, registry, patient):
+    def __init__(self, registry, patient, backups, clinical_data=None, ids=Stats):
         self.registry = registry
+        # where the patient id is recorded as processed or skipped
+        self.ids = ids
         self.registry_code = registry.code
         self.patient = patient
         self.patient_id = patient.id
@@ -90,7 +118,15 @@ class Munger:
         self.dry_run = True
         self.debug = True
         self.data = None
-        self._load_data()
+        self.backups = backups
+        # When the ClinicalData row is handed in (chunked mode) the caller
+        # prefetched it and will write it back with bulk_update
+        self.clinical_data = clinical_data
+        if clinical_data is None:
+            self._load_data()
+        else:
+            self.data = clinical_data.data
+            self.context_id = clinical_data.context_id
 
     def log(self, msg):
         self.logger.log(msg)
@@ -104,9 +140,9 @@ class Munger:
             self.context_id = self.data["context_id"]
 
     def backup(self, data):
-        filename = "comms_update_patient_%s.json" % self.patient.id
-        with open(filename, "w") as f:
-            json.dump(data, f)
+        if self.dry_run:
+            return
+        self.backups.add(backup_record(self.registry_code, self.patient_id, self.context_id, data))
 
     def _print_data(self, msg):
         self.log(msg)
@@ -123,38 +159,46 @@ class Munger:
         self.log("starting to munge ...")
         if self.context_id is None:
             self.logger.warn("No context id? - skipping")
-            Stats.ids_skipped.append(self.patient_id)
+            self.ids.ids_skipped.append(self.patient_id)
+            return
         if not self.data:
             self.logger.warn("no data - skipping")
-            Stats.ids_skipped.append(self.patient_id)
+            self.ids.ids_skipped.append(self.patient_id)
             return
 
         if "forms" not in self.data:
             self.log("no forms key in data - skipping")
-            Stats.ids_skipped.append(self.patient_id)
+            self.ids.ids_skipped.append(self.patient_id)
             return
 
-        old_form = get_form(self.data, OLD_FORM)
-        if not old_form:
+        if not PLAN.applies_to(self.data):
             self.log("no %s form - skipping" % OLD_FORM)
-            Stats.ids_skipped.append(self.patient_id)
+            self.ids.ids_skipped.append(self.patient_id)
             return
 
-        backup_data = deepcopy(self.data)
-        self.backup(backup_data)
-
-        self._move_data(self.data, old_form, SPEECH_SECTION)
-        self._move_data(self.data, old_form, COMM_SECTION)
-        self._delete_old_sections(old_form)
+        result = PLAN.apply(self.data)
+        for msg_type, msg in result.messages:
+            self.logger.log(msg, msg_type)
+        if not result.changed:
+            self.log("nothing to move - skipping")
+            self.ids.ids_skipped.append(self.patient_id)
+            return
+        # the plan never modifies the loaded document, so it is the backup
+        self.backup(self.data)
+        self.data = result.data
 
         self.save()
-        Stats.ids_processed.append(self.patient_id)
+        self.ids.ids_processed.append(self.patient_id)
+        return True
 
     def save(self):
-        if not self.dry_run:
-            self._save()
-        else:
+        if self.dry_run:
             self.log("dry run - not saving")
+        elif self.clinical_data is not None:
+            self.clinical_data.data = self.data
+            self.log("queued new data for chunk update")
+        else:
+            self._save()
 
     def _save(self):
         self.log("really saving data ...")
@@ -170,33 +214,6 @@ class Munger:
                                         django_id=self.patient_id,
                                         context_id=self.context_id)
 
-    def _move_data(self, data, form_dict, section_code):
-        section_dict = get_section(form_dict, section_code)
-        section_copy = deepcopy(section_dict)
-        if section_dict is None:
-            self.logger.warn(
-                "%s section does not exist - skipping" % section_code)
-        else:
-            if not form_exists(data, NEW_FORM):
-                new_form = add_form(data, NEW_FORM)
-                self.log("created form %s" % NEW_FORM)
-            else:
-                new_form = get_form(data, NEW_FORM)
-                self.log("form %s already exists - using" % NEW_FORM)
-
-            section_count = len(
-                [s for s in new_form["sections"] if s["code"] == section_code])
-            if section_count == 0:
-                new_form["sections"].append(section_copy)
-                self.log("added section %s to %s" % (section_code, NEW_FORM))
-            else:
-                self.error("section %s already exists in %s?" %
-                           (section_code, NEW_FORM))
-
-    def _delete_old_sections(self, old_form):
-        old_form["sections"] = [
-            s for s in old_form["sections"] if s["code"] not in SECTIONS]
-
 
 def check_registry(reg):
     form_names = [f.name for f in reg.forms]
@@ -214,47 +231,223 @@ def check_registry(reg):
         raise Exception("comm section %s not present" % COMM_SECTION)
 
 
-def run(dry_run=True):
+def run(dry_run=True, archive_path=BACKUP_ARCHIVE):
     if dry_run:
-        print("this is a dry run - no data will be changed")
+        print("this is a dry run - no data will be changed or backed up")
     else:
         print("this is NOT a dry run - data will be updated")
     ang = Registry.objects.get(code="ang")
     check_registry(ang)
     print("checked registry - seems ok")
 
+    backups = BackupArchive(archive_path).batch()
     for p in Patient.objects.all():
         try:
-            m = Munger(ang, p)
+            m = Munger(ang, p, backups)
         except NoData as nd:
             print("NoData error: %s" % nd)
             print("could not load data for patient %s - skipping" % p.id)
             Stats.ids_skipped.append(p.id)
+            continue
         m.dry_run = dry_run
         m.munge()
+        if len(backups.records) >= BACKUP_FLUSH_SIZE:
+            backups.flush()
+    backups.flush()
+
+
+class Checkpoint:
+    """
+    Records the patient id ranges of chunks which have been committed, so a
+    crashed chunked run can be restarted and skip the work already done.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.completed = []
+
+    def load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.completed = [tuple(r) for r in json.load(f)["completed"]]
+        print("checkpoint %s: %s chunks already done" % (self.filename, len(self.completed)))
+
+    def is_done(self, patient_id):
+        return any(first_id <= patient_id <= last_id for first_id, last_id in self.completed)
+
+    def mark_done(self, first_id, last_id):
+        self.completed.append((first_id, last_id))
+        tmp_filename = "%s.tmp" % self.filename
+        with open(tmp_filename, "w") as f:
+            json.dump({"completed": self.completed}, f)
+        os.replace(tmp_filename, self.filename)
+
+
+def patient_id_chunks(chunk_size, checkpoint=None):
+    chunk = []
+    patient_ids = Patient.objects.order_by("id").values_list("id", flat=True)
+    for patient_id in patient_ids.iterator(chunk_size=chunk_size):
+        if checkpoint is not None and checkpoint.is_done(patient_id):
+            continue
+        chunk.append(patient_id)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def process_chunk(registry, patient_ids, dry_run, archive_path):
+    started = time.monotonic()
+    result = {
+        "first_id": patient_ids[0],
+        "last_id": patient_ids[-1],
+        "count": len(patient_ids),
+        "errors": 0,
+        "ids_processed": [],
+        "ids_skipped": [],
+    }
+    try:
+        with transaction.atomic():
+            clinical_data = {}
+            for cd in ClinicalData.objects.filter(collection="cdes",
+                                                  registry_code=registry.code,
+                                                  django_model="Patient",
+                                                  django_id__in=patient_ids):
+                clinical_data.setdefault(cd.django_id, []).append(cd)
+
+            backups = BackupArchive(archive_path).batch()
+            changed = []
+            for patient_id in patient_ids:
+                patient = Patient(id=patient_id)
+                # per context results; the patient counts once, as processed if any context changed
+                ids = PatientIds()
+                for cd in clinical_data.get(patient_id, []):
+                    if not PLAN.applies_to(cd.data):
+                        continue
+                    m = Munger(registry, patient, backups, clinical_data=cd, ids=ids)
+                    m.dry_run = dry_run
+                    if m.munge():
+                        changed.append(cd)
+                if ids.ids_processed:
+                    result["ids_processed"].append(patient_id)
+                else:
+                    Logger(patient).log("no %s form in any context - skipping" % OLD_FORM)
+                    result["ids_skipped"].append(patient_id)
+
+            backups.flush()
+            if changed and not dry_run:
+                ClinicalData.objects.bulk_update(changed, ["data"])
+                # bulk_update sends no post_save
+                rebuild_patient_indexes(registry.code, {cd.django_id for cd in changed})
+    except Exception as ex:
+        print("chunk pids %s-%s failed ( rolled back): %s" % (result["first_id"], result["last_id"], ex))
+        print("Traceback:\n %s" % traceback.format_exc())
+        result["errors"] = 1
+        result["ids_processed"] = []
+        result["ids_skipped"] = []
+
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def _chunk_done(chunk_result, checkpoint):
+    Stats.merge(chunk_result)
+    print("chunk pids %s-%s done: %s patients in %.2fs" % (chunk_result["first_id"],
+                                                           chunk_result["last_id"],
+                                                           chunk_result["count"],
+                                                           chunk_result["seconds"]))
+    if checkpoint is not None and not chunk_result["errors"]:
+        checkpoint.mark_done(chunk_result["first_id"], chunk_result["last_id"])
+
+
+def run_chunked(dry_run=True, chunk_size=500, workers=1, checkpoint=None, archive_path=BACKUP_ARCHIVE):
+    if dry_run:
+        print("this is a dry run - no data will be changed or backed up")
+    else:
+        print("this is NOT a dry run - data will be updated chunk by chunk")
+    ang = Registry.objects.get(code="ang")
+    check_registry(ang)
+    print("checked registry - seems ok")
+
+    if checkpoint is not None:
+        checkpoint.load()
+        if dry_run:
+            # a dry run must not mark chunks as done for the real run
+            checkpoint = None
+
+    chunks = patient_id_chunks(chunk_size, checkpoint)
+    if workers <= 1:
+        for patient_ids in chunks:
+            _chunk_done(process_chunk(ang, patient_ids, dry_run, archive_path), checkpoint)
+        return
+
+    # Spawned workers set up their own database connections rather than
+    # sharing the parent's, which is busy streaming patient ids
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = set()
+        for patient_ids in chunks:
+            pending.add(pool.submit(process_chunk, ang, patient_ids, dry_run, archive_path))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _chunk_done(future.result(), checkpoint)
+        for future in wait(pending).done:
+            _chunk_done(future.result(), checkpoint)
+
+
+def parse_args(argv):
+    parser = ArgumentParser(
+        description="Move the speech and communication sections from %s to %s" % (OLD_FORM, NEW_FORM))
+    parser.add_argument("mode", nargs="?", default="dry",
+                        help='"real" to update data, anything else is a dry run')
+    parser.add_argument("--backup", default=BACKUP_ARCHIVE,
+                        help="compressed archive the documents are backed up to before they are changed"
+                             " (not written by a dry run)")
+    parser.add_argument("--chunked", action="store_true",
+                        help="stream patients in chunks, committing each chunk in its own transaction")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes to fan chunks out to (chunked mode only)")
+    parser.add_argument("--checkpoint", default="move_communication.checkpoint.json",
+                        help="file recording committed chunks (chunked mode only)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip chunks recorded in the checkpoint file")
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    dry_run = True
-    try:
-        dry_run = sys.argv[1] != "real"
-    except Exception:
-        pass
+    args = parse_args(sys.argv[1:])
+    dry_run = args.mode != "real"
 
     if not dry_run:
         answer = input("NOT a dry run - Are you sure? (yes/y/no/n): ")
         if answer.lower() not in ["y", "yes"]:
             sys.exit(0)
 
+    if args.chunked and not args.resume and os.path.exists(args.checkpoint):
+        print("checkpoint %s exists - rerun with --resume or remove it first" % args.checkpoint)
+        sys.exit(1)
+
+    Stats.started = time.monotonic()
     try:
-        with transaction.atomic():
-            run(dry_run)
+        if args.chunked:
+            checkpoint = Checkpoint(args.checkpoint)
+            connections.close_all()
+            run_chunked(dry_run, args.chunk_size, args.workers, checkpoint, args.backup)
+        else:
+            with transaction.atomic():
+                run(dry_run, args.backup)
 
-        total_skipped = len(Stats.ids_skipped)
-        total_processed = len(Stats.ids_processed)
-        print("stats total processed = %s" % total_processed)
-        print("stats total skipped = %s" % total_skipped)
+        Stats.finished = time.monotonic()
+        Stats.report()
+        if not dry_run:
+            print("backups written to %s - restore with: django-admin restore_clinical_data %s"
+                  % (args.backup, args.backup))
 
     except Exception as ex:
-        print("run failed ! ( rolled back): %s" % ex)
+        if args.chunked:
+            print("run failed ! ( committed chunks are kept - rerun with --resume): %s" % ex)
+        else:
+            print("run failed ! ( rolled back): %s" % ex)
         print("Traceback:\n %s" % traceback.format_exc())
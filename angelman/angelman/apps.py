@@ -0,0 +1,23 @@
+from django.apps import AppConfig
+
+
+class AngelmanConfig(AppConfig):
+    name = "angelman"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from angelman import checks  # noqa: F401
+        from angelman.clinical_data import signals as clinical_data_signals
+        from angelman.cohort import signals as cohort_signals
+        from angelman.consents import signals as consent_signals
+        from angelman.dashboard import signals as dashboard_signals
+        from angelman.definition import signals as definition_signals
+        from angelman.metrics import signals as metrics_signals
+        from angelman.metrics.registry import registry
+        definition_signals.connect_signals()
+        metrics_signals.connect_signals()
+        registry.clear_previous_run()
+        dashboard_signals.connect_signals()
+        consent_signals.connect_signals()
+        cohort_signals.connect_signals()
+        clinical_data_signals.connect_signals()
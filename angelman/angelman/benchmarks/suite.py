@@ -0,0 +1,188 @@
+"""
+Benchmarks of the hot paths of the registry, run against the cohort in the
+database (see generate_synthetic_cohort).
+
+Every benchmark is run a number of iterations; each iteration is timed and
+its database queries counted. Iterations which write run in a transaction
+which is rolled back, so the cohort is the same for every run.
+"""
+import logging
+import platform
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.utils import timezone
+
+from angelman.benchmarks.synthetic import CdeValues, family_row
+from angelman.clinical_data.partial import CdeWrite, set_cde_values
+from angelman.clinical_data.transform import Plan, SetCde
+from angelman.dashboard.completion import module_progress
+from angelman.definition.form_index import get_form_index
+from angelman.followups import due_patient_ids
+from angelman.forms.angelman_registration_form import ANGRegistrationForm
+from angelman.models import PatientDashboardSummary
+from angelman.query_budget import QueryBudget
+from angelman.registry.groups.registration.angelman_registration import AngelmanRegistration, get_diagnosis_options
+from angelman.report.export import iter_rows
+from rdrf.models.definition.models import ClinicalData, LongitudinalFollowup, Registry
+from registration.models import RegistrationProfile
+from registry.patients.models import Patient
+
+logger = logging.getLogger(__name__)
+
+
+class _Rollback(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower, upper = int(position), min(int(position) + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarise(timings, query_counts):
+    milliseconds = [t * 1000 for t in timings]
+    return {
+        "iterations": len(timings),
+        "p50_ms": percentile(milliseconds, 0.5),
+        "p90_ms": percentile(milliseconds, 0.9),
+        "p99_ms": percentile(milliseconds, 0.99),
+        "max_ms": max(milliseconds) if milliseconds else None,
+        "queries_mean": sum(query_counts) / len(query_counts) if query_counts else None,
+        "queries_max": max(query_counts) if query_counts else None,
+    }
+
+
+def measure(function, iterations, rollback=False):
+    timings, query_counts = [], []
+    for iteration in range(iterations):
+        counter = QueryBudget("benchmark", budget=float("inf"))
+        start = time.perf_counter()
+        try:
+            with counter, transaction.atomic():
+                function(iteration)
+                if rollback:
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        timings.append(time.perf_counter() - start)
+        query_counts.append(counter.count)
+    return summarise(timings, query_counts)
+
+
+class Suite:
+
+    def __init__(self, registry_code, iterations=20, seed=1):
+        self.registry = Registry.objects.get(code=registry_code)
+        self.iterations = iterations
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.patient_ids = list(Patient.objects.filter(rdrf_registry=self.registry).values_list("pk", flat=True))
+        self.documents = list(ClinicalData.objects.filter(
+            registry_code=registry_code, collection="cdes", django_model="Patient",
+        ).values_list("pk", flat=True))
+
+    def registration(self, iteration):
+        diagnosis_codes = [option["code"] for option in get_diagnosis_options() or []] or [""]
+        row = family_row(self.rng, f"bench{self.seed}", iteration, diagnosis_codes)
+        row["registry_code"] = self.registry.code
+        row["password1"] = row["password2"] = "Benchmark-Passw0rd!"
+        form = ANGRegistrationForm(data=row)
+        if not form.is_valid():
+            raise ValueError(f"Synthetic registration is invalid: {form.errors.as_json()}")
+        user = get_user_model().objects.create_user(username=row["username"], email=row["username"],
+                                                    password=row["password1"])
+        RegistrationProfile.objects.create_profile(user)
+        AngelmanRegistration(RequestFactory().get("/"), form=form).process(user)
+
+    def form_load(self, iteration):
+        clinical_data = ClinicalData.objects.get(pk=self.rng.choice(self.documents))
+        form_index = get_form_index(self.registry.code)
+        for form in clinical_data.data.get("forms", []):
+            for section in form.get("sections", []):
+                if not section.get("allow_multiple"):
+                    for cde in section.get("cdes", []):
+                        form_index.validate(form["name"], section["code"], cde["code"], cde.get("value"))
+
+    def form_save(self, iteration):
+        clinical_data = ClinicalData.objects.select_for_update().get(pk=self.rng.choice(self.documents))
+        form = self.rng.choice(clinical_data.data.get("forms") or [{"name": "", "sections": []}])
+        sections = [s for s in form["sections"] if not s.get("allow_multiple") and s.get("cdes")]
+        if sections:
+            section = self.rng.choice(sections)
+            cde = self.rng.choice(section["cdes"])
+            result = Plan([SetCde(form["name"], section["code"], cde["code"], cde.get("value"))]).apply(
+                clinical_data.data)
+            clinical_data.data = result.data
+        clinical_data.save()
+
+    def _cde_write_targets(self, sample_size=50):
+        targets = []
+        sample = self.rng.sample(self.documents, min(sample_size, len(self.documents)))
+        for clinical_data in ClinicalData.objects.filter(pk__in=sample):
+            for form in clinical_data.data.get("forms", []):
+                for section in form.get("sections", []):
+                    if not section.get("allow_multiple"):
+                        targets.extend((clinical_data.django_id, clinical_data.context_id, form["name"],
+                                        section["code"], cde["code"]) for cde in section.get("cdes", []))
+        return targets
+
+    def cde_write(self, iteration):
+        patient_id, context_id, form_name, section_code, cde_code = self.rng.choice(self.targets)
+        set_cde_values(self.registry.code, patient_id, context_id,
+                       [CdeWrite(form_name, section_code, cde_code, self.values.value(cde_code))])
+
+    def dashboard(self, iteration):
+        patient_id = self.rng.choice(self.patient_ids)
+        PatientDashboardSummary.objects.filter(patient_id=patient_id).first()
+        module_progress(patient_id, self.registry.code)
+
+    def followups(self, iteration):
+        now = timezone.now()
+        for followup in LongitudinalFollowup.objects.filter(context_form_group__registry=self.registry):
+            due_patient_ids(followup, now)
+
+    def report_export(self, iteration):
+        for __ in iter_rows(self.registry.code):
+            pass
+
+    def run(self, only=None):
+        benchmarks = [
+            ("registration", self.registration, self.iterations, True),
+            ("form_load", self.form_load, self.iterations, False),
+            ("form_save", self.form_save, self.iterations, True),
+            ("cde_write", self.cde_write, self.iterations, True),
+            ("dashboard", self.dashboard, self.iterations, False),
+            ("followup_scheduling", self.followups, max(1, self.iterations // 10), False),
+            ("report_export", self.report_export, 1, False),
+        ]
+        if not self.patient_ids or not self.documents:
+            raise ValueError(f"Registry {self.registry.code} has no patients - generate a cohort first")
+        if not only or "cde_write" in only:
+            self.targets = self._cde_write_targets()
+            self.values = CdeValues(self.rng, get_form_index(self.registry.code))
+            if not self.targets:
+                benchmarks = [benchmark for benchmark in benchmarks if benchmark[0] != "cde_write"]
+
+        results = {}
+        for name, function, iterations, rollback in benchmarks:
+            if only and name not in only:
+                continue
+            logger.info(f"Benchmark {name} ({iterations} iterations)")
+            results[name] = measure(function, iterations, rollback)
+        return {
+            "registry": self.registry.code,
+            "patients": len(self.patient_ids),
+            "clinical_data_documents": len(self.documents),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "run_at": timezone.now().isoformat(),
+            "benchmarks": results,
+        }
@@ -0,0 +1,187 @@
+"""
+Synthetic cohorts for benchmarking.
+
+Families are enrolled through the bulk family import (so they get users,
+parents, addresses, fixed contexts and a diagnosis like real registrations),
+then every patient gets contexts for the multiple context form groups,
+ClinicalData for the forms of each context with values generated from the
+cde datatypes and permissible value groups of the registry definition, and
+answers to the consent questions. Generation is deterministic for a seed.
+"""
+import logging
+import random
+from datetime import date, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from angelman.definition.form_index import get_form_index
+from angelman.patient_indexes import rebuild_patient_indexes
+from angelman.registry.groups.registration.angelman_registration import get_diagnosis_options
+from angelman.registry.groups.registration.bulk_import import FamilyImporter
+from rdrf.models.definition.models import ClinicalData, ConsentQuestion, ContextFormGroup, RDRFContext
+from registry.patients.models import ConsentValue, Patient
+
+logger = logging.getLogger(__name__)
+
+FIRST_NAMES = ["Alex", "Sam", "Charlie", "Jamie", "Robin", "Morgan", "Riley", "Taylor", "Jordan", "Casey"]
+SURNAMES = ["Smith", "Nguyen", "Garcia", "Müller", "Rossi", "Kowalski", "Tanaka", "Okafor", "Silva", "Brown"]
+COUNTRIES = ["AU", "NZ", "GB", "US", "CA", "DE", "FR", "IT", "ES", "NL"]
+WORDS = ["sleep", "walking", "seizure", "speech", "therapy", "smile", "school", "clinic", "review", "device"]
+
+# How many contexts a patient gets for each multiple context form group
+MULTIPLE_CONTEXTS = (0, 3)
+# Share of the cdes of a form which are filled in
+FILL_RATE = 0.7
+
+
+def _random_date(rng, start_year, end_year):
+    start = date(start_year, 1, 1)
+    return start + timedelta(days=rng.randrange((date(end_year, 12, 31) - start).days))
+
+
+def family_row(rng, seed, index, diagnosis_codes):
+    surname = rng.choice(SURNAMES)
+    country = rng.choice(COUNTRIES)
+    return {
+        "username": f"synthetic-{seed}-{index}@example.org",
+        "first_name": rng.choice(FIRST_NAMES),
+        "surname": surname,
+        "date_of_birth": _random_date(rng, 1985, 2022).isoformat(),
+        "gender": rng.choice(["1", "2"]),
+        "diagnosis": rng.choice(diagnosis_codes),
+        "same_address": "on",
+        "parent_guardian_first_name": rng.choice(FIRST_NAMES),
+        "parent_guardian_last_name": surname,
+        "parent_guardian_date_of_birth": _random_date(rng, 1950, 2000).isoformat(),
+        "parent_guardian_gender": rng.choice(["1", "2"]),
+        "parent_guardian_address": f"{rng.randint(1, 500)} {rng.choice(WORDS).title()} Street",
+        "parent_guardian_suburb": rng.choice(WORDS).title(),
+        "parent_guardian_country": country,
+        "parent_guardian_postcode": str(rng.randint(1000, 9999)),
+        "parent_guardian_phone": f"+61 4{rng.randint(10000000, 99999999)}",
+    }
+
+
+class CdeValues:
+    """
+    Generates values for cdes from the datatype and permissible values of their CdeSpec
+    """
+
+    def __init__(self, rng, form_index):
+        self.rng = rng
+        self.cdes = form_index.cdes
+
+    def value(self, code):
+        cde = self.cdes.get(code)
+        if cde is None:
+            return None
+        rng = self.rng
+        datatype = cde.datatype
+        if cde.options:
+            codes = [option_code for option_code, __ in cde.options]
+            if cde.allow_multiple:
+                return rng.sample(codes, rng.randint(1, min(3, len(codes))))
+            return rng.choice(codes)
+        minimum = cde.min_value if cde.min_value is not None else 0
+        maximum = cde.max_value if cde.max_value is not None else 100
+        if datatype == "integer":
+            return str(rng.randint(int(minimum), int(maximum)))
+        if datatype in ("float", "decimal"):
+            return str(round(rng.uniform(minimum, maximum), 2))
+        if datatype == "date":
+            return _random_date(rng, 2000, 2023).isoformat()
+        if datatype == "boolean":
+            return rng.choice([True, False])
+        if datatype in ("string", "text", "textarea", "email"):
+            return " ".join(rng.choice(WORDS) for __ in range(rng.randint(1, 6)))
+        # files, calculated fields etc are left empty
+        return None
+
+
+class CohortGenerator:
+
+    def __init__(self, registry_code, seed=1, chunk_size=200):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.importer = FamilyImporter(registry_code, chunk_size=chunk_size, rebuild_indexes=False)
+        self.registry = self.importer.registry
+        self.form_index = get_form_index(registry_code)
+        self.values = CdeValues(self.rng, self.form_index)
+        self.context_form_groups = list(ContextFormGroup.objects.filter(registry=self.registry)
+                                        .prefetch_related("items__registry_form"))
+        self.consent_questions = list(ConsentQuestion.objects.filter(section__registry=self.registry))
+        self.patient_content_type = ContentType.objects.get_for_model(Patient)
+
+    def generate(self, count):
+        diagnosis_codes = [option["code"] for option in get_diagnosis_options() or []] or [""]
+        start = Patient.objects.filter(rdrf_registry=self.registry).count()
+        patient_ids = []
+        chunk = []
+        for index in range(start, start + count):
+            form = self.importer.validate(index, family_row(self.rng, self.seed, index, diagnosis_codes))
+            if form is not None:
+                chunk.append(form)
+            if len(chunk) == self.importer.chunk_size or index == start + count - 1:
+                patients = self.importer.import_chunk(chunk) if chunk else []
+                self._populate(patients)
+                patient_ids.extend(patient.pk for patient in patients)
+                chunk = []
+                logger.info(f"Synthetic cohort - {len(patient_ids)} of {count} patients")
+
+        for error in self.importer.errors:
+            logger.warning(f"Synthetic cohort - family {error.row_number} rejected: {error.errors}")
+        rebuild_patient_indexes(self.registry.code, patient_ids)
+        return patient_ids
+
+    def _document(self, patient_id, context_id, form_names):
+        forms = []
+        for form_name in form_names:
+            form = self.form_index.form(form_name)
+            sections = []
+            for section_code in form.sections if form else ():
+                cde_codes = self.form_index.sections[section_code].cdes
+                if self.form_index.sections[section_code].allow_multiple:
+                    items = [self._cdes(cde_codes) for __ in range(self.rng.randint(0, 2))]
+                    sections.append({"code": section_code, "allow_multiple": True, "cdes": items})
+                else:
+                    sections.append({"code": section_code, "allow_multiple": False, "cdes": self._cdes(cde_codes)})
+            forms.append({"name": form_name, "sections": sections})
+        return {"django_model": "Patient", "django_id": patient_id, "context_id": context_id, "forms": forms}
+
+    def _cdes(self, cde_codes):
+        return [{"code": code, "value": self.values.value(code) if self.rng.random() < FILL_RATE else None}
+                for code in sorted(cde_codes)]
+
+    def _populate(self, patients):
+        if not patients:
+            return
+        patient_ids = [patient.pk for patient in patients]
+        with transaction.atomic():
+            contexts = RDRFContext.objects.bulk_create([
+                RDRFContext(registry=self.registry, content_type=self.patient_content_type, object_id=patient_id,
+                            context_form_group=cfg, display_name=cfg.name)
+                for patient_id in patient_ids
+                for cfg in self.context_form_groups if cfg.context_type != "F"
+                for __ in range(self.rng.randint(*MULTIPLE_CONTEXTS))
+            ])
+            contexts += list(RDRFContext.objects.filter(registry=self.registry, object_id__in=patient_ids,
+                                                        context_form_group__context_type="F"))
+            form_names = {cfg.pk: [item.registry_form.name for item in cfg.items.all()]
+                          for cfg in self.context_form_groups}
+            existing = set(ClinicalData.objects.filter(
+                registry_code=self.registry.code, collection="cdes", django_id__in=patient_ids,
+            ).values_list("django_id", "context_id"))
+            ClinicalData.objects.bulk_create([
+                ClinicalData(registry_code=self.registry.code, collection="cdes", django_model="Patient",
+                             django_id=context.object_id, context_id=context.pk,
+                             data=self._document(context.object_id, context.pk,
+                                                 form_names.get(context.context_form_group_id, [])))
+                for context in contexts
+                if (context.object_id, context.pk) not in existing
+            ], batch_size=500)
+            ConsentValue.objects.bulk_create([
+                ConsentValue(patient_id=patient_id, consent_question=question, answer=self.rng.random() < 0.9)
+                for patient_id in patient_ids
+                for question in self.consent_questions
+            ], batch_size=2000)
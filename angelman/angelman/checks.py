@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches, deploy=True)
+def check_definition_cache(app_configs, **kwargs):
+    if settings.DEFINITION_CACHE_ALIAS:
+        return []
+    if settings.DEFINITION_CACHE_TIMEOUT:
+        message = (f"DEFINITION_CACHE_ALIAS is not set: with more than one worker process, a registry definition "
+                   f"change reaches the other workers only after DEFINITION_CACHE_TIMEOUT "
+                   f"({settings.DEFINITION_CACHE_TIMEOUT}s)")
+    else:
+        message = ("DEFINITION_CACHE_ALIAS is not set and DEFINITION_CACHE_TIMEOUT is 0: with more than one worker "
+                   "process, a registry definition change never reaches the other workers")
+    return [Warning(message, hint="Set DEFINITION_CACHE_ALIAS to a cache shared by all workers (e.g. memcached)",
+                    id="angelman.W001")]
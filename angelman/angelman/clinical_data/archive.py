@@ -0,0 +1,123 @@
+"""
+Append-only, compressed backup archive of ClinicalData documents.
+
+The archive is a gzip file of JSON lines in which every record is written as
+its own gzip member, so the file as a whole can be streamed with gzip.open
+while a single record can be read by seeking to its member. A sidecar index
+(<archive>.idx, plain JSON lines) records the offset and length of each
+member together with the record's natural key.
+
+Several processes can append to the same archive: every append takes an
+exclusive lock on the archive file for the duration of the write.
+"""
+import fcntl
+import gzip
+import json
+import os
+import zlib
+from collections import namedtuple
+
+COMPRESS_LEVEL = 6
+
+KEY_FIELDS = ["collection", "registry_code", "django_model", "django_id", "context_id"]
+
+IndexEntry = namedtuple("IndexEntry", KEY_FIELDS + ["offset", "length"])
+
+
+def backup_record(registry_code, django_id, context_id, data, django_model="Patient", collection="cdes"):
+    return {
+        "collection": collection,
+        "registry_code": registry_code,
+        "django_model": django_model,
+        "django_id": django_id,
+        "context_id": context_id,
+        "data": data,
+    }
+
+
+def record_key(record):
+    return tuple(record[f] for f in KEY_FIELDS)
+
+
+class BackupArchive:
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = "%s.idx" % path
+
+    def append(self, records):
+        members = [gzip.compress((json.dumps(record) + "\n").encode("utf-8"), compresslevel=COMPRESS_LEVEL)
+                   for record in records]
+        if not members:
+            return 0
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                index_lines = []
+                for record, member in zip(records, members):
+                    f.write(member)
+                    entry = {key: record[key] for key in KEY_FIELDS}
+                    entry.update(offset=offset, length=len(member))
+                    index_lines.append(json.dumps(entry) + "\n")
+                    offset += len(member)
+                f.flush()
+                os.fsync(f.fileno())
+                with open(self.index_path, "a") as index_file:
+                    index_file.writelines(index_lines)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return len(members)
+
+    def batch(self):
+        return _ArchiveBatch(self)
+
+    def __iter__(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def index(self):
+        with open(self.index_path) as f:
+            for line in f:
+                yield IndexEntry(**json.loads(line))
+
+    def find(self, **criteria):
+        unknown = set(criteria) - set(KEY_FIELDS)
+        if unknown:
+            raise ValueError("Cannot look up backup records by %s" % ", ".join(sorted(unknown)))
+        return [entry for entry in self.index()
+                if all(getattr(entry, key) == value for key, value in criteria.items())]
+
+    def read(self, entry):
+        with open(self.path, "rb") as f:
+            f.seek(entry.offset)
+            member = f.read(entry.length)
+        line = zlib.decompress(member, wbits=zlib.MAX_WBITS | 16)
+        return json.loads(line)
+
+
+class _ArchiveBatch:
+    """
+    Collects records in memory and appends them in one locked write, used to
+    write all backups of a chunk of patients at once.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        written = self.archive.append(self.records)
+        self.records = []
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
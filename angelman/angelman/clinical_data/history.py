@@ -0,0 +1,274 @@
+"""
+Delta compressed history of ClinicalData documents.
+
+RDRF stores the history of a document as ClinicalData rows of the "history"
+collection, each a full copy of the record. With
+settings.CLINICAL_DATA_HISTORY_DELTAS those rows are moved into
+ClinicalDataHistory when they are written: every
+CLINICAL_DATA_HISTORY_SNAPSHOT_INTERVAL versions a full snapshot, in between
+only the diff against the previous version, e.g.
+
+    [["s", ["record", "forms", 3, "sections", 1, "cdes", 4, "value"], "21"], ["d", ["record", "old_key"]]]
+
+Diffs descend into dicts and into lists of unchanged length (cde positions
+are stable between saves); other changes replace the value. materialise()
+rebuilds any version from the snapshot before it, and the
+compact_clinical_data_history command converts existing history rows.
+
+RDRF's cde history page is served by angelman.clinical_data.views, which adds
+the versions of the compressed history (see cde_history) to the history rows
+not compacted yet.
+"""
+import json
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from angelman.models import ClinicalDataHistory
+from rdrf.models.definition.models import ClinicalData
+
+logger = logging.getLogger(__name__)
+
+HISTORY_COLLECTION = "history"
+
+# attempts at appending a version before giving up
+WRITE_ATTEMPTS = 3
+
+_MISSING = object()
+
+
+def diff(old, new, path=()):
+    """
+    Returns the operations turning old into new
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = [["d", list(path) + [key]] for key in old if key not in new]
+        for key, value in new.items():
+            previous = old.get(key, _MISSING)
+            if previous is _MISSING:
+                operations.append(["s", list(path) + [key], value])
+            elif previous != value:
+                operations.extend(diff(previous, value, path + (key,)))
+        return operations
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        operations = []
+        for index, (previous, value) in enumerate(zip(old, new)):
+            if previous != value:
+                operations.extend(diff(previous, value, path + (index,)))
+        return operations
+    return [] if old == new else [["s", list(path), new]]
+
+
+def patch(data, operations):
+    """
+    Applies diff operations to data in place, returns the result (a new object when the root is replaced)
+    """
+    for operation in operations:
+        path = operation[1]
+        if not path:
+            data = operation[2]
+            continue
+        parent = data
+        for key in path[:-1]:
+            parent = parent[key]
+        if operation[0] == "s":
+            parent[path[-1]] = operation[2]
+        else:
+            del parent[path[-1]]
+    return data
+
+
+def _key(clinical_data):
+    return dict(registry_code=clinical_data.registry_code, django_model=clinical_data.django_model,
+                django_id=clinical_data.django_id, context_id=clinical_data.context_id)
+
+
+def _created_at(data):
+    timestamp = (data or {}).get("timestamp")
+    if timestamp:
+        try:
+            created_at = datetime.fromisoformat(str(timestamp))
+            return timezone.make_aware(created_at) if timezone.is_naive(created_at) else created_at
+        except ValueError:
+            pass
+    return timezone.now()
+
+
+def _versions(key):
+    return ClinicalDataHistory.objects.filter(**key).order_by("version")
+
+
+def iter_versions(registry_code, django_id, context_id, django_model="Patient"):
+    """
+    Yields (ClinicalDataHistory, full history record) for every version in
+    order; the record is patched in place into the next version, copy it to keep it
+    """
+    current = None
+    for entry in _versions(dict(registry_code=registry_code, django_model=django_model, django_id=django_id,
+                                context_id=context_id)).iterator():
+        current = entry.data if entry.snapshot else patch(current, entry.data)
+        yield entry, current
+
+
+def materialise(registry_code, django_id, context_id, version=None, django_model="Patient"):
+    """
+    Returns the full history record of a version (the latest by default), or
+    None when there is none or no snapshot precedes it
+    """
+    key = dict(registry_code=registry_code, django_model=django_model, django_id=django_id, context_id=context_id)
+    entries = _versions(key)
+    if version is not None:
+        entries = entries.filter(version__lte=version)
+    last = entries.last()
+    if last is None or (version is not None and last.version != version):
+        return None
+    snapshot = entries.filter(snapshot=True).last()
+    if snapshot is None:
+        logger.warning(f"No history snapshot of {key} precedes version {last.version}")
+        return None
+    data = None
+    for entry in entries.filter(version__gte=snapshot.version):
+        data = entry.data if entry.snapshot else patch(data, entry.data)
+    return data
+
+
+def _cde_value(record, form_name, section_code, cde_code, formset_index=None):
+    for form in (record or {}).get("forms", []):
+        if form.get("name") != form_name:
+            continue
+        for section in form.get("sections", []):
+            if section.get("code") != section_code:
+                continue
+            items = section.get("cdes") or []
+            if section.get("allow_multiple"):
+                items = items[formset_index] if formset_index is not None and formset_index < len(items) else []
+            for cde in items:
+                if cde.get("code") == cde_code:
+                    return cde.get("value")
+    return None
+
+
+def cde_history(registry_code, django_id, context_id, form_name, section_code, cde_code, formset_index=None,
+                django_model="Patient"):
+    """
+    Returns the value of a cde in every version of the compressed history, oldest first, as
+    {"timestamp", "value", "user"} dicts
+    """
+    history = []
+    for entry, data in iter_versions(registry_code, django_id, context_id, django_model):
+        history.append({
+            "timestamp": entry.created_at,
+            "value": _cde_value(data.get("record"), form_name, section_code, cde_code, formset_index),
+            "user": data.get("username"),
+        })
+    return history
+
+
+class HistoryWriter:
+    """
+    Appends versions to the compressed history, keeping the latest record of
+    each document in memory so a stream of versions is diffed without reading
+    them back
+    """
+
+    def __init__(self, snapshot_interval=None):
+        self.snapshot_interval = snapshot_interval or settings.CLINICAL_DATA_HISTORY_SNAPSHOT_INTERVAL
+        self._latest = {}
+
+    def _latest_version(self, key):
+        cache_key = tuple(key.values())
+        if cache_key not in self._latest:
+            last = _versions(key).last()
+            data = materialise(version=last.version, **key) if last else None
+            self._latest[cache_key] = (last.version if last else 0, data)
+        return self._latest[cache_key]
+
+    def forget(self, key):
+        self._latest.pop(tuple(key.values()), None)
+
+    def entry(self, key, data, created_at):
+        version, previous = self._latest_version(key)
+        version += 1
+        snapshot = previous is None or (version - 1) % self.snapshot_interval == 0
+        self._latest[tuple(key.values())] = (version, data)
+        return ClinicalDataHistory(version=version, snapshot=snapshot,
+                                   data=data if snapshot else diff(previous, data),
+                                   created_at=created_at, **key)
+
+
+def _lock_document(key):
+    """
+    Locks the document the history belongs to, so the versions of concurrent saves are appended one after the other
+    """
+    list(ClinicalData.objects.filter(collection="cdes", **key).select_for_update().values_list("pk", flat=True))
+
+
+def record_history(clinical_data):
+    """
+    Moves a history row written by RDRF into the compressed history. A
+    version taken by a concurrent save is retried with the next version
+    """
+    key = _key(clinical_data)
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                _lock_document(key)
+                entry = HistoryWriter().entry(key, clinical_data.data, _created_at(clinical_data.data))
+                entry.save()
+                ClinicalData.objects.filter(pk=clinical_data.pk).delete()
+            return entry
+        except IntegrityError:
+            if attempt == WRITE_ATTEMPTS:
+                raise
+            logger.warning(f"Version of history row {clinical_data.pk} taken by a concurrent save, retrying")
+
+
+def compact(registry_code=None, batch_size=500, dry_run=False):
+    """
+    Moves the existing history rows into the compressed history in batches,
+    returns (rows, bytes of the rows, bytes of the versions written). Rows are
+    appended after the versions a document already has, so run it before the
+    site serves saves with CLINICAL_DATA_HISTORY_DELTAS on
+    """
+    rows = ClinicalData.objects.filter(collection=HISTORY_COLLECTION)
+    if registry_code:
+        rows = rows.filter(registry_code=registry_code)
+    rows = rows.order_by("registry_code", "django_model", "django_id", "context_id", "pk")
+
+    writer = HistoryWriter()
+    count = original_size = compressed_size = 0
+    batch = []
+    previous_key = None
+
+    def flush():
+        with transaction.atomic():
+            if not dry_run:
+                ClinicalDataHistory.objects.bulk_create([entry for __, entry in batch])
+                ClinicalData.objects.filter(pk__in=[pk for pk, __ in batch]).delete()
+
+    for clinical_data in rows.iterator(chunk_size=batch_size):
+        key = _key(clinical_data)
+        if key != previous_key:
+            # rows come ordered by document, the previous one is done
+            if previous_key is not None:
+                writer.forget(previous_key)
+            previous_key = key
+        entry = writer.entry(key, clinical_data.data, _created_at(clinical_data.data))
+        batch.append((clinical_data.pk, entry))
+        count += 1
+        original_size += len(_dumps(clinical_data.data))
+        compressed_size += len(_dumps(entry.data))
+        if len(batch) == batch_size:
+            flush()
+            batch = []
+            logger.info(f"Compacted {count} history rows")
+    if batch:
+        flush()
+    return count, original_size, compressed_size
+
+
+def _dumps(data):
+    return json.dumps(data, default=str)
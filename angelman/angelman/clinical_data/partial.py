@@ -0,0 +1,176 @@
+"""
+Partial writes of cde values into a ClinicalData document.
+
+Writing one cde through patient.set_form_value loads, modifies and saves the
+whole document of the context. set_cde_values instead locks the document row
+and, on PostgreSQL, finds the array positions of the cdes with a query over
+the jsonb document and updates them in place with jsonb_set, so a write is
+one small UPDATE whatever the size of the document:
+
+    set_cde_values("ang", patient.pk, context.pk, [
+        CdeWrite("CheckUp6Months", "6moAgehw", "6MoWeight", "21"),
+    ])
+
+When the document, form, section or cde does not exist yet, or on other
+databases, the locked document is read, transformed with SetCde and saved.
+
+An in place update does not save the model, so post_save does not fire;
+cde_values_written is sent instead, with the old value of every changed cde,
+for the receivers which maintain indexes of the documents.
+"""
+import json
+import logging
+from collections import namedtuple
+
+from django.db import connection, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from angelman.clinical_data.transform import Plan, SetCde
+from angelman.metrics.registry import span
+from rdrf.models.definition.models import ClinicalData
+
+logger = logging.getLogger(__name__)
+
+CdeWrite = namedtuple("CdeWrite", ["form", "section", "cde", "value"])
+
+# sent with registry_code, patient_id, context_id and changes, a list of (CdeWrite, old value)
+cde_values_written = Signal()
+
+_MISSING = object()
+
+_POSITIONS_SQL = """
+    SELECT f.i - 1, f.form->>'name', s.i - 1, s.section->>'code', c.i - 1, c.cde->>'code', (c.cde->'value')::text
+    FROM {table} cd
+    CROSS JOIN LATERAL jsonb_array_elements(cd.data->'forms') WITH ORDINALITY AS f(form, i)
+    CROSS JOIN LATERAL jsonb_array_elements(f.form->'sections') WITH ORDINALITY AS s(section, i)
+    CROSS JOIN LATERAL jsonb_array_elements(s.section->'cdes') WITH ORDINALITY AS c(cde, i)
+    WHERE cd.id = %s
+      AND f.form->>'name' = ANY(%s)
+      AND COALESCE(s.section->>'allow_multiple', 'false') <> 'true'
+"""
+
+
+class PartialWriteResult:
+
+    def __init__(self):
+        # (CdeWrite, old value) of the values which changed
+        self.changes = []
+        # index of a write -> error messages
+        self.errors = {}
+        self.in_place = False
+
+
+def new_document(registry_code, patient_id, context_id):
+    return ClinicalData(
+        registry_code=registry_code,
+        collection="cdes",
+        django_model="Patient",
+        django_id=patient_id,
+        context_id=context_id,
+        data={"django_model": "Patient", "django_id": patient_id, "context_id": context_id, "forms": []},
+    )
+
+
+def _documents(registry_code, patient_id, context_id):
+    return ClinicalData.objects.filter(registry_code=registry_code, collection="cdes", django_model="Patient",
+                                       django_id=patient_id, context_id=context_id)
+
+
+def _timestamps(writes):
+    now = timezone.now().isoformat()
+    return {f"{form_name}_timestamp": now for form_name in {write.form for write in writes}}
+
+
+def _update_in_place(pk, writes, result):
+    """
+    Returns False when a cde is not in the document yet
+    """
+    # the last write of a cde wins, its old value is the one in the document
+    latest = {(write.form, write.section, write.cde): write for write in writes}
+    with connection.cursor() as cursor:
+        cursor.execute(_POSITIONS_SQL.format(table=connection.ops.quote_name(ClinicalData._meta.db_table)),
+                       [pk, sorted({write.form for write in writes})])
+        positions = {(form_name, section_code, cde_code): (form_index, section_index, cde_index, value)
+                     for form_index, form_name, section_index, section_code, cde_index, cde_code, value in cursor}
+
+    paths = []
+    for key, write in latest.items():
+        position = positions.get(key)
+        if position is None:
+            return False
+        form_index, section_index, cde_index, old_value = position
+        # the json text of the value, NULL when the cde has no value key
+        old_value = json.loads(old_value) if old_value is not None else None
+        if old_value != write.value:
+            path = ["forms", str(form_index), "sections", str(section_index), "cdes", str(cde_index), "value"]
+            paths.append((path, write.value))
+            result.changes.append((write, old_value))
+    if not paths:
+        return True
+
+    for key, timestamp in _timestamps(write for write, __ in result.changes).items():
+        paths.append(([key], timestamp))
+    expression, params = "data", []
+    for path, value in paths:
+        expression = f"jsonb_set({expression}, %s::text[], %s::jsonb)"
+        params.extend([path, json.dumps(value)])
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {connection.ops.quote_name(ClinicalData._meta.db_table)} "
+                       f"SET data = {expression} WHERE id = %s", params + [pk])
+    return True
+
+
+def _current_value(data, write):
+    for form in data.get("forms", []):
+        if form["name"] != write.form:
+            continue
+        for section in form.get("sections", []):
+            if section["code"] == write.section and not section.get("allow_multiple"):
+                for cde in section.get("cdes", []):
+                    if cde["code"] == write.cde:
+                        return cde.get("value")
+    return _MISSING
+
+
+def _read_modify_write(clinical_data, writes, result):
+    data = clinical_data.data or {}
+    for index, write in enumerate(writes):
+        old_value = _current_value(data, write)
+        transformed = Plan([SetCde(write.form, write.section, write.cde, write.value)]).apply(data)
+        errors = [message for level, message in transformed.messages if level == "ERROR"]
+        if errors:
+            result.errors[index] = errors
+        elif transformed.changed:
+            data = transformed.data
+            result.changes.append((write, None if old_value is _MISSING else old_value))
+    if result.changes:
+        data.update(_timestamps(write for write, __ in result.changes))
+        clinical_data.data = data
+        clinical_data.save()
+
+
+def set_cde_values(registry_code, patient_id, context_id, writes):
+    """
+    Sets the values of cdes of single sections in the document of a patient context, returns a PartialWriteResult
+    """
+    writes = [CdeWrite(*write) for write in writes]
+    result = PartialWriteResult()
+    if not writes:
+        return result
+
+    with span("clinical_data.partial_write"), transaction.atomic():
+        pk = _documents(registry_code, patient_id, context_id).select_for_update().values_list(
+            "pk", flat=True).first()
+        if pk is not None and connection.vendor == "postgresql" and _update_in_place(pk, writes, result):
+            result.in_place = True
+            if result.changes:
+                cde_values_written.send(sender=ClinicalData, registry_code=registry_code, patient_id=patient_id,
+                                        context_id=context_id, changes=result.changes)
+            return result
+
+        result.changes = []
+        clinical_data = (ClinicalData.objects.get(pk=pk) if pk is not None
+                         else new_document(registry_code, patient_id, context_id))
+        _read_modify_write(clinical_data, writes, result)
+    return result
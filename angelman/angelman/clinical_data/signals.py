@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.db.models.signals import post_save
+
+from angelman.clinical_data.history import HISTORY_COLLECTION, record_history
+from rdrf.models.definition.models import ClinicalData
+
+
+def history_saved(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw and instance.collection == HISTORY_COLLECTION and settings.CLINICAL_DATA_HISTORY_DELTAS:
+        record_history(instance)
+
+
+def connect_signals():
+    post_save.connect(history_saved, sender=ClinicalData, dispatch_uid="angelman_clinical_data_history")
@@ -0,0 +1,392 @@
+"""
+Declarative transformations of ClinicalData documents.
+
+A migration is declared as a list of operations which is compiled once into a
+Plan and then applied to each document:
+
+    plan = Plan([
+        MoveSection("ANGBEHDEVSPEECHLANGUAGE", "AngelmanRegistryBehaviourAndDevelopment",
+                    "AngelmanRegistryCommunication"),
+        RenameCde("AngelmanRegistryCommunication", "ANGBEHDEVCOMMUNICATION", "OldCode", "NewCode"),
+    ])
+    result = plan.apply(clinical_data.data)
+    if result.changed:
+        clinical_data.data = result.data
+
+Documents are never modified in place: only the forms, sections and cde lists
+an operation writes to are copied, everything else is shared with the input.
+"""
+from collections import namedtuple
+
+
+class TransformError(Exception):
+    pass
+
+
+TransformResult = namedtuple("TransformResult", ["data", "changed", "messages"])
+
+
+class _Document:
+
+    def __init__(self, data):
+        self.data = dict(data)
+        self.data["forms"] = list(data.get("forms", []))
+        self.changed = False
+        self.messages = []
+        self._forms = {form_dict["name"]: index for index, form_dict in enumerate(self.data["forms"])}
+        self._sections = {}
+        self._owned = set()
+
+    def _own(self, obj):
+        self._owned.add(id(obj))
+        return obj
+
+    def _is_owned(self, obj):
+        return id(obj) in self._owned
+
+    def info(self, msg):
+        self.messages.append(("INFO", msg))
+
+    def warn(self, msg):
+        self.messages.append(("WARN", msg))
+
+    def error(self, msg):
+        self.messages.append(("ERROR", msg))
+
+    def form(self, form_name):
+        index = self._forms.get(form_name)
+        return None if index is None else self.data["forms"][index]
+
+    def writable_form(self, form_name, create=False):
+        index = self._forms.get(form_name)
+        if index is None:
+            if not create:
+                return None
+            form_dict = self._own({"name": form_name, "sections": self._own([])})
+            self._forms[form_name] = len(self.data["forms"])
+            self.data["forms"].append(form_dict)
+            self.changed = True
+            self.info("created form %s" % form_name)
+            return form_dict
+
+        form_dict = self.data["forms"][index]
+        if not self._is_owned(form_dict):
+            form_dict = self._own(dict(form_dict))
+            form_dict["sections"] = self._own(list(form_dict.get("sections", [])))
+            self.data["forms"][index] = form_dict
+        return form_dict
+
+    def _section_index(self, form_name):
+        if form_name not in self._sections:
+            form_dict = self.form(form_name)
+            sections = form_dict.get("sections", []) if form_dict else []
+            self._sections[form_name] = {section_dict["code"]: index for index, section_dict in enumerate(sections)}
+        return self._sections[form_name]
+
+    def section(self, form_name, section_code):
+        index = self._section_index(form_name).get(section_code)
+        return None if index is None else self.form(form_name)["sections"][index]
+
+    def writable_section(self, form_name, section_code):
+        index = self._section_index(form_name).get(section_code)
+        if index is None:
+            return None
+        sections = self.writable_form(form_name)["sections"]
+        section_dict = sections[index]
+        if not self._is_owned(section_dict):
+            section_dict = self._own(dict(section_dict))
+            if section_dict.get("allow_multiple"):
+                section_dict["cdes"] = self._own([self._own([dict(cde) for cde in item])
+                                                  for item in section_dict.get("cdes", [])])
+            else:
+                section_dict["cdes"] = self._own([dict(cde) for cde in section_dict.get("cdes", [])])
+            sections[index] = section_dict
+        return section_dict
+
+    def add_section(self, form_name, section_dict):
+        form_dict = self.writable_form(form_name, create=True)
+        self._section_index(form_name)[section_dict["code"]] = len(form_dict["sections"])
+        form_dict["sections"].append(section_dict)
+        self.changed = True
+
+    def remove_section(self, form_name, section_code):
+        form_dict = self.writable_form(form_name)
+        form_dict["sections"] = self._own([s for s in form_dict["sections"] if s["code"] != section_code])
+        self._sections.pop(form_name, None)
+        self.changed = True
+
+    def mark_changed(self):
+        self.changed = True
+
+
+def _section_items(section_dict):
+    if section_dict.get("allow_multiple"):
+        return section_dict.get("cdes", [])
+    return [section_dict.get("cdes", [])]
+
+
+class Operation:
+    source_forms = ()
+    # operations which write to forms the document may not have yet
+    creates_forms = False
+
+    def apply(self, doc):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % kv for kv in vars(self).items()))
+
+
+class _SectionOperation(Operation):
+
+    def __init__(self, section_code, from_form, to_form):
+        if from_form == to_form:
+            raise TransformError("%s: source and target form are both %s" % (self.__class__.__name__, from_form))
+        self.section_code = section_code
+        self.from_form = from_form
+        self.to_form = to_form
+        self.source_forms = (from_form,)
+
+    def _copy_section(self, doc):
+        section_dict = doc.section(self.from_form, self.section_code)
+        if section_dict is None:
+            doc.warn("%s section does not exist in %s - skipping" % (self.section_code, self.from_form))
+            return False
+        if doc.section(self.to_form, self.section_code) is not None:
+            doc.error("section %s already exists in %s?" % (self.section_code, self.to_form))
+            return False
+        # sections are only replaced, never modified in place, so the copy can share the dict
+        doc.add_section(self.to_form, section_dict)
+        doc.info("added section %s to %s" % (self.section_code, self.to_form))
+        return True
+
+
+class CopySection(_SectionOperation):
+
+    def apply(self, doc):
+        self._copy_section(doc)
+
+
+class MoveSection(_SectionOperation):
+
+    def apply(self, doc):
+        if self._copy_section(doc):
+            doc.remove_section(self.from_form, self.section_code)
+            doc.info("removed section %s from %s" % (self.section_code, self.from_form))
+
+
+class RenameSection(Operation):
+
+    def __init__(self, form_name, old_code, new_code):
+        self.form_name = form_name
+        self.old_code = old_code
+        self.new_code = new_code
+        self.source_forms = (form_name,)
+
+    def apply(self, doc):
+        if doc.section(self.form_name, self.old_code) is None:
+            doc.warn("%s section does not exist in %s - skipping" % (self.old_code, self.form_name))
+            return
+        if doc.section(self.form_name, self.new_code) is not None:
+            doc.error("section %s already exists in %s?" % (self.new_code, self.form_name))
+            return
+        section_dict = dict(doc.section(self.form_name, self.old_code))
+        section_dict["code"] = self.new_code
+        doc.remove_section(self.form_name, self.old_code)
+        doc.add_section(self.form_name, section_dict)
+        doc.info("renamed section %s to %s in %s" % (self.old_code, self.new_code, self.form_name))
+
+
+class DeleteSection(Operation):
+
+    def __init__(self, form_name, section_code):
+        self.form_name = form_name
+        self.section_code = section_code
+        self.source_forms = (form_name,)
+
+    def apply(self, doc):
+        if doc.section(self.form_name, self.section_code) is None:
+            return
+        doc.remove_section(self.form_name, self.section_code)
+        doc.info("deleted section %s from %s" % (self.section_code, self.form_name))
+
+
+class _CdeOperation(Operation):
+
+    def __init__(self, cde_code, from_form, from_section, to_form, to_section):
+        if (from_form, from_section) == (to_form, to_section):
+            raise TransformError("%s: source and target of %s are the same" % (self.__class__.__name__, cde_code))
+        self.cde_code = cde_code
+        self.from_form = from_form
+        self.from_section = from_section
+        self.to_form = to_form
+        self.to_section = to_section
+        self.source_forms = (from_form,)
+
+    def _copy_cde(self, doc):
+        source = doc.section(self.from_form, self.from_section)
+        if source is None:
+            doc.warn("%s section does not exist in %s - skipping" % (self.from_section, self.from_form))
+            return False
+        values = [[dict(cde) for cde in item if cde["code"] == self.cde_code] for item in _section_items(source)]
+        if not any(values):
+            doc.warn("%s not present in %s/%s - skipping" % (self.cde_code, self.from_form, self.from_section))
+            return False
+
+        target = doc.section(self.to_form, self.to_section)
+        if target is None:
+            doc.add_section(self.to_form, {"code": self.to_section,
+                                           "allow_multiple": bool(source.get("allow_multiple")),
+                                           "cdes": []})
+            target = doc.section(self.to_form, self.to_section)
+        if bool(target.get("allow_multiple")) != bool(source.get("allow_multiple")):
+            doc.error("cannot move %s between multiple and single sections (%s -> %s)" % (
+                self.cde_code, self.from_section, self.to_section))
+            return False
+        if any(cde["code"] == self.cde_code for item in _section_items(target) for cde in item):
+            doc.error("%s already exists in %s/%s?" % (self.cde_code, self.to_form, self.to_section))
+            return False
+
+        target = doc.writable_section(self.to_form, self.to_section)
+        if target.get("allow_multiple"):
+            while len(target["cdes"]) < len(values):
+                target["cdes"].append([])
+        for item, cdes in zip(_section_items(target), values):
+            item.extend(cdes)
+        doc.mark_changed()
+        doc.info("added %s to %s/%s" % (self.cde_code, self.to_form, self.to_section))
+        return True
+
+
+class CopyCde(_CdeOperation):
+
+    def apply(self, doc):
+        self._copy_cde(doc)
+
+
+class MoveCde(_CdeOperation):
+
+    def apply(self, doc):
+        if self._copy_cde(doc):
+            _delete_cde(doc, self.from_form, self.from_section, self.cde_code)
+
+
+def _delete_cde(doc, form_name, section_code, cde_code):
+    section_dict = doc.writable_section(form_name, section_code)
+    for item in _section_items(section_dict):
+        item[:] = [cde for cde in item if cde["code"] != cde_code]
+    doc.mark_changed()
+    doc.info("deleted %s from %s/%s" % (cde_code, form_name, section_code))
+
+
+class RenameCde(Operation):
+
+    def __init__(self, form_name, section_code, old_code, new_code):
+        self.form_name = form_name
+        self.section_code = section_code
+        self.old_code = old_code
+        self.new_code = new_code
+        self.source_forms = (form_name,)
+
+    def apply(self, doc):
+        section_dict = doc.section(self.form_name, self.section_code)
+        if section_dict is None:
+            return
+        items = _section_items(section_dict)
+        if not any(cde["code"] == self.old_code for item in items for cde in item):
+            return
+        if any(cde["code"] == self.new_code for item in items for cde in item):
+            doc.error("%s already exists in %s/%s?" % (self.new_code, self.form_name, self.section_code))
+            return
+        for item in _section_items(doc.writable_section(self.form_name, self.section_code)):
+            for cde in item:
+                if cde["code"] == self.old_code:
+                    cde["code"] = self.new_code
+        doc.mark_changed()
+        doc.info("renamed %s to %s in %s/%s" % (self.old_code, self.new_code, self.form_name, self.section_code))
+
+
+class DeleteCde(Operation):
+
+    def __init__(self, form_name, section_code, cde_code):
+        self.form_name = form_name
+        self.section_code = section_code
+        self.cde_code = cde_code
+        self.source_forms = (form_name,)
+
+    def apply(self, doc):
+        section_dict = doc.section(self.form_name, self.section_code)
+        if section_dict is None:
+            return
+        if any(cde["code"] == self.cde_code for item in _section_items(section_dict) for cde in item):
+            _delete_cde(doc, self.form_name, self.section_code, self.cde_code)
+
+
+class SetCde(Operation):
+    creates_forms = True
+
+    def __init__(self, form_name, section_code, cde_code, value):
+        self.form_name = form_name
+        self.section_code = section_code
+        self.cde_code = cde_code
+        self.value = value
+
+    def apply(self, doc):
+        section_dict = doc.section(self.form_name, self.section_code)
+        if section_dict is None:
+            doc.add_section(self.form_name, {"code": self.section_code,
+                                             "allow_multiple": False,
+                                             "cdes": [{"code": self.cde_code, "value": self.value}]})
+            doc.info("set %s in %s/%s" % (self.cde_code, self.form_name, self.section_code))
+            return
+        if section_dict.get("allow_multiple"):
+            doc.error("cannot set %s in multiple section %s/%s" % (self.cde_code, self.form_name, self.section_code))
+            return
+        current = [cde for cde in section_dict.get("cdes", []) if cde["code"] == self.cde_code]
+        if current and current[0].get("value") == self.value:
+            return
+
+        section_dict = doc.writable_section(self.form_name, self.section_code)
+        if current:
+            for cde in section_dict["cdes"]:
+                if cde["code"] == self.cde_code:
+                    cde["value"] = self.value
+        else:
+            section_dict["cdes"].append({"code": self.cde_code, "value": self.value})
+        doc.mark_changed()
+        doc.info("set %s in %s/%s" % (self.cde_code, self.form_name, self.section_code))
+
+
+class Plan:
+    """
+    A compiled list of operations. Documents which contain none of the forms
+    the operations read from are skipped without being indexed.
+    """
+
+    def __init__(self, operations):
+        self.operations = tuple(operations)
+        if not self.operations:
+            raise TransformError("A plan needs at least one operation")
+        for op in self.operations:
+            if not isinstance(op, Operation):
+                raise TransformError("Not an operation: %r" % (op,))
+        self.source_forms = frozenset(form_name for op in self.operations for form_name in op.source_forms)
+        self.creates_forms = any(op.creates_forms for op in self.operations)
+
+    def applies_to(self, data):
+        if self.creates_forms:
+            return True
+        return bool(data) and any(form_dict.get("name") in self.source_forms for form_dict in data.get("forms", []))
+
+    def apply(self, data):
+        if not self.applies_to(data):
+            return TransformResult(data, False, [])
+        doc = _Document(data or {})
+        for op in self.operations:
+            op.apply(doc)
+        if not doc.changed:
+            return TransformResult(data, False, doc.messages)
+        return TransformResult(doc.data, True, doc.messages)
+
+    def __repr__(self):
+        return "Plan(%r)" % (self.operations,)
@@ -0,0 +1,22 @@
+from django.shortcuts import get_object_or_404
+
+from angelman.clinical_data.history import cde_history
+from rdrf.models.definition.models import RegistryForm
+from rdrf.views.form_view import FormFieldHistoryView
+
+
+class CompressedFormFieldHistoryView(FormFieldHistoryView):
+    """
+    RDRF's history of a cde, which reads the rows of the history collection,
+    with the versions of the compressed history added after them
+    """
+
+    def get_context_data(self, registry_code, form_id, patient_id, context_id, section_code, cde_code,
+                         formset_index=None, **kwargs):
+        context = super().get_context_data(registry_code, form_id, patient_id, context_id, section_code, cde_code,
+                                           formset_index)
+        form = get_object_or_404(RegistryForm, registry__code=registry_code, pk=form_id)
+        context["history"] = list(context.get("history") or []) + cde_history(
+            registry_code, int(patient_id), int(context_id), form.name, section_code, cde_code,
+            int(formset_index) if formset_index is not None else None)
+        return context
@@ -0,0 +1,125 @@
+"""
+Index of the cde values in the clinical data of each patient context.
+
+CdeValueIndex has one row per value: single sections give one row per cde,
+multiple sections one per item and cde, and multi valued cdes one per value.
+Values are stored as text, dates normalised to YYYY-MM-DD, and numeric cdes
+also as a number, so equality and range predicates are index lookups.
+"""
+import logging
+from datetime import datetime
+
+from django.db import transaction
+
+from angelman.dashboard.completion import is_filled
+from angelman.definition.form_index import DATE_FORMATS, get_form_index
+from angelman.models import CdeValueIndex
+from rdrf.models.definition.models import ClinicalData
+
+logger = logging.getLogger(__name__)
+
+NUMERIC_DATATYPES = ("integer", "float", "decimal")
+
+
+def normalise(value, datatype):
+    """
+    Returns (text, number) of a single value as they are stored in the index
+    """
+    if isinstance(value, bool):
+        return str(value), None
+    text = str(value).strip()
+    if datatype == "date":
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.strptime(text, date_format).date().isoformat(), None
+            except ValueError:
+                pass
+    number = None
+    if datatype in NUMERIC_DATATYPES or isinstance(value, (int, float)):
+        try:
+            number = float(text)
+        except ValueError:
+            pass
+    return text[:CdeValueIndex._meta.get_field("value").max_length], number
+
+
+def _values(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _document_rows(clinical_data, form_index):
+    for form in (clinical_data.data or {}).get("forms", []):
+        for section in form.get("sections", []):
+            items = section.get("cdes") or []
+            if not section.get("allow_multiple"):
+                items = [items]
+            for item_index, item in enumerate(items):
+                for cde in item:
+                    yield from _rows(clinical_data.django_id, clinical_data.context_id, clinical_data.registry_code,
+                                     form["name"], section["code"], cde["code"], item_index, cde.get("value"),
+                                     form_index)
+
+
+def _rows(patient_id, context_id, registry_code, form_name, section_code, cde_code, item, value, form_index):
+    spec = form_index.cdes.get(cde_code)
+    datatype = spec.datatype if spec else None
+    for single_value in _values(value):
+        if not is_filled(single_value):
+            continue
+        text, number = normalise(single_value, datatype)
+        yield CdeValueIndex(patient_id=patient_id, context_id=context_id, registry_code=registry_code,
+                            form_name=form_name, section_code=section_code, cde_code=cde_code, item=item,
+                            value=text, number=number)
+
+
+def update_from_clinical_data(clinical_data):
+    rows = list(_document_rows(clinical_data, get_form_index(clinical_data.registry_code)))
+    with transaction.atomic():
+        CdeValueIndex.objects.filter(patient_id=clinical_data.django_id, context_id=clinical_data.context_id,
+                                     registry_code=clinical_data.registry_code).delete()
+        CdeValueIndex.objects.bulk_create(rows, batch_size=1000)
+
+
+def remove_clinical_data(clinical_data):
+    CdeValueIndex.objects.filter(patient_id=clinical_data.django_id, context_id=clinical_data.context_id,
+                                 registry_code=clinical_data.registry_code).delete()
+
+
+def apply_changes(registry_code, patient_id, context_id, changes):
+    """
+    Updates the index from the (CdeWrite, old value) changes of a partial write
+    """
+    form_index = get_form_index(registry_code)
+    with transaction.atomic():
+        for write, __ in changes:
+            CdeValueIndex.objects.filter(patient_id=patient_id, context_id=context_id, registry_code=registry_code,
+                                         form_name=write.form, section_code=write.section, cde_code=write.cde,
+                                         item=0).delete()
+            CdeValueIndex.objects.bulk_create(_rows(patient_id, context_id, registry_code, write.form,
+                                                    write.section, write.cde, 0, write.value, form_index))
+
+
+def rebuild(registry_code, patient_ids=None):
+    """
+    Recreates the index of a registry from the clinical data, returns the number of patients indexed
+    """
+    documents = ClinicalData.objects.filter(registry_code=registry_code, collection="cdes", django_model="Patient")
+    existing = CdeValueIndex.objects.filter(registry_code=registry_code)
+    if patient_ids is not None:
+        documents = documents.filter(django_id__in=patient_ids)
+        existing = existing.filter(patient_id__in=patient_ids)
+
+    form_index = get_form_index(registry_code)
+    patients = set()
+    with transaction.atomic():
+        existing.delete()
+        rows = []
+        for clinical_data in documents.iterator(chunk_size=500):
+            rows.extend(_document_rows(clinical_data, form_index))
+            patients.add(clinical_data.django_id)
+            if len(rows) >= 5000:
+                CdeValueIndex.objects.bulk_create(rows)
+                rows = []
+        CdeValueIndex.objects.bulk_create(rows)
+    logger.info(f"Rebuilt the cde value index of {len(patients)} patients for {registry_code}")
+    return len(patients)
@@ -0,0 +1,200 @@
+"""
+Cohort selection over the cde value index.
+
+Predicates are EXISTS expressions on Patient, combined with & | ~ like Q
+objects:
+
+    cohort("ang", equals("ang", "ANGDNAMethylAbnormalResult", "X") & one_of("ang", "RegistrationDiagnosis", ["A", "B"]))
+
+or parsed from an expression
+
+    cde("ANGDNAMethylAbnormalResult") == "X" and cde("RegistrationDiagnosis") in ["A", "B"]
+    and 10 <= cde("6MoWeight", "CheckUp6Months") < 20 and not filled("ANGSeizures")
+
+For multi valued cdes and multiple sections a predicate holds when any of the
+values matches; all_of("code", [...]) needs every value. Each predicate is
+checked over all contexts of the patient, so predicates on different cdes may
+be met in different contexts.
+"""
+import ast
+
+from django.db.models import Exists, OuterRef, Q
+
+from angelman.cohort.index import NUMERIC_DATATYPES, normalise
+from angelman.definition.form_index import get_form_index
+from angelman.models import CdeValueIndex
+from registry.patients.models import Patient
+
+
+class CohortQueryError(Exception):
+    pass
+
+
+def _datatype(registry_code, cde_code):
+    spec = get_form_index(registry_code).cdes.get(cde_code)
+    return spec.datatype if spec else None
+
+
+def cde_matches(registry_code, cde_code, form_name=None, patient_ref=None, **lookups):
+    """
+    EXISTS expression true for the patients (by default the outer queryset's) with a value of the cde matching lookups
+    """
+    values = CdeValueIndex.objects.filter(
+        patient=patient_ref if patient_ref is not None else OuterRef("pk"),
+        registry_code=registry_code,
+        cde_code=cde_code,
+        **lookups,
+    )
+    if form_name:
+        values = values.filter(form_name=form_name)
+    return Exists(values)
+
+
+def _lookup(registry_code, cde_code, value):
+    datatype = _datatype(registry_code, cde_code)
+    text, number = normalise(value, datatype)
+    # the values of non numeric cdes are indexed as text only, so a number literal compares as text
+    if number is None or (datatype is not None and datatype not in NUMERIC_DATATYPES):
+        return {"value": text}
+    return {"number": number}
+
+
+def equals(registry_code, cde_code, value, form_name=None):
+    return Q(cde_matches(registry_code, cde_code, form_name, **_lookup(registry_code, cde_code, value)))
+
+
+def one_of(registry_code, cde_code, values, form_name=None):
+    q = Q(pk__in=[])
+    for value in values:
+        q |= equals(registry_code, cde_code, value, form_name)
+    return q
+
+
+def all_of(registry_code, cde_code, values, form_name=None):
+    q = Q()
+    for value in values:
+        q &= equals(registry_code, cde_code, value, form_name)
+    return q
+
+
+def between(registry_code, cde_code, low=None, high=None, form_name=None, include_low=True, include_high=True):
+    """
+    Range of numbers, or of text (e.g. YYYY-MM-DD dates) when the bounds are not numeric
+    """
+    lookups = {}
+    for bound, inclusive, operator in ((low, include_low, "gt"), (high, include_high, "lt")):
+        if bound is None:
+            continue
+        field, bound_value = next(iter(_lookup(registry_code, cde_code, bound).items()))
+        lookups[f"{field}__{operator}{'e' if inclusive else ''}"] = bound_value
+    return Q(cde_matches(registry_code, cde_code, form_name, **lookups))
+
+
+def filled(registry_code, cde_code, form_name=None):
+    return Q(cde_matches(registry_code, cde_code, form_name))
+
+
+def cohort(registry_code, q):
+    """
+    Ids of the patients of the registry matching q
+    """
+    return Patient.objects.filter(rdrf_registry__code=registry_code).filter(q).values_list("pk", flat=True)
+
+
+def _constant(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise CohortQueryError(f"Expected a constant: {ast.dump(node)}")
+
+
+def _cde_reference(node):
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "cde"
+            and 1 <= len(node.args) <= 2 and not node.keywords):
+        return None
+    return tuple(_constant(arg) for arg in node.args) + (None,) * (2 - len(node.args))
+
+
+_RANGE_OPERATORS = {
+    ast.Lt: ("high", False),
+    ast.LtE: ("high", True),
+    ast.Gt: ("low", False),
+    ast.GtE: ("low", True),
+}
+_MIRRORED = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+
+
+def _comparison(registry_code, left, op, right):
+    reference = _cde_reference(left)
+    if reference is None:
+        reference = _cde_reference(right)
+        if reference is None:
+            raise CohortQueryError("A comparison needs a cde(...) on one side")
+        left, right = right, left
+        op = _MIRRORED.get(type(op), type(op))()
+    cde_code, form_name = reference
+    value = _constant(right)
+
+    if isinstance(op, ast.Eq):
+        return equals(registry_code, cde_code, value, form_name)
+    if isinstance(op, ast.NotEq):
+        return ~equals(registry_code, cde_code, value, form_name)
+    if isinstance(op, (ast.In, ast.NotIn)):
+        if not isinstance(value, (list, tuple, set)):
+            raise CohortQueryError("in needs a list of values")
+        q = one_of(registry_code, cde_code, value, form_name)
+        return q if isinstance(op, ast.In) else ~q
+    if type(op) in _RANGE_OPERATORS:
+        side, inclusive = _RANGE_OPERATORS[type(op)]
+        return between(registry_code, cde_code, form_name=form_name,
+                       **{side: value, f"include_{side}": inclusive})
+    raise CohortQueryError(f"Unsupported comparison {ast.dump(op)}")
+
+
+def _translate(registry_code, node):
+    if isinstance(node, ast.Expression):
+        return _translate(registry_code, node.body)
+
+    if isinstance(node, ast.BoolOp):
+        parts = [_translate(registry_code, value) for value in node.values]
+        combined = parts[0]
+        for part in parts[1:]:
+            combined = combined & part if isinstance(node.op, ast.And) else combined | part
+        return combined
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return ~_translate(registry_code, node.operand)
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        args = [_constant(arg) for arg in node.args]
+        if node.func.id == "filled" and 1 <= len(args) <= 2:
+            return filled(registry_code, *args)
+        if node.func.id == "all_of" and 2 <= len(args) <= 3:
+            return all_of(registry_code, *args)
+
+    if isinstance(node, ast.Compare):
+        reference = _cde_reference(node.comparators[0]) if len(node.ops) == 2 else None
+        if reference is not None and all(type(op) in (ast.Lt, ast.LtE) for op in node.ops):
+            # low <= cde(...) < high, matched by a single value
+            return between(registry_code, reference[0], _constant(node.left), _constant(node.comparators[1]),
+                           form_name=reference[1], include_low=isinstance(node.ops[0], ast.LtE),
+                           include_high=isinstance(node.ops[1], ast.LtE))
+        # other chains: a < b < c is a < b and b < c
+        operands = [node.left] + node.comparators
+        q = Q()
+        for left, op, right in zip(operands, node.ops, operands[1:]):
+            q &= _comparison(registry_code, left, op, right)
+        return q
+
+    raise CohortQueryError(f"Unsupported expression {ast.dump(node)}")
+
+
+def parse(registry_code, expression):
+    """
+    Returns the Q object of a cohort expression
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as ex:
+        raise CohortQueryError(f"Invalid expression: {ex}")
+    return _translate(registry_code, tree)
@@ -0,0 +1,30 @@
+from django.db.models.signals import post_delete, post_save
+
+from angelman.clinical_data.partial import cde_values_written
+from angelman.cohort import index
+from rdrf.models.definition.models import ClinicalData
+
+
+def _is_patient_document(clinical_data):
+    return clinical_data.collection == "cdes" and clinical_data.django_model == "Patient"
+
+
+def clinical_data_saved(sender, instance, raw=False, **kwargs):
+    if not raw and _is_patient_document(instance):
+        index.update_from_clinical_data(instance)
+
+
+def clinical_data_deleted(sender, instance, **kwargs):
+    if _is_patient_document(instance):
+        index.remove_clinical_data(instance)
+
+
+def clinical_data_partially_written(sender, registry_code, patient_id, context_id, changes, **kwargs):
+    index.apply_changes(registry_code, patient_id, context_id, changes)
+
+
+def connect_signals():
+    post_save.connect(clinical_data_saved, sender=ClinicalData, dispatch_uid="angelman_cohort_clinical_data_saved")
+    post_delete.connect(clinical_data_deleted, sender=ClinicalData,
+                        dispatch_uid="angelman_cohort_clinical_data_deleted")
+    cde_values_written.connect(clinical_data_partially_written, dispatch_uid="angelman_cohort_partial_write")
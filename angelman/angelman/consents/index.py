@@ -0,0 +1,96 @@
+"""
+Index of the consent questions each patient answered yes to.
+
+PatientConsentAnswer mirrors the ConsentValue rows with answer=True, keyed by
+codes instead of consent question ids, so the consent_rules of a registry and
+consent based followup conditions are applied to a patient queryset as
+EXISTS filters instead of checking every patient in Python (see
+angelman.patients.views for the patient listing).
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from angelman.definition.cache import definition_cache
+from angelman.models import PatientConsentAnswer
+from rdrf.models.definition.models import ConsentRule
+from registry.patients.models import ConsentValue
+
+logger = logging.getLogger(__name__)
+
+
+def _question_codes(consent_question):
+    section = consent_question.section
+    return dict(registry_code=section.registry.code, section_code=section.code, question_code=consent_question.code)
+
+
+def sync_consent_value(consent_value, deleted=False):
+    codes = _question_codes(consent_value.consent_question)
+    if consent_value.answer and not deleted:
+        PatientConsentAnswer.objects.get_or_create(patient_id=consent_value.patient_id, **codes)
+    else:
+        PatientConsentAnswer.objects.filter(patient_id=consent_value.patient_id, **codes).delete()
+
+
+def rebuild(registry_code, patient_ids=None):
+    """
+    Recreates the index of a registry from ConsentValue, returns the number of patients indexed
+    """
+    values = ConsentValue.objects.filter(answer=True, consent_question__section__registry__code=registry_code)
+    existing = PatientConsentAnswer.objects.filter(registry_code=registry_code)
+    if patient_ids is not None:
+        values = values.filter(patient_id__in=patient_ids)
+        existing = existing.filter(patient_id__in=patient_ids)
+
+    answers = [
+        PatientConsentAnswer(patient_id=patient_id, registry_code=registry_code,
+                             section_code=section_code, question_code=question_code)
+        for patient_id, section_code, question_code in values.values_list(
+            "patient_id", "consent_question__section__code", "consent_question__code").distinct()
+    ]
+    with transaction.atomic():
+        existing.delete()
+        PatientConsentAnswer.objects.bulk_create(answers, batch_size=5000)
+    count = len({answer.patient_id for answer in answers})
+    logger.info(f"Rebuilt the consent index of {count} patients for {registry_code}")
+    return count
+
+
+def consented(registry_code, section_code, question_code, patient_ref=None):
+    """
+    EXISTS expression true for the patients (by default the outer queryset's) who answered yes to the question
+    """
+    return Exists(PatientConsentAnswer.objects.filter(
+        patient=patient_ref if patient_ref is not None else OuterRef("pk"),
+        registry_code=registry_code,
+        section_code=section_code,
+        question_code=question_code,
+    ))
+
+
+def _consent_rules(registry, group_ids, capability):
+    def load():
+        return list(ConsentRule.objects.filter(
+            registry=registry,
+            user_group__in=group_ids,
+            capability=capability,
+            enabled=True,
+        ).values_list("consent_question__section__code", "consent_question__code").distinct())
+
+    key = f"consents:rules:{registry.code}:{capability}:{','.join(map(str, sorted(group_ids)))}"
+    return definition_cache.get(key, load)
+
+
+def filter_by_consent_rules(patients, user, registry, capability="see_patient"):
+    """
+    Restricts a Patient queryset to the patients the user may see under the
+    consent rules of the registry: every rule of the user's groups for the
+    capability needs its consent question answered yes
+    """
+    if user.is_superuser:
+        return patients
+    group_ids = list(user.groups.values_list("pk", flat=True))
+    for section_code, question_code in _consent_rules(registry, group_ids, capability):
+        patients = patients.filter(consented(registry.code, section_code, question_code))
+    return patients
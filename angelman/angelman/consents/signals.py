@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+
+from angelman.consents.index import sync_consent_value
+from registry.patients.models import ConsentValue
+
+
+def consent_value_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_consent_value(instance)
+
+
+def consent_value_deleted(sender, instance, **kwargs):
+    sync_consent_value(instance, deleted=True)
+
+
+def connect_signals():
+    post_save.connect(consent_value_saved, sender=ConsentValue, dispatch_uid="angelman_consent_index_saved")
+    post_delete.connect(consent_value_deleted, sender=ConsentValue, dispatch_uid="angelman_consent_index_deleted")
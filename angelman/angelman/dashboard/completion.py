@@ -0,0 +1,168 @@
+"""
+Completion of forms, per patient and context.
+
+A form's completion is the share of its complete_form_cdes that have a value.
+It is computed when a ClinicalData document is saved and stored in
+FormCompletionStatus, and recomputed for a form when its completion cdes
+change, so progress views read it instead of walking every context document.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from angelman.definition.form_index import get_form_index
+from angelman.models import FormCompletionStatus
+from rdrf.models.definition.models import ClinicalData
+
+logger = logging.getLogger(__name__)
+
+
+def is_filled(value):
+    return value not in (None, "", [])
+
+
+def completion_cdes(registry_code):
+    """
+    form name -> set of the codes of its completion cdes
+    """
+    return {name: form.complete_form_cdes for name, form in get_form_index(registry_code).forms.items()}
+
+
+def form_cdes(form):
+    """
+    (section code, cde) of every cde of a form of a ClinicalData document
+    """
+    for section in form.get("sections", []):
+        if section.get("allow_multiple"):
+            for item in section.get("cdes") or []:
+                for cde in item:
+                    yield section["code"], cde
+        else:
+            for cde in section.get("cdes") or []:
+                yield section["code"], cde
+
+
+def filled_count(form, required):
+    filled = {cde["code"] for __, cde in form_cdes(form) if is_filled(cde.get("value"))}
+    return len(filled & required)
+
+
+def _statuses(clinical_data, form_names=None):
+    required_cdes = completion_cdes(clinical_data.registry_code)
+    for form in (clinical_data.data or {}).get("forms", []):
+        required = required_cdes.get(form["name"])
+        if not required or (form_names is not None and form["name"] not in form_names):
+            continue
+        yield FormCompletionStatus(
+            patient_id=clinical_data.django_id,
+            context_id=clinical_data.context_id,
+            registry_code=clinical_data.registry_code,
+            form_name=form["name"],
+            filled=filled_count(form, required),
+            required=len(required),
+        )
+
+
+def update_from_clinical_data(clinical_data):
+    if clinical_data.context_id is None:
+        return
+    statuses = list(_statuses(clinical_data))
+    with transaction.atomic():
+        FormCompletionStatus.objects.filter(
+            patient_id=clinical_data.django_id,
+            context_id=clinical_data.context_id,
+            form_name__in=[status.form_name for status in statuses],
+        ).delete()
+        FormCompletionStatus.objects.bulk_create(statuses)
+
+
+def apply_changes(registry_code, patient_id, context_id, changes):
+    """
+    Updates the completion of a context from the (CdeWrite, old value) changes
+    of a partial write; forms without a status yet are computed from the document
+    """
+    required_cdes = completion_cdes(registry_code)
+    deltas = {}
+    for write, old_value in changes:
+        if write.cde in required_cdes.get(write.form, ()):
+            deltas[write.form] = deltas.get(write.form, 0) + is_filled(write.value) - is_filled(old_value)
+
+    missing = set()
+    for form_name, delta in deltas.items():
+        statuses = FormCompletionStatus.objects.filter(patient_id=patient_id, context_id=context_id,
+                                                       form_name=form_name)
+        updated = statuses.update(filled=F("filled") + delta, updated_at=timezone.now())
+        if not updated:
+            missing.add(form_name)
+    if missing:
+        clinical_data = ClinicalData.objects.filter(
+            registry_code=registry_code, collection="cdes", django_model="Patient", django_id=patient_id,
+            context_id=context_id,
+        ).first()
+        if clinical_data is not None:
+            FormCompletionStatus.objects.bulk_create(_statuses(clinical_data, missing), ignore_conflicts=True)
+    return set(deltas)
+
+
+def recompute_form(registry_code, form_name):
+    """
+    Recomputes the completion of one form for every patient, e.g. after its completion cdes changed,
+    returns the ids of the patients with the form
+    """
+    documents = ClinicalData.objects.filter(
+        registry_code=registry_code, collection="cdes", django_model="Patient", context_id__isnull=False,
+        data__forms__contains=[{"name": form_name}],
+    )
+    with transaction.atomic():
+        FormCompletionStatus.objects.filter(registry_code=registry_code, form_name=form_name).delete()
+        statuses = []
+        patient_ids = set()
+        for clinical_data in documents.iterator(chunk_size=500):
+            patient_ids.add(clinical_data.django_id)
+            statuses.extend(_statuses(clinical_data, form_names={form_name}))
+            if len(statuses) >= 500:
+                FormCompletionStatus.objects.bulk_create(statuses)
+                statuses = []
+        FormCompletionStatus.objects.bulk_create(statuses)
+    logger.info(f"Recomputed the completion of {registry_code}/{form_name}")
+    return patient_ids
+
+
+def rebuild(registry_code, patient_ids=None):
+    """
+    Recomputes the completion of every form, returns the number of patients processed
+    """
+    documents = ClinicalData.objects.filter(
+        registry_code=registry_code, collection="cdes", django_model="Patient", context_id__isnull=False,
+    )
+    existing = FormCompletionStatus.objects.filter(registry_code=registry_code)
+    if patient_ids is not None:
+        documents = documents.filter(django_id__in=patient_ids)
+        existing = existing.filter(patient_id__in=patient_ids)
+
+    patients = set()
+    with transaction.atomic():
+        existing.delete()
+        statuses = []
+        for clinical_data in documents.iterator(chunk_size=500):
+            statuses.extend(_statuses(clinical_data))
+            patients.add(clinical_data.django_id)
+            if len(statuses) >= 500:
+                FormCompletionStatus.objects.bulk_create(statuses)
+                statuses = []
+        FormCompletionStatus.objects.bulk_create(statuses)
+    logger.info(f"Rebuilt the form completion of {len(patients)} patients for {registry_code}")
+    return len(patients)
+
+
+def module_progress(patient_id, registry_code):
+    """
+    form name -> completion percentage of the most recently saved context of the form
+    """
+    progress = {}
+    statuses = FormCompletionStatus.objects.filter(patient_id=patient_id, registry_code=registry_code)
+    for status in statuses.order_by("updated_at"):
+        progress[status.form_name] = status.percentage
+    return progress
@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from angelman.clinical_data.partial import cde_values_written
+from angelman.dashboard import completion, summary
+from angelman.dashboard.summary import update_consents, update_from_clinical_data
+from angelman.definition.cache import definition_cache
+from rdrf.models.definition.models import ClinicalData, RegistryForm
+from registry.patients.models import ConsentValue
+
+
+def clinical_data_saved(sender, instance, raw=False, **kwargs):
+    if raw or instance.collection != "cdes" or instance.django_model != "Patient":
+        return
+    completion.update_from_clinical_data(instance)
+    update_from_clinical_data(instance)
+
+
+def clinical_data_partially_written(sender, registry_code, patient_id, context_id, changes, **kwargs):
+    forms = completion.apply_changes(registry_code, patient_id, context_id, changes)
+    summary.apply_changes(registry_code, patient_id, context_id, changes, forms)
+
+
+def consent_value_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    update_consents(instance.patient_id, instance.consent_question.section.registry.code)
+
+
+def completion_cdes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        # instance is a cde, pk_set the forms (empty on clear, when the forms are not known any more)
+        forms = RegistryForm.objects.filter(pk__in=pk_set or []).select_related("registry")
+    else:
+        forms = [instance]
+    definition_cache.invalidate_on_commit()
+    for form in forms:
+        transaction.on_commit(
+            lambda registry_code=form.registry.code, form_name=form.name: summary.recompute_form(
+                registry_code, form_name))
+
+
+def connect_signals():
+    post_save.connect(clinical_data_saved, sender=ClinicalData, dispatch_uid="angelman_dashboard_clinical_data")
+    cde_values_written.connect(clinical_data_partially_written, dispatch_uid="angelman_dashboard_partial_write")
+    post_save.connect(consent_value_changed, sender=ConsentValue, dispatch_uid="angelman_dashboard_consent_saved")
+    post_delete.connect(consent_value_changed, sender=ConsentValue, dispatch_uid="angelman_dashboard_consent_deleted")
+    m2m_changed.connect(completion_cdes_changed, sender=RegistryForm.complete_form_cdes.through,
+                        dispatch_uid="angelman_dashboard_completion_cdes")
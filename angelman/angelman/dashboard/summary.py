@@ -0,0 +1,170 @@
+"""
+Per patient summary of the registry dashboard widgets.
+
+The dashboard of angelman.yaml shows module progress, consents and the latest
+values of a few cdes. Instead of walking every context document of the
+patient when the dashboard is opened, these are kept in
+PatientDashboardSummary and updated from the document or consent value being
+saved. The cdes tracked are the ones of the cde widgets of the registry
+dashboard (registry_dashboards in the definition); angelman.dashboard.views
+serves the widgets from the summary.
+"""
+import logging
+from collections import namedtuple
+
+from django.db import transaction
+
+from angelman.dashboard import completion
+from angelman.dashboard.completion import completion_cdes, filled_count, form_cdes, is_filled
+from angelman.definition.cache import definition_cache
+from angelman.models import FormCompletionStatus, PatientDashboardSummary
+from rdrf.models.definition.models import ClinicalData, ConsentQuestion, RegistryDashboardCDEData
+from registry.patients.models import ConsentValue, Patient
+
+logger = logging.getLogger(__name__)
+
+DashboardCde = namedtuple("DashboardCde", ["form", "section", "cde", "label"])
+
+
+def dashboard_cdes(registry_code):
+    """
+    The DashboardCdes of the cde widgets of the registry dashboard, in display order
+    """
+    def load():
+        return tuple(DashboardCde(*values) for values in RegistryDashboardCDEData.objects.filter(
+            widget__registry_dashboard__registry__code=registry_code,
+        ).order_by("sort_order", "pk").values_list("registry_form__name", "section__code", "cde__code", "label"))
+
+    return definition_cache.get(f"dashboard:cdes:{registry_code}", load)
+
+
+def tracked_cdes(registry_code):
+    """
+    set of the (form, section, cde) of the dashboard cde widgets
+    """
+    return {(cde.form, cde.section, cde.cde) for cde in dashboard_cdes(registry_code)}
+
+
+def consent_questions(registry_code):
+    """
+    consent section code -> set of the codes of its questions
+    """
+    def load():
+        questions = {}
+        for section_code, question_code in ConsentQuestion.objects.filter(
+                section__registry__code=registry_code).values_list("section__code", "code"):
+            questions.setdefault(section_code, set()).add(question_code)
+        return {section_code: frozenset(codes) for section_code, codes in questions.items()}
+
+    return definition_cache.get(f"dashboard:consent_questions:{registry_code}", load)
+
+
+def apply_document(summary, clinical_data):
+    data = clinical_data.data or {}
+    required_cdes = completion_cdes(summary.registry_code)
+    tracked = tracked_cdes(summary.registry_code)
+
+    for form in data.get("forms", []):
+        form_name = form["name"]
+        required = required_cdes.get(form_name)
+        for section_code, cde in form_cdes(form):
+            if (form_name, section_code, cde["code"]) not in tracked:
+                continue
+            if is_filled(cde.get("value")):
+                summary.cde_values[cde["code"]] = {"value": cde["value"], "context_id": clinical_data.context_id}
+            elif summary.cde_values.get(cde["code"], {}).get("context_id") == clinical_data.context_id:
+                # cleared in the context the shown value came from
+                del summary.cde_values[cde["code"]]
+        if required:
+            summary.module_progress[form_name] = round(100 * filled_count(form, required) / len(required))
+        else:
+            # the form has no completion cdes (any more)
+            summary.module_progress.pop(form_name, None)
+
+
+def consent_status(registry_code, patient_id):
+    answered = set(ConsentValue.objects.filter(
+        patient_id=patient_id,
+        answer=True,
+        consent_question__section__registry__code=registry_code,
+    ).values_list("consent_question__section__code", "consent_question__code"))
+    return {
+        section_code: all((section_code, question_code) in answered for question_code in question_codes)
+        for section_code, question_codes in consent_questions(registry_code).items()
+    }
+
+
+def _locked_summary(patient_id, registry_code):
+    summary, created = (PatientDashboardSummary.objects
+                        .select_for_update()
+                        .get_or_create(patient_id=patient_id, defaults={"registry_code": registry_code}))
+    return summary
+
+
+def update_from_clinical_data(clinical_data):
+    with transaction.atomic():
+        summary = _locked_summary(clinical_data.django_id, clinical_data.registry_code)
+        apply_document(summary, clinical_data)
+        summary.save()
+
+
+def apply_changes(registry_code, patient_id, context_id, changes, forms):
+    """
+    Updates the summary from the (CdeWrite, old value) changes of a partial write, and the progress of forms
+    """
+    tracked = tracked_cdes(registry_code)
+    changes = [(write, old_value) for write, old_value in changes if (write.form, write.section, write.cde) in tracked]
+    if not changes and not forms:
+        return
+    with transaction.atomic():
+        summary = _locked_summary(patient_id, registry_code)
+        for write, __ in changes:
+            if is_filled(write.value):
+                summary.cde_values[write.cde] = {"value": write.value, "context_id": context_id}
+            elif summary.cde_values.get(write.cde, {}).get("context_id") == context_id:
+                del summary.cde_values[write.cde]
+        for status in FormCompletionStatus.objects.filter(patient_id=patient_id, context_id=context_id,
+                                                          form_name__in=forms):
+            summary.module_progress[status.form_name] = status.percentage
+        summary.save()
+
+
+def update_consents(patient_id, registry_code):
+    with transaction.atomic():
+        summary = _locked_summary(patient_id, registry_code)
+        summary.consents = consent_status(registry_code, patient_id)
+        summary.save(update_fields=["consents", "updated_at"])
+
+
+def recompute_form(registry_code, form_name):
+    """
+    Recomputes the completion of a form and the summaries of the patients with it
+    """
+    patient_ids = completion.recompute_form(registry_code, form_name)
+    if patient_ids:
+        rebuild(registry_code, patient_ids)
+
+
+def rebuild(registry_code, patient_ids=None):
+    """
+    Recomputes the summaries of the patients of a registry from scratch, returns how many were written
+    """
+    patients = Patient.objects.filter(rdrf_registry__code=registry_code).order_by("pk")
+    if patient_ids is not None:
+        patients = patients.filter(pk__in=patient_ids)
+
+    count = 0
+    for patient_id in list(patients.values_list("pk", flat=True)):
+        summary = PatientDashboardSummary(patient_id=patient_id, registry_code=registry_code)
+        documents = ClinicalData.objects.filter(
+            registry_code=registry_code, collection="cdes", django_model="Patient", django_id=patient_id,
+        ).order_by("context_id")
+        for clinical_data in documents.iterator():
+            apply_document(summary, clinical_data)
+        summary.consents = consent_status(registry_code, patient_id)
+        with transaction.atomic():
+            PatientDashboardSummary.objects.filter(patient_id=patient_id).delete()
+            summary.save(force_insert=True)
+        count += 1
+    logger.info(f"Rebuilt {count} dashboard summaries for {registry_code}")
+    return count
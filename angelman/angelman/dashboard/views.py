@@ -0,0 +1,46 @@
+from django.shortcuts import get_object_or_404
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from angelman.dashboard import summary
+from angelman.models import PatientDashboardSummary
+from angelman.patients.views import visible_patients
+from rdrf.models.definition.models import Registry
+
+
+class PatientDashboardView(APIView):
+    """
+    The data of the dashboard widgets of a patient (module progress, consents
+    and the latest cde values), read from PatientDashboardSummary, for the
+    users who may see the patient
+    """
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, registry_code, patient_id):
+        registry = get_object_or_404(Registry, code=registry_code)
+        patient = visible_patients(request.user, registry).filter(pk=patient_id).first()
+        if patient is None:
+            raise PermissionDenied()
+
+        patient_summary = PatientDashboardSummary.objects.filter(patient=patient).first()
+        if patient_summary is None:
+            # nothing saved for the patient yet (existing patients are backfilled by the migration)
+            patient_summary = PatientDashboardSummary(patient=patient, registry_code=registry_code,
+                                                      consents=summary.consent_status(registry_code, patient.pk))
+
+        cdes = []
+        for cde in summary.dashboard_cdes(registry_code):
+            value = patient_summary.cde_values.get(cde.cde, {})
+            cdes.append({"label": cde.label, "form": cde.form, "section": cde.section, "cde": cde.cde,
+                         "value": value.get("value"), "context_id": value.get("context_id")})
+        return Response({
+            "patient_id": patient.pk,
+            "module_progress": patient_summary.module_progress,
+            "consents": patient_summary.consents,
+            "cdes": cdes,
+            "updated_at": patient_summary.updated_at,
+        })
@@ -0,0 +1,121 @@
+"""
+Cache for lookups of static registry definition data (cdes, permissible
+values, context form groups, address types ...).
+
+Values are kept per process. When settings.DEFINITION_CACHE_ALIAS names a
+django cache, values are also shared through it: a generation counter in the
+shared cache is bumped on every invalidation, so all processes drop their
+local copies. Invalidation happens when the writing transaction commits,
+triggered by the signal receivers in angelman.definition.signals and by bulk
+definition writes.
+
+Without a shared cache an invalidation only reaches the process it happens
+in, so local values (and the generation) also expire after
+settings.DEFINITION_CACHE_TIMEOUT seconds. Deployments with more than one
+worker process should set DEFINITION_CACHE_ALIAS (see angelman.checks).
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "angelman:definition:generation"
+
+_MISSING = object()
+
+
+class DefinitionCache:
+
+    def __init__(self):
+        self._values = {}
+        self._generation = 0
+        self._expires_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _shared_cache(self):
+        alias = getattr(settings, "DEFINITION_CACHE_ALIAS", None)
+        return caches[alias] if alias else None
+
+    def _sync_generation(self, shared):
+        generation = shared.get(GENERATION_KEY)
+        if generation is None:
+            shared.add(GENERATION_KEY, 0, timeout=None)
+            generation = shared.get(GENERATION_KEY, 0)
+        if generation != self._generation:
+            with self._lock:
+                self._values = {}
+                self._generation = generation
+        return generation
+
+    def _expire_local(self):
+        timeout = getattr(settings, "DEFINITION_CACHE_TIMEOUT", 0)
+        if not timeout:
+            return self._generation
+        now = time.monotonic()
+        if self._expires_at is None or now >= self._expires_at:
+            with self._lock:
+                if self._expires_at is not None and now >= self._expires_at:
+                    self._values = {}
+                    self._generation += 1
+                self._expires_at = now + timeout
+        return self._generation
+
+    @property
+    def generation(self):
+        shared = self._shared_cache()
+        return self._sync_generation(shared) if shared is not None else self._expire_local()
+
+    def get(self, key, loader):
+        shared = self._shared_cache()
+        if shared is not None:
+            self._sync_generation(shared)
+        else:
+            self._expire_local()
+
+        value = self._values.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        shared_key = f"angelman:definition:{self._generation}:{key}"
+        if shared is not None:
+            value = shared.get(shared_key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            if shared is not None:
+                shared.set(shared_key, value, timeout=None)
+        with self._lock:
+            self._values[key] = value
+        return value
+
+    def invalidate(self):
+        shared = self._shared_cache()
+        with self._lock:
+            self._values = {}
+            if shared is None:
+                self._generation += 1
+        if shared is not None:
+            try:
+                shared.incr(GENERATION_KEY)
+            except ValueError:
+                shared.set(GENERATION_KEY, 1, timeout=None)
+            self._sync_generation(shared)
+        logger.debug("Definition cache invalidated")
+
+    def invalidate_on_commit(self):
+        """
+        Invalidates when the current transaction commits: before that other transactions would cache the old rows
+        again, and after a rollback there is nothing to invalidate
+        """
+        transaction.on_commit(self.invalidate)
+
+
+definition_cache = DefinitionCache()
@@ -0,0 +1,198 @@
+"""
+Compiled, in memory index of the forms of a registry.
+
+The index resolves form -> sections -> cde specs (datatype, widget, options
+of the permissible value group, validation limits) with three queries and
+keeps the result in immutable structures shared by all requests of the
+worker. It is rebuilt when the registry definition changes: the definition
+signals move the definition cache on to a new generation, and indexes built
+for an older generation are dropped. Datatype validation of cde values is
+done against the index, without definition queries.
+"""
+import logging
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
+from angelman.definition.cache import definition_cache
+from rdrf.models.definition.models import (
+    CommonDataElement, ContextFormGroupItem, Registry, RegistryForm, Section,
+)
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y")
+
+FormSpec = namedtuple("FormSpec", ["name", "display_name", "sections", "complete_form_cdes"])
+SectionSpec = namedtuple("SectionSpec", ["code", "display_name", "allow_multiple", "cdes"])
+
+
+class CdeSpec(namedtuple("CdeSpec", [
+        "code", "name", "datatype", "widget_name", "allow_multiple", "options", "option_codes",
+        "min_value", "max_value", "max_length", "pattern"])):
+    __slots__ = ()
+
+    def _validate_one(self, value):
+        if self.option_codes:
+            return [] if value in self.option_codes else [f"{value!r} is not a permitted value of {self.code}"]
+        if self.datatype == "integer":
+            try:
+                number = int(value)
+            except (TypeError, ValueError):
+                return [f"{self.code} must be a whole number"]
+            return self._check_range(number)
+        if self.datatype in ("float", "decimal"):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return [f"{self.code} must be a number"]
+            return self._check_range(number)
+        if self.datatype == "date":
+            for date_format in DATE_FORMATS:
+                try:
+                    datetime.strptime(str(value), date_format)
+                    return []
+                except ValueError:
+                    pass
+            return [f"{self.code} must be a date (YYYY-MM-DD)"]
+        if self.datatype == "boolean":
+            return [] if isinstance(value, bool) or value in ("True", "False", "true", "false") else [
+                f"{self.code} must be true or false"]
+        if self.datatype in ("string", "text", "textarea", "email"):
+            value = str(value)
+            if self.max_length and len(value) > self.max_length:
+                return [f"{self.code} is longer than {self.max_length} characters"]
+            if self.pattern and not re.fullmatch(self.pattern, value):
+                return [f"{self.code} does not match {self.pattern}"]
+        return []
+
+    def _check_range(self, number):
+        if self.min_value is not None and number < self.min_value:
+            return [f"{self.code} must be at least {self.min_value}"]
+        if self.max_value is not None and number > self.max_value:
+            return [f"{self.code} must be at most {self.max_value}"]
+        return []
+
+    def validate(self, value):
+        """
+        Returns the validation errors of a value, None and "" are always valid
+        """
+        if value in (None, ""):
+            return []
+        if self.allow_multiple and self.option_codes:
+            if not isinstance(value, list):
+                return [f"{self.code} takes a list of values"]
+            return [error for item in value for error in self._validate_one(item)]
+        return self._validate_one(value)
+
+
+def _codes(text):
+    return tuple(code.strip() for code in (text or "").split(",") if code.strip())
+
+
+def _number(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+class FormIndex:
+
+    def __init__(self, registry_code, version, forms, sections, cdes, fixed_context_form_groups):
+        self.registry_code = registry_code
+        self.version = version
+        self.forms = MappingProxyType(forms)
+        self.sections = MappingProxyType(sections)
+        self.cdes = MappingProxyType(cdes)
+        self.fixed_context_form_groups = MappingProxyType(fixed_context_form_groups)
+
+    def form(self, form_name):
+        return self.forms.get(form_name)
+
+    def section(self, form_name, section_code):
+        form = self.forms.get(form_name)
+        if form is None or section_code not in form.sections:
+            return None
+        return self.sections.get(section_code)
+
+    def validate(self, form_name, section_code, cde_code, value):
+        """
+        Returns the errors of setting a value of a single section cde
+        """
+        if form_name not in self.forms:
+            return [f"unknown form {form_name}"]
+        section = self.section(form_name, section_code)
+        if section is None:
+            return [f"section {section_code} is not in form {form_name}"]
+        if section.allow_multiple:
+            return [f"section {section_code} is a multiple section"]
+        if cde_code not in section.cdes:
+            return [f"cde {cde_code} is not in section {section_code}"]
+        return self.cdes[cde_code].validate(value)
+
+
+def build_form_index(registry_code):
+    registry = Registry.objects.get(code=registry_code)
+    form_rows = list(RegistryForm.objects.filter(registry=registry).prefetch_related("complete_form_cdes"))
+    section_codes = {code for form in form_rows for code in _codes(form.sections)}
+
+    sections = {}
+    for section in Section.objects.filter(code__in=section_codes):
+        sections[section.code] = SectionSpec(section.code, section.display_name, bool(section.allow_multiple),
+                                             _codes(section.elements))
+
+    cde_codes = {code for section in sections.values() for code in section.cdes}
+    cdes = {}
+    for cde in CommonDataElement.objects.filter(code__in=cde_codes).select_related("pv_group"):
+        options = tuple((option["code"], option["text"]) for option in cde.pv_group.options) if cde.pv_group else ()
+        cdes[cde.code] = CdeSpec(
+            code=cde.code,
+            name=cde.name,
+            datatype=(cde.datatype or "").strip().lower(),
+            widget_name=cde.widget_name,
+            allow_multiple=bool(cde.allow_multiple),
+            options=options,
+            option_codes=frozenset(code for code, __ in options),
+            min_value=_number(cde.min_value),
+            max_value=_number(cde.max_value),
+            max_length=cde.max_length,
+            pattern=cde.pattern or None,
+        )
+
+    forms = {
+        form.name: FormSpec(form.name, form.display_name,
+                            tuple(code for code in _codes(form.sections) if code in sections),
+                            frozenset(cde.code for cde in form.complete_form_cdes.all()))
+        for form in form_rows
+    }
+    fixed_context_form_groups = dict(ContextFormGroupItem.objects.filter(
+        context_form_group__registry=registry,
+        context_form_group__context_type="F",
+    ).values_list("registry_form__name", "context_form_group_id"))
+
+    logger.info(f"Built the form index of {registry_code} {registry.version}: {len(forms)} forms, "
+                f"{len(sections)} sections, {len(cdes)} cdes")
+    return FormIndex(registry_code, registry.version, forms, sections, cdes, fixed_context_form_groups)
+
+
+_indexes = {}
+_indexes_generation = None
+_lock = threading.Lock()
+
+
+def get_form_index(registry_code):
+    global _indexes, _indexes_generation
+    generation = definition_cache.generation
+    with _lock:
+        if generation != _indexes_generation:
+            _indexes, _indexes_generation = {}, generation
+        index = _indexes.get(registry_code)
+    if index is None:
+        index = build_form_index(registry_code)
+        with _lock:
+            if generation == _indexes_generation:
+                _indexes[registry_code] = index
+    return index
@@ -0,0 +1,496 @@
+"""
+Incremental import of a registry definition.
+
+Every entity of the definition (cde, permissible value group, section, form,
+consent section, consent question and email notification) is serialised to a
+canonical dict and hashed, both from the yaml and from what is stored in the
+database. Only the entities whose hashes differ are written, in bulk.
+
+CDEs, permissible value groups and sections are shared between registries, so
+they are never deleted, and neither are consent sections; entities of those
+types which are no longer in the definition are reported instead. Consent
+questions removed from a section of the definition are deleted together with
+the answers given to them, and the consent indexes of the patients who had
+answered them are rebuilt. Parts of the definition other than the ones above (context form
+groups, dashboards, followups, ...) are not compared; use a full import when
+they change.
+"""
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from decimal import Decimal
+
+from django.contrib.auth.models import Group
+from django.db import transaction
+
+from angelman.dashboard import summary
+from angelman.definition.cache import definition_cache
+from angelman.patient_indexes import rebuild_patient_indexes
+from rdrf.models.definition.models import (
+    CDEPermittedValue, CDEPermittedValueGroup, CommonDataElement, ConsentQuestion, ConsentSection,
+    EmailNotification, EmailTemplate, Registry, RegistryForm, Section,
+)
+from registry.patients.models import ConsentValue
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalImportError(Exception):
+    pass
+
+
+Diff = namedtuple("Diff", ["entity_type", "created", "updated", "deleted", "orphaned"])
+
+
+def _normalise(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (Decimal, float)):
+        return int(value) if value == int(value) else float(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v) for v in value]
+    return value
+
+
+def digest(entity):
+    return hashlib.sha1(json.dumps(entity, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _field_names(model):
+    return {f.name for f in model._meta.concrete_fields if not f.primary_key or not f.auto_created}
+
+
+def _values(model, source, keys, getter=dict.get):
+    names = _field_names(model)
+    return {key: _normalise(getter(source, key)) for key in keys if key in names}
+
+
+def _instance_values(model, source, keys):
+    return _values(model, source, keys, getter=getattr)
+
+
+def _model_kwargs(model, values):
+    fields = {f.name: f for f in model._meta.concrete_fields}
+    kwargs = {}
+    for key, value in values.items():
+        field = fields[key]
+        if value == "" and field.null:
+            value = None
+        if field.many_to_one:
+            kwargs[field.attname] = value
+        else:
+            kwargs[key] = value
+    return kwargs
+
+
+class EntityType:
+    name = None
+    deletable = False
+
+    def __init__(self, registry, definition):
+        self.registry = registry
+        self.definition = definition
+
+    def from_definition(self):
+        raise NotImplementedError()
+
+    def from_database(self):
+        raise NotImplementedError()
+
+    def apply(self, diff, entities):
+        raise NotImplementedError()
+
+    def diff(self):
+        wanted = {key: digest(entity) for key, entity in self.entities.items()}
+        stored = {key: digest(entity) for key, entity in self.from_database().items()}
+        created = sorted(wanted.keys() - stored.keys())
+        updated = sorted(key for key in wanted.keys() & stored.keys() if wanted[key] != stored[key])
+        removed = sorted(stored.keys() - wanted.keys())
+        if self.deletable:
+            return Diff(self.name, created, updated, removed, [])
+        return Diff(self.name, created, updated, [], removed)
+
+    @property
+    def entities(self):
+        if not hasattr(self, "_entities"):
+            self._entities = self.from_definition()
+        return self._entities
+
+
+CDE_KEYS = [
+    "abbreviated_name", "allow_multiple", "calculation", "calculation_query", "code", "datatype", "desc",
+    "important", "instructions", "is_required", "max_length", "max_value", "min_value", "name", "pattern",
+    "pv_group", "widget_name", "widget_settings",
+]
+
+
+class CdeEntities(EntityType):
+    name = "cdes"
+
+    def from_definition(self):
+        return {cde["code"]: _values(CommonDataElement, cde, CDE_KEYS) for cde in self.definition.get("cdes", [])}
+
+    def from_database(self):
+        qs = CommonDataElement.objects.filter(code__in=self.entities.keys())
+        result = {}
+        for cde in qs:
+            values = _instance_values(CommonDataElement, cde, [k for k in CDE_KEYS if k != "pv_group"])
+            values["pv_group"] = _normalise(cde.pv_group_id)
+            result[cde.code] = values
+        return result
+
+    def apply(self, diff, entities):
+        CommonDataElement.objects.bulk_create(
+            [CommonDataElement(**_model_kwargs(CommonDataElement, entities[code])) for code in diff.created])
+        updated = [CommonDataElement(**_model_kwargs(CommonDataElement, entities[code])) for code in diff.updated]
+        if updated:
+            CommonDataElement.objects.bulk_update(updated, [k for k in entities[diff.updated[0]] if k != "code"])
+
+
+PV_KEYS = ["code", "value", "desc", "position"]
+
+
+class PermittedValueGroupEntities(EntityType):
+    name = "pvgs"
+
+    def from_definition(self):
+        return {
+            pvg["code"]: sorted((_values(CDEPermittedValue, pv, PV_KEYS) for pv in pvg.get("values", [])),
+                                key=lambda pv: pv["code"])
+            for pvg in self.definition.get("pvgs", [])
+        }
+
+    def from_database(self):
+        result = {code: [] for code in CDEPermittedValueGroup.objects.filter(
+            code__in=self.entities.keys()).values_list("code", flat=True)}
+        for pv in CDEPermittedValue.objects.filter(pv_group__code__in=result.keys()):
+            result[pv.pv_group_id].append(_instance_values(CDEPermittedValue, pv, PV_KEYS))
+        return {code: sorted(values, key=lambda pv: pv["code"]) for code, values in result.items()}
+
+    def apply(self, diff, entities):
+        CDEPermittedValueGroup.objects.bulk_create([CDEPermittedValueGroup(code=code) for code in diff.created])
+        CDEPermittedValue.objects.filter(pv_group__code__in=diff.updated).delete()
+        CDEPermittedValue.objects.bulk_create([
+            CDEPermittedValue(pv_group_id=code, **_model_kwargs(CDEPermittedValue, pv))
+            for code in diff.created + diff.updated
+            for pv in entities[code]
+        ])
+
+
+SECTION_KEYS = ["abbreviated_name", "allow_multiple", "code", "display_name", "elements", "extra", "header"]
+
+
+def _section_values(section):
+    values = _values(Section, section, SECTION_KEYS)
+    values["elements"] = ",".join(section.get("elements", []))
+    return values
+
+
+class SectionEntities(EntityType):
+    name = "sections"
+
+    def from_definition(self):
+        sections = [s for form in self.definition.get("forms", []) for s in form.get("sections", [])]
+        sections += self.definition.get("generic_sections", [])
+        return {section["code"]: _section_values(section) for section in sections}
+
+    def from_database(self):
+        return {section.code: _instance_values(Section, section, SECTION_KEYS)
+                for section in Section.objects.filter(code__in=self.entities.keys())}
+
+    def apply(self, diff, entities):
+        Section.objects.bulk_create([Section(**_model_kwargs(Section, entities[code])) for code in diff.created])
+        existing = Section.objects.in_bulk(diff.updated, field_name="code")
+        for code, section in existing.items():
+            for key, value in _model_kwargs(Section, entities[code]).items():
+                setattr(section, key, value)
+        if existing:
+            Section.objects.bulk_update(existing.values(), [k for k in SECTION_KEYS if k in _field_names(Section)])
+
+
+FORM_KEYS = [
+    "abbreviated_name", "applicability_condition", "conditional_rendering_rules", "display_name", "header",
+    "name", "position", "tags",
+]
+
+
+class FormEntities(EntityType):
+    name = "forms"
+    deletable = True
+
+    def from_definition(self):
+        complete_fields = {cf["form_name"]: sorted(cf["cdes"]) for cf in self.definition.get("complete_fields", [])}
+        result = {}
+        for form in self.definition.get("forms", []):
+            values = _values(RegistryForm, form, FORM_KEYS)
+            values["sections"] = ",".join(s["code"] for s in form.get("sections", []))
+            values["complete_form_cdes"] = complete_fields.get(form["name"], [])
+            result[form["name"]] = values
+        return result
+
+    def from_database(self):
+        through = RegistryForm.complete_form_cdes.through
+        complete_form_cdes = {}
+        for form_id, cde_code in through.objects.filter(
+                registryform__registry=self.registry).values_list("registryform_id", "commondataelement_id"):
+            complete_form_cdes.setdefault(form_id, []).append(cde_code)
+
+        result = {}
+        for form in RegistryForm.objects.filter(registry=self.registry):
+            values = _instance_values(RegistryForm, form, FORM_KEYS + ["sections"])
+            values["complete_form_cdes"] = sorted(complete_form_cdes.get(form.pk, []))
+            result[form.name] = values
+        return result
+
+    def apply(self, diff, entities):
+        def form_values(name):
+            return _model_kwargs(RegistryForm, {k: v for k, v in entities[name].items() if k != "complete_form_cdes"})
+
+        stored = self.from_database()
+        RegistryForm.objects.filter(registry=self.registry, name__in=diff.deleted).delete()
+        RegistryForm.objects.bulk_create(
+            [RegistryForm(registry=self.registry, **form_values(name)) for name in diff.created])
+
+        existing = RegistryForm.objects.filter(registry=self.registry).in_bulk(diff.updated, field_name="name")
+        for name, form in existing.items():
+            for key, value in form_values(name).items():
+                setattr(form, key, value)
+        if existing:
+            RegistryForm.objects.bulk_update(existing.values(), list(form_values(diff.updated[0]).keys()))
+
+        changed = RegistryForm.objects.filter(registry=self.registry).in_bulk(diff.created + diff.updated,
+                                                                              field_name="name")
+        through = RegistryForm.complete_form_cdes.through
+        recompute = list(diff.deleted) + [
+            name for name in changed
+            if entities[name]["complete_form_cdes"] != stored.get(name, {}).get("complete_form_cdes", [])
+        ]
+        through.objects.filter(registryform__in=changed.values()).delete()
+        through.objects.bulk_create([
+            through(registryform_id=form.pk, commondataelement_id=cde_code)
+            for name, form in changed.items()
+            for cde_code in entities[name]["complete_form_cdes"]
+        ])
+
+        # bulk writes send no m2m_changed: recompute the completion of the forms, and the dashboard
+        # summaries showing it, once the new definition is visible
+        if recompute:
+            definition_cache.invalidate_on_commit()
+        for name in recompute:
+            transaction.on_commit(lambda form_name=name: summary.recompute_form(self.registry.code, form_name))
+
+
+CONSENT_SECTION_KEYS = [
+    "applicability_condition", "code", "information_link", "information_text", "section_label", "validation_rule",
+]
+CONSENT_QUESTION_KEYS = ["code", "instructions", "position", "question_label"]
+
+
+class ConsentSectionEntities(EntityType):
+    name = "consent_sections"
+
+    def from_definition(self):
+        return {section["code"]: _values(ConsentSection, section, CONSENT_SECTION_KEYS)
+                for section in self.definition.get("consent_sections", [])}
+
+    def from_database(self):
+        return {section.code: _instance_values(ConsentSection, section, CONSENT_SECTION_KEYS)
+                for section in ConsentSection.objects.filter(registry=self.registry)}
+
+    def apply(self, diff, entities):
+        ConsentSection.objects.bulk_create(
+            [ConsentSection(registry=self.registry, **_model_kwargs(ConsentSection, entities[code]))
+             for code in diff.created])
+        sections = ConsentSection.objects.filter(registry=self.registry).in_bulk(diff.updated, field_name="code")
+        for code, section in sections.items():
+            for key, value in _model_kwargs(ConsentSection, entities[code]).items():
+                setattr(section, key, value)
+        if sections:
+            ConsentSection.objects.bulk_update(sections.values(), [k for k in entities[diff.updated[0]] if k != "code"])
+
+
+class ConsentQuestionEntities(EntityType):
+    """
+    The questions of the consent sections in the definition, keyed
+    "<section code>.<question code>"
+    """
+    name = "consent_questions"
+    deletable = True
+
+    def from_definition(self):
+        return {f"{section['code']}.{question['code']}": _values(ConsentQuestion, question, CONSENT_QUESTION_KEYS)
+                for section in self.definition.get("consent_sections", [])
+                for question in section.get("questions", [])}
+
+    def _stored_questions(self):
+        section_codes = [section["code"] for section in self.definition.get("consent_sections", [])]
+        questions = ConsentQuestion.objects.filter(section__registry=self.registry, section__code__in=section_codes)
+        return {f"{question.section.code}.{question.code}": question
+                for question in questions.select_related("section")}
+
+    def from_database(self):
+        return {key: _instance_values(ConsentQuestion, question, CONSENT_QUESTION_KEYS)
+                for key, question in self._stored_questions().items()}
+
+    def apply(self, diff, entities):
+        stored = self._stored_questions()
+        deleted = [stored[key].pk for key in diff.deleted]
+        if deleted:
+            # deleting a question deletes the answers given to it
+            patient_ids = sorted(set(ConsentValue.objects.filter(consent_question__in=deleted).values_list(
+                "patient_id", flat=True)))
+            ConsentQuestion.objects.filter(pk__in=deleted).delete()
+            if patient_ids:
+                transaction.on_commit(lambda: rebuild_patient_indexes(
+                    self.registry.code, patient_ids, only=["consents", "dashboard"]))
+
+        sections = ConsentSection.objects.filter(registry=self.registry).in_bulk(
+            {key.split(".", 1)[0] for key in diff.created}, field_name="code")
+        ConsentQuestion.objects.bulk_create([
+            ConsentQuestion(section=sections[key.split(".", 1)[0]], **_model_kwargs(ConsentQuestion, entities[key]))
+            for key in diff.created
+        ])
+
+        updated = [stored[key] for key in diff.updated]
+        for key, question in zip(diff.updated, updated):
+            for field, value in _model_kwargs(ConsentQuestion, entities[key]).items():
+                setattr(question, field, value)
+        if updated:
+            ConsentQuestion.objects.bulk_update(updated, [k for k in CONSENT_QUESTION_KEYS if k != "code"])
+
+
+NOTIFICATION_KEYS = ["description", "disabled", "email_from", "recipient"]
+TEMPLATE_KEYS = ["body", "description", "language", "subject"]
+
+
+def _notification_keys(notification_values):
+    """
+    Keys notifications by description and recipients, with an ordinal for
+    notifications which are the same in both, as several notifications of a
+    registry can share a description (e.g. one per recipient group)
+    """
+    keys = []
+    seen = {}
+    for values in notification_values:
+        identity = f"{values['description']} -> {values.get('recipient', '')}/{values['group_recipient']}"
+        seen[identity] = seen.get(identity, 0) + 1
+        keys.append(identity if seen[identity] == 1 else f"{identity} #{seen[identity]}")
+    return keys
+
+
+class EmailNotificationEntities(EntityType):
+    name = "email_notifications"
+    deletable = True
+
+    def from_definition(self):
+        notifications = []
+        for notification in self.definition.get("email_notifications", []):
+            values = _values(EmailNotification, notification, NOTIFICATION_KEYS)
+            values["group_recipient"] = _normalise(notification.get("group_recipient"))
+            values["email_templates"] = sorted((_values(EmailTemplate, t, TEMPLATE_KEYS)
+                                                for t in notification.get("email_templates", [])),
+                                               key=lambda t: (t["language"], t["description"]))
+            notifications.append(values)
+        return dict(zip(_notification_keys(notifications), notifications))
+
+    def from_database(self):
+        result = {}
+        notifications = (EmailNotification.objects.filter(registry=self.registry)
+                         .select_related("group_recipient").order_by("pk"))
+        for notification in notifications:
+            values = _instance_values(EmailNotification, notification, NOTIFICATION_KEYS)
+            group = notification.group_recipient
+            values["group_recipient"] = _normalise(group.name if group else None)
+            values["email_templates"] = []
+            result[notification.pk] = values
+
+        through = EmailNotification.email_templates.through
+        for link in through.objects.filter(emailnotification__in=notifications).select_related("emailtemplate"):
+            result[link.emailnotification_id]["email_templates"].append(
+                _instance_values(EmailTemplate, link.emailtemplate, TEMPLATE_KEYS))
+        for values in result.values():
+            values["email_templates"].sort(key=lambda t: (t["language"], t["description"]))
+        keys = _notification_keys(result.values())
+        # key -> pk of the stored notification, used by apply()
+        self.stored = dict(zip(keys, result.keys()))
+        return dict(zip(keys, result.values()))
+
+    def apply(self, diff, entities):
+        group_names = {entities[key]["group_recipient"] for key in diff.created + diff.updated} - {""}
+        groups = Group.objects.in_bulk(group_names, field_name="name")
+
+        def notification_values(key):
+            values = {k: v for k, v in entities[key].items() if k not in ("group_recipient", "email_templates")}
+            group = groups.get(entities[key]["group_recipient"])
+            return dict(_model_kwargs(EmailNotification, values), group_recipient=group)
+
+        notifications = EmailNotification.objects.filter(registry=self.registry)
+        notifications.filter(pk__in=[self.stored[key] for key in diff.deleted]).delete()
+        created = EmailNotification.objects.bulk_create(
+            [EmailNotification(registry=self.registry, **notification_values(key)) for key in diff.created])
+
+        updated = notifications.in_bulk([self.stored[key] for key in diff.updated])
+        changed = dict(zip(diff.created, created))
+        changed.update((key, updated[self.stored[key]]) for key in diff.updated)
+        for key in diff.updated:
+            for field, value in notification_values(key).items():
+                setattr(changed[key], field, value)
+        if diff.updated:
+            EmailNotification.objects.bulk_update([changed[key] for key in diff.updated],
+                                                  list(notification_values(diff.updated[0]).keys()))
+
+        through = EmailNotification.email_templates.through
+        old_templates = through.objects.filter(emailnotification__in=changed.values())
+        EmailTemplate.objects.filter(pk__in=list(old_templates.values_list("emailtemplate_id", flat=True))).delete()
+        templates = []
+        for key, notification in changed.items():
+            for values in entities[key]["email_templates"]:
+                templates.append((notification, EmailTemplate(**_model_kwargs(EmailTemplate, values))))
+        EmailTemplate.objects.bulk_create([template for __, template in templates])
+        through.objects.bulk_create([through(emailnotification_id=notification.pk, emailtemplate_id=template.pk)
+                                     for notification, template in templates])
+
+
+# In dependency order: cdes refer to pvgs, sections to cdes, forms to sections, consent questions to
+# consent sections
+ENTITY_TYPES = [
+    PermittedValueGroupEntities,
+    CdeEntities,
+    SectionEntities,
+    FormEntities,
+    ConsentSectionEntities,
+    ConsentQuestionEntities,
+    EmailNotificationEntities,
+]
+
+
+def incremental_import(definition, dry_run=False):
+    registry_code = definition["code"]
+    try:
+        registry = Registry.objects.get(code=registry_code)
+    except Registry.DoesNotExist:
+        raise IncrementalImportError(f"Registry {registry_code} does not exist yet - run a full import first")
+
+    with transaction.atomic():
+        diffs = []
+        for entity_type_class in ENTITY_TYPES:
+            entity_type = entity_type_class(registry, definition)
+            diff = entity_type.diff()
+            diffs.append(diff)
+            if not dry_run and (diff.created or diff.updated or diff.deleted):
+                entity_type.apply(diff, entity_type.entities)
+                logger.info(f"Incremental import of {registry_code}: {len(diff.created)} {diff.entity_type} created, "
+                            f"{len(diff.updated)} updated, {len(diff.deleted)} deleted")
+
+        version = definition.get("REGISTRY_VERSION")
+        if not dry_run and version and registry.version != version:
+            registry.version = version
+            registry.save(update_fields=["version"])
+
+    if not dry_run:
+        # bulk writes do not send the signals the definition cache listens to
+        definition_cache.invalidate_on_commit()
+    return diffs
@@ -0,0 +1,102 @@
+"""
+Loads registry definition yaml files (e.g. angelman.yaml) through a binary
+cache.
+
+The parsed definition is pickled into REGISTRY_DEFINITION_CACHE_DIR under a
+name made of the yaml file name, its REGISTRY_VERSION and a hash of its
+content, so an edited or re-exported definition never hits a stale cache.
+When there is no usable cache the yaml is parsed with libyaml (the C
+parser) where available.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import re
+import tempfile
+
+import yaml
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Bump when the structure of the cached data changes
+CACHE_FORMAT = 1
+
+_REGISTRY_VERSION_RE = re.compile(rb"^REGISTRY_VERSION:\s*['\"]?([^'\"\r\n]*)['\"]?\s*$", re.MULTILINE)
+
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def registry_version(raw):
+    match = _REGISTRY_VERSION_RE.search(raw)
+    return match.group(1).decode("utf-8").strip() if match else "unknown"
+
+
+def parse_definition(raw):
+    if YamlLoader is yaml.SafeLoader:
+        logger.warning("libyaml is not available - parsing the registry definition with the pure python loader")
+    return yaml.load(raw, Loader=YamlLoader)
+
+
+def _cache_prefix(yaml_path):
+    return "%s-" % os.path.splitext(os.path.basename(yaml_path))[0]
+
+
+def cache_path(yaml_path, raw, cache_dir):
+    digest = hashlib.sha256(raw).hexdigest()[:20]
+    version = re.sub(r"[^\w.]", "_", registry_version(raw))
+    return os.path.join(cache_dir, f"{_cache_prefix(yaml_path)}{version}-{digest}-{CACHE_FORMAT}.pickle")
+
+
+def _read_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning(f"Ignoring unreadable registry definition cache {path}: {ex}")
+        return None
+
+
+def _write_cache(path, yaml_path, definition):
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(definition, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as ex:
+        logger.warning(f"Could not write registry definition cache {path}: {ex}")
+        return
+
+    # Only the current version of a definition file is worth keeping
+    prefix = _cache_prefix(yaml_path)
+    for name in os.listdir(cache_dir):
+        stale_path = os.path.join(cache_dir, name)
+        if name.startswith(prefix) and name.endswith(".pickle") and stale_path != path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+
+
+def load_registry_definition(yaml_path, use_cache=True, cache_dir=None):
+    with open(yaml_path, "rb") as f:
+        raw = f.read()
+
+    if not use_cache:
+        return parse_definition(raw)
+
+    path = cache_path(yaml_path, raw, cache_dir or settings.REGISTRY_DEFINITION_CACHE_DIR)
+    definition = _read_cache(path)
+    if definition is not None:
+        logger.info(f"Loaded registry definition {yaml_path} from cache {path}")
+        return definition
+
+    definition = parse_definition(raw)
+    _write_cache(path, yaml_path, definition)
+    logger.info(f"Parsed registry definition {yaml_path} and cached it in {path}")
+    return definition
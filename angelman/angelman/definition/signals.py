@@ -0,0 +1,37 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from angelman.definition.cache import definition_cache
+from rdrf.models.definition.models import (
+    CDEPermittedValue, CDEPermittedValueGroup, CommonDataElement, ConsentQuestion, ConsentRule, ContextFormGroup,
+    ContextFormGroupItem, EmailNotification, EmailTemplate, RegistryDashboardCDEData, RegistryForm, Section,
+)
+from registry.patients.models import AddressType
+
+DEFINITION_MODELS = [
+    CommonDataElement,
+    CDEPermittedValueGroup,
+    CDEPermittedValue,
+    ContextFormGroup,
+    ContextFormGroupItem,
+    RegistryForm,
+    Section,
+    ConsentQuestion,
+    ConsentRule,
+    EmailNotification,
+    EmailTemplate,
+    AddressType,
+    RegistryDashboardCDEData,
+]
+
+
+def invalidate_definition_cache(sender, **kwargs):
+    definition_cache.invalidate_on_commit()
+
+
+def connect_signals():
+    for model in DEFINITION_MODELS:
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate_definition_cache, sender=model,
+                           dispatch_uid=f"angelman_definition_cache_{model.__name__}")
+    m2m_changed.connect(invalidate_definition_cache, sender=EmailNotification.email_templates.through,
+                        dispatch_uid="angelman_definition_cache_email_templates")
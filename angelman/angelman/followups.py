@@ -0,0 +1,246 @@
+"""
+Set based selection of the patients due for a longitudinal followup.
+
+Followup conditions, e.g.
+
+    consents.get('ang.AngNewConsentSection.angnewconsent6b') and patient.living_status == 'Alive'
+    and patient.age < 10
+
+are compiled once into a Q object on Patient, so the patients a followup
+applies to are found with one query per followup. The supported expressions
+are and/or/not of consents.get('<registry>.<section>.<question>'), checked
+against the consent index, and of comparisons between a patient field (or
+patient.age) and a constant.
+Conditions using anything else are evaluated in Python for each candidate
+patient instead.
+
+The reminders of the pending followup entries are sent as one
+longitudinal-followup email per patient, rendered with the compiled
+notification templates over one SMTP connection.
+"""
+import ast
+import logging
+from datetime import date
+from functools import lru_cache
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch, Q
+from django.utils import timezone
+
+from angelman.consents.index import consented
+from angelman.models import PatientConsentAnswer
+from angelman.notifications.batch import send_batch
+from rdrf.models.definition.models import LongitudinalFollowupEntry, LongitudinalFollowupQueueState
+from registry.patients.models import ParentGuardian, Patient
+
+logger = logging.getLogger(__name__)
+
+REMINDER_NOTIFICATION = "longitudinal-followup"
+
+
+class NotTranslatable(Exception):
+    pass
+
+
+_COMPARISON_LOOKUPS = {
+    ast.Eq: "exact",
+    ast.Lt: "lt",
+    ast.LtE: "lte",
+    ast.Gt: "gt",
+    ast.GtE: "gte",
+}
+
+
+def _years_ago(today, years):
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        # 29th of February
+        return today.replace(year=today.year - years, day=28)
+
+
+def _age_q(op, age, today):
+    # patient.age is the number of full years since date_of_birth
+    if not isinstance(age, int) or isinstance(age, bool):
+        raise NotTranslatable("patient.age can only be compared with whole years")
+    if isinstance(op, ast.Lt):
+        return Q(date_of_birth__gt=_years_ago(today, age))
+    if isinstance(op, ast.LtE):
+        return Q(date_of_birth__gt=_years_ago(today, age + 1))
+    if isinstance(op, ast.GtE):
+        return Q(date_of_birth__lte=_years_ago(today, age))
+    if isinstance(op, ast.Gt):
+        return Q(date_of_birth__lte=_years_ago(today, age + 1))
+    if isinstance(op, ast.Eq):
+        return _age_q(ast.GtE(), age, today) & _age_q(ast.Lt(), age + 1, today)
+    if isinstance(op, ast.NotEq):
+        return ~_age_q(ast.Eq(), age, today)
+    raise NotTranslatable(f"Unsupported comparison of patient.age: {ast.dump(op)}")
+
+
+def _consent_q(key):
+    try:
+        registry_code, section_code, question_code = key.split(".")
+    except ValueError:
+        raise NotTranslatable(f"Unexpected consent key {key}")
+    return Q(consented(registry_code, section_code, question_code))
+
+
+def _patient_field(node):
+    if not (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "patient"):
+        raise NotTranslatable(f"Unsupported operand {ast.dump(node)}")
+    return node.attr
+
+
+def _constant(node):
+    if not isinstance(node, ast.Constant):
+        raise NotTranslatable(f"Unsupported operand {ast.dump(node)}")
+    return node.value
+
+
+def _translate(node, today):
+    if isinstance(node, ast.Expression):
+        return _translate(node.body, today)
+
+    if isinstance(node, ast.BoolOp):
+        parts = [_translate(value, today) for value in node.values]
+        combined = parts[0]
+        for part in parts[1:]:
+            combined = combined & part if isinstance(node.op, ast.And) else combined | part
+        return combined
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return ~_translate(node.operand, today)
+
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "get"
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == "consents"
+            and len(node.args) == 1 and not node.keywords):
+        return _consent_q(_constant(node.args[0]))
+
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        field, op, value = _patient_field(node.left), node.ops[0], _constant(node.comparators[0])
+        if field == "age":
+            return _age_q(op, value, today)
+        if field not in {f.name for f in Patient._meta.concrete_fields}:
+            raise NotTranslatable(f"patient.{field} is not a database field")
+        if isinstance(op, ast.NotEq):
+            return ~Q(**{field: value})
+        if type(op) not in _COMPARISON_LOOKUPS:
+            raise NotTranslatable(f"Unsupported comparison {ast.dump(op)}")
+        return Q(**{f"{field}__{_COMPARISON_LOOKUPS[type(op)]}": value})
+
+    raise NotTranslatable(f"Unsupported expression {ast.dump(node)}")
+
+
+@lru_cache(maxsize=None)
+def _parse(condition):
+    return ast.parse(condition, mode="eval"), compile(condition, "<followup condition>", "eval")
+
+
+def compile_condition(condition, today=None):
+    """
+    Returns a Q object on Patient equivalent to the condition, or None when the
+    condition cannot be translated to SQL
+    """
+    if not condition or not condition.strip():
+        return Q()
+    tree, __ = _parse(condition)
+    try:
+        return _translate(tree, today or date.today())
+    except NotTranslatable as ex:
+        logger.info(f"Followup condition evaluated in python ({ex}): {condition}")
+        return None
+
+
+def _consents_by_patient(patient_ids):
+    consents = {}
+    values = PatientConsentAnswer.objects.filter(patient_id__in=patient_ids).values_list(
+        "patient_id", "registry_code", "section_code", "question_code")
+    for patient_id, registry_code, section_code, question_code in values:
+        consents.setdefault(patient_id, {})[f"{registry_code}.{section_code}.{question_code}"] = True
+    return consents
+
+
+def _evaluate(condition, patients):
+    __, code = _parse(condition)
+    patients = list(patients)
+    consents = _consents_by_patient([p.pk for p in patients])
+    matches = []
+    for patient in patients:
+        try:
+            if eval(code, {"__builtins__": {}}, {"patient": patient, "consents": consents.get(patient.pk, {})}):
+                matches.append(patient.pk)
+        except Exception as ex:
+            logger.warning(f"Could not evaluate followup condition for patient {patient.pk}: {ex}")
+    return matches
+
+
+def candidate_patients(followup, now=None):
+    now = now or timezone.now()
+    window = max(followup.frequency, followup.debounce)
+    recent_entries = LongitudinalFollowupEntry.objects.filter(
+        longitudinal_followup=followup,
+        patient=OuterRef("pk"),
+        send_at__gt=now - window,
+    )
+    return Patient.objects.filter(rdrf_registry=followup.context_form_group.registry).exclude(Exists(recent_entries))
+
+
+def due_patient_ids(followup, now=None):
+    """
+    Returns (patient ids, whether the condition ran in SQL)
+    """
+    now = now or timezone.now()
+    candidates = candidate_patients(followup, now)
+    q = compile_condition(followup.condition, today=timezone.localdate(now))
+    if q is not None:
+        return list(candidates.filter(q).values_list("pk", flat=True)), True
+    return _evaluate(followup.condition, candidates.iterator(chunk_size=2000)), False
+
+
+def _reminder(patient, entries):
+    followups = {}
+    for entry in entries:
+        followups.setdefault(entry.longitudinal_followup.name, []).append(entry)
+    parent = next(iter(patient.parents), None)
+    return {
+        "patient": patient,
+        "longitudinal_followups": followups,
+        "language": getattr(parent.user, "preferred_language", None) if parent and parent.user else None,
+    }
+
+
+def send_reminders(registry_code, now=None, rate=10, max_per_connection=100):
+    """
+    Sends the longitudinal followup entries of the registry due by now, one
+    email per patient listing all of the patient's due followups, and marks
+    the entries of the patients emailed as sent; returns the BatchResult
+    """
+    now = now or timezone.now()
+    entries = (LongitudinalFollowupEntry.objects
+               .filter(longitudinal_followup__context_form_group__registry__code=registry_code,
+                       state=LongitudinalFollowupQueueState.PENDING, send_at__lte=now)
+               .select_related("longitudinal_followup__context_form_group")
+               .order_by("patient_id", "longitudinal_followup__name"))
+    by_patient = {}
+    for entry in entries:
+        by_patient.setdefault(entry.patient_id, []).append(entry)
+    patients = Patient.objects.prefetch_related(Prefetch(
+        "parentguardian_set", queryset=ParentGuardian.objects.select_related("user").order_by("pk"),
+        to_attr="parents")).in_bulk(list(by_patient))
+
+    patient_ids = [patient_id for patient_id in by_patient if patient_id in patients]
+    result = send_batch(registry_code, REMINDER_NOTIFICATION,
+                        [_reminder(patients[patient_id], by_patient[patient_id]) for patient_id in patient_ids],
+                        rate=rate, max_per_connection=max_per_connection)
+
+    failed = {index for index, __ in result.failed}
+    sent = [entry for index, patient_id in enumerate(patient_ids) if index not in failed
+            for entry in by_patient[patient_id]]
+    sent_at = timezone.now()
+    for entry in sent:
+        entry.state = LongitudinalFollowupQueueState.SENT
+        entry.sent_at = [*(entry.sent_at or []), sent_at]
+    with transaction.atomic():
+        LongitudinalFollowupEntry.objects.bulk_update(sent, ["state", "sent_at"], batch_size=1000)
+    return result
@@ -1,39 +1,87 @@
-from operator import attrgetter
+from functools import lru_cache
+from operator import itemgetter
 
 import pycountry
+from django.conf import settings
 from django.forms import CharField, ChoiceField, DateField, BooleanField
+from django.forms.utils import flatatt
 from django.forms.widgets import RadioSelect, Select
-from django.utils.translation import gettext_lazy as _
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language, gettext, override, gettext_lazy as _
 
-from angelman.registry.groups.registration.angelman_registration import DIAGNOSIS_CDE
+from angelman.registry.groups.registration.angelman_registration import get_diagnosis_options
 from rdrf.forms.registration_forms import RegistrationFormCaseInsensitiveCheck
 from rdrf.helpers.utils import get_all_language_codes
-from rdrf.models.definition.models import CommonDataElement
 from registry.patients.models import Patient
 
 
-def _tuple(code, name):
-    return code, _(name)
+def _active_language():
+    return get_language() or settings.LANGUAGE_CODE
 
 
-def _countries():
-    countries = sorted(pycountry.countries, key=attrgetter('name'))
-    result = [_tuple("", "Country")]
-    return result + [_tuple(c.alpha_2, c.name) for c in countries]
+@lru_cache(maxsize=None)
+def _countries(language):
+    with override(language):
+        countries = sorted(((c.alpha_2, gettext(c.name)) for c in pycountry.countries), key=itemgetter(1))
+        return (("", gettext("Country")),) + tuple(countries)
+
+
+def _country_choices():
+    return _countries(_active_language())
 
 
 def _get_diagnosis():
-    cde_code = DIAGNOSIS_CDE['cde_code']
-    cde = CommonDataElement.objects.filter(code=cde_code).first()
-    options = cde.pv_group.options if cde else []
+    options = get_diagnosis_options() or []
     initial = {'code': '', 'text': 'Diagnosis'}
     options = [initial] + options
     return [(o['code'], _(o['text'])) for o in options]
 
 
-def _preferred_languages():
-    languages = get_all_language_codes()
-    return [_tuple(lang.code, lang.name) for lang in languages] if languages else [_tuple('en', 'English')]
+@lru_cache(maxsize=None)
+def _preferred_languages(language):
+    with override(language):
+        languages = get_all_language_codes()
+        if not languages:
+            return (('en', gettext('English')),)
+        return tuple((lang.code, gettext(lang.name)) for lang in languages)
+
+
+def _language_choices():
+    return _preferred_languages(_active_language())
+
+
+@lru_cache(maxsize=None)
+def _rendered_options(choices_function, language):
+    # (value, unselected markup, selected markup) for each choice
+    return tuple(
+        (str(value),
+         format_html('<option value="{}">{}</option>', value, label),
+         format_html('<option value="{}" selected>{}</option>', value, label))
+        for value, label in choices_function()
+    )
+
+
+class PrerenderedSelect(Select):
+    """
+    A select whose <option> markup is rendered once per language, rather than
+    through a template per option on every render. Only for flat choice lists.
+    """
+
+    def __init__(self, choices_function, attrs=None):
+        super().__init__(attrs)
+        self.choices_function = choices_function
+
+    def render(self, name, value, attrs=None, renderer=None):
+        selected = set(self.format_value(value))
+        options = _rendered_options(self.choices_function, _active_language())
+        final_attrs = self.build_attrs(self.attrs, attrs)
+        return mark_safe(
+            format_html('<select name="{}"{}>', name, flatatt(final_attrs)) +
+            "".join(selected_html if option_value in selected else html
+                    for option_value, html, selected_html in options) +
+            "</select>"
+        )
 
 
 def _field_widget_class(field):
@@ -69,10 +117,6 @@ class ANGPatientRegistrationForm(RegistrationFormCaseInsensitiveCheck):
         'date_of_birth': _("YYYY-MM-DD")
     }
 
-    country_choices = _countries()
-
-    language_choices = _preferred_languages()
-
     password_fields = ['password1', 'password2']
 
     def __init__(self, *args, **kwargs):
@@ -91,7 +135,7 @@ class ANGPatientRegistrationForm(RegistrationFormCaseInsensitiveCheck):
             if field in self.password_fields:
                 self.fields[field].widget.render_value = True
 
-    preferred_languages = ChoiceField(required=False, choices=language_choices)
+    preferred_languages = ChoiceField(required=False, choices=_language_choices)
     first_name = CharField(required=True, max_length=30)
     surname = CharField(required=True, max_length=30)
     date_of_birth = DateField(required=True)
@@ -99,7 +143,8 @@ class ANGPatientRegistrationForm(RegistrationFormCaseInsensitiveCheck):
     diagnosis = ChoiceField(required=True, widget=Select, choices=_get_diagnosis, initial="")
     address = CharField(required=True, max_length=100)
     suburb = CharField(required=True, max_length=30)
-    country = ChoiceField(required=True, widget=Select, choices=country_choices, initial="")
+    country = ChoiceField(required=True, widget=PrerenderedSelect(_country_choices), choices=_country_choices,
+                          initial="")
     state = CharField(required=False, widget=Select)
     postcode = CharField(required=True, max_length=30)
     phone_number = CharField(required=True, max_length=30)
@@ -140,8 +185,8 @@ class ANGRegistrationForm(ANGPatientRegistrationForm):
     parent_guardian_gender = ChoiceField(choices=Patient.SEX_CHOICES, widget=RadioSelect, required=True)
     parent_guardian_address = CharField(required=True, max_length=100)
     parent_guardian_suburb = CharField(required=True, max_length=30)
-    parent_guardian_country = ChoiceField(required=True, widget=Select, choices=ANGPatientRegistrationForm.country_choices,
-                                          initial="-1")
+    parent_guardian_country = ChoiceField(required=True, widget=PrerenderedSelect(_country_choices),
+                                          choices=_country_choices, initial="-1")
     parent_guardian_state = CharField(required=False, widget=Select, max_length=30)
     parent_guardian_postcode = CharField(required=True, max_length=30)
     parent_guardian_phone = CharField(required=True, max_length=30)
@@ -0,0 +1,139 @@
+"""
+Batch ingestion of cde values.
+
+A batch is a list of records
+
+    {"patient_id": 12, "form": "CheckUp6Months", "section": "6moAgehw", "cde": "6MoWeight", "value": "21"}
+
+with an optional "context_id"; without one the patient's context of the
+fixed context form group holding the form is used. All records of a batch
+are validated against the form index of the registry first (including the
+datatype, permissible values and limits of the cde), then the values for
+each (patient, context) document are written together with one partial
+write (see angelman.clinical_data.partial), in a savepoint of its own. Every
+record gets its own result, so one bad record does not reject the batch, and
+a failing write only fails the records of its document.
+
+Records are only written for patients in the working groups of the user
+sending them, unless the user is a superuser.
+"""
+import logging
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError
+
+from angelman.clinical_data.partial import CdeWrite, set_cde_values
+from angelman.definition.form_index import get_form_index
+from rdrf.models.definition.models import RDRFContext
+from registry.patients.models import Patient
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("patient_id", "form", "section", "cde", "value")
+
+
+class RecordResult:
+
+    def __init__(self, index, errors=None):
+        self.index = index
+        self.errors = errors or []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def as_dict(self):
+        result = {"index": self.index, "status": "ok" if self.ok else "error"}
+        if self.errors:
+            result["errors"] = self.errors
+        return result
+
+
+def _validate(record, form_index):
+    if not isinstance(record, dict):
+        return ["record is not an object"]
+    missing = [field for field in REQUIRED_FIELDS if field not in record]
+    if missing:
+        return [f"missing {', '.join(missing)}"]
+    for field in ("patient_id", "context_id"):
+        if record.get(field) is not None and (not isinstance(record[field], int) or isinstance(record[field], bool)):
+            return [f"{field} must be an integer"]
+    return form_index.validate(record["form"], record["section"], record["cde"], record["value"])
+
+
+def _resolve_contexts(registry, form_index, records, results, user):
+    """
+    Sets record["context_id"] where it is missing, and checks given ones belong to the patient
+    """
+    patient_ids = {record["patient_id"] for record, result in zip(records, results) if result.ok}
+    patients = Patient.objects.filter(pk__in=patient_ids, rdrf_registry=registry)
+    known_patients = set(patients.values_list("pk", flat=True))
+    if user is None or user.is_superuser:
+        allowed_patients = known_patients
+    else:
+        allowed_patients = set(patients.filter(working_groups__in=user.working_groups.all())
+                               .values_list("pk", flat=True))
+    contexts = RDRFContext.objects.filter(
+        registry=registry,
+        content_type=ContentType.objects.get_for_model(Patient),
+        object_id__in=known_patients,
+    ).values_list("pk", "object_id", "context_form_group_id")
+    context_patients = {}
+    fixed_contexts = {}
+    for context_id, patient_id, context_form_group_id in contexts:
+        context_patients[context_id] = patient_id
+        fixed_contexts[(patient_id, context_form_group_id)] = context_id
+
+    form_groups = form_index.fixed_context_form_groups
+    for record, result in zip(records, results):
+        if not result.ok:
+            continue
+        if record["patient_id"] not in known_patients:
+            result.errors.append(f"patient {record['patient_id']} is not in registry {registry.code}")
+        elif record["patient_id"] not in allowed_patients:
+            result.errors.append(f"patient {record['patient_id']} is not in your working groups")
+        elif record.get("context_id") is not None:
+            if context_patients.get(record["context_id"]) != record["patient_id"]:
+                result.errors.append(f"context {record['context_id']} is not a context of the patient")
+        else:
+            context_id = fixed_contexts.get((record["patient_id"], form_groups.get(record["form"])))
+            if context_id is None:
+                result.errors.append(f"no context for form {record['form']} - pass context_id")
+            else:
+                record["context_id"] = context_id
+
+
+def _write(registry, records, results):
+    by_document = defaultdict(list)
+    for record, result in zip(records, results):
+        if result.ok:
+            by_document[(record["patient_id"], record["context_id"])].append((record, result))
+
+    for (patient_id, context_id), document_records in by_document.items():
+        try:
+            # set_cde_values is atomic, a savepoint when the batch runs in a transaction
+            written = set_cde_values(registry.code, patient_id, context_id, [
+                CdeWrite(record["form"], record["section"], record["cde"], record["value"])
+                for record, __ in document_records
+            ])
+        except DatabaseError as ex:
+            logger.exception(f"Ingest into {registry.code} - writing patient {patient_id} context {context_id} failed")
+            for __, result in document_records:
+                result.errors.append(f"the values could not be saved: {ex}")
+            continue
+        for index, errors in written.errors.items():
+            document_records[index][1].errors.extend(errors)
+
+
+def ingest_records(registry, records, user=None):
+    """
+    Validates and writes a batch of records, returns a RecordResult per record;
+    with a user, only records of patients in the user's working groups are written
+    """
+    form_index = get_form_index(registry.code)
+    results = [RecordResult(index, _validate(record, form_index)) for index, record in enumerate(records)]
+    _resolve_contexts(registry, form_index, records, results, user)
+    _write(registry, records, results)
+    logger.info(f"Ingested {sum(result.ok for result in results)} of {len(records)} records into {registry.code}")
+    return results
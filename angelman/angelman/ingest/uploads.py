@@ -0,0 +1,99 @@
+"""
+Resumable, chunked uploads of file cde values.
+
+The client names an upload by the sha256 of the file, sends the file in
+chunks at increasing offsets and asks for the current offset to resume an
+interrupted upload. Completing the upload checks the hash, stores the file
+as a CDEFile and sets the cde value through the batch ingestion path.
+"""
+import fcntl
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+from angelman.ingest.records import ingest_records
+from rdrf.models.definition.models import CDEFile
+
+UPLOAD_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadError(Exception):
+    pass
+
+
+def _path(registry_code, upload_id):
+    if not UPLOAD_ID.match(upload_id):
+        raise UploadError("the upload id must be the sha256 of the file")
+    return os.path.join(settings.INGEST_UPLOAD_DIR, registry_code, upload_id)
+
+
+def upload_offset(registry_code, upload_id):
+    path = _path(registry_code, upload_id)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def append_chunk(registry_code, upload_id, offset, chunk):
+    """
+    Appends a chunk written at offset, returns the new offset. Chunks which
+    don't start at the current end of the upload are rejected with the
+    current offset, so the client can resume from there. Concurrent requests
+    for the same upload are serialised by a lock on the file.
+    """
+    path = _path(registry_code, upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        # released when the file is closed
+        fcntl.flock(f, fcntl.LOCK_EX)
+        current = f.seek(0, os.SEEK_END)
+        if offset != current:
+            raise UploadError(f"expected offset {current}")
+        f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def complete_upload(registry, upload_id, record, user=None):
+    """
+    Stores a finished upload as the value of the cde of the record, returns the RecordResult
+    """
+    if not isinstance(record, dict):
+        raise UploadError("the record must be a JSON object")
+    missing = [field for field in ("patient_id", "form", "section", "cde") if field not in record]
+    if missing:
+        raise UploadError(f"missing {', '.join(missing)}")
+    path = _path(registry.code, upload_id)
+    if not os.path.exists(path):
+        raise UploadError("unknown upload")
+    if _sha256(path) != upload_id:
+        raise UploadError("the uploaded data does not match its sha256 - upload it again")
+
+    file_name = os.path.basename(record.get("file_name") or upload_id)
+    with transaction.atomic():
+        cde_file = CDEFile(registry_code=registry.code,
+                           form_name=record["form"],
+                           section_code=record["section"],
+                           cde_code=record["cde"],
+                           filename=file_name)
+        with open(path, "rb") as f:
+            cde_file.item.save(file_name, File(f), save=True)
+        result, = ingest_records(registry, [dict(record, value={"file_name": file_name,
+                                                                "django_file_id": cde_file.pk})], user)
+        if not result.ok:
+            transaction.set_rollback(True)
+            cde_file.item.delete(save=False)
+            return result
+    os.remove(path)
+    return result
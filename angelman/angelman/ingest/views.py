@@ -0,0 +1,112 @@
+import json
+
+from django.shortcuts import get_object_or_404
+from rest_framework import status
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.permissions import BasePermission
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from angelman.ingest.records import ingest_records
+from angelman.ingest.uploads import UploadError, append_chunk, complete_upload, upload_offset
+from rdrf.models.definition.models import Registry
+
+MAX_BATCH_SIZE = 10000
+
+
+class JSONLinesParser(BaseParser):
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return [line for line in stream.read().decode("utf-8").splitlines() if line.strip()]
+
+
+class RawChunkParser(BaseParser):
+    media_type = "application/octet-stream"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream.read()
+
+
+class IsCuratorOrSuperuser(BasePermission):
+    """
+    is_staff is not enough - RDRF sets it for registering parents too
+    """
+
+    def has_permission(self, request, view):
+        user = request.user
+        return bool(user and user.is_authenticated and (user.is_superuser or user.is_curator))
+
+
+class IngestView(APIView):
+    authentication_classes = [SessionAuthentication, BasicAuthentication]
+    permission_classes = [IsCuratorOrSuperuser]
+
+
+class BatchIngestView(IngestView):
+    """
+    Takes one cde value record per line (JSON lines), returns a result per record
+    """
+    parser_classes = [JSONLinesParser]
+
+    def post(self, request, registry_code):
+        registry = get_object_or_404(Registry, code=registry_code)
+        lines = request.data
+        if len(lines) > MAX_BATCH_SIZE:
+            return Response({"error": f"at most {MAX_BATCH_SIZE} records per batch"},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        records, parse_errors = [], {}
+        for index, line in enumerate(lines):
+            try:
+                records.append(json.loads(line))
+            except ValueError as ex:
+                records.append(None)
+                parse_errors[index] = f"invalid json: {ex}"
+
+        results = [result.as_dict() for result in ingest_records(registry, records, request.user)]
+        for index, error in parse_errors.items():
+            results[index]["errors"] = [error]
+        return Response({
+            "ok": sum(result["status"] == "ok" for result in results),
+            "failed": sum(result["status"] != "ok" for result in results),
+            "results": results,
+        })
+
+
+class UploadView(IngestView):
+    """
+    GET returns the offset to resume an upload from, PUT appends the chunk
+    sent at ?offset=, POST completes the upload with the cde record as JSON
+    """
+    parser_classes = [RawChunkParser, JSONParser]
+
+    def get(self, request, registry_code, upload_id):
+        get_object_or_404(Registry, code=registry_code)
+        try:
+            return Response({"offset": upload_offset(registry_code, upload_id)})
+        except UploadError as ex:
+            return Response({"error": str(ex)}, status=status.HTTP_400_BAD_REQUEST)
+
+    def put(self, request, registry_code, upload_id):
+        get_object_or_404(Registry, code=registry_code)
+        try:
+            upload_offset(registry_code, upload_id)
+            offset = int(request.query_params.get("offset", 0))
+        except (UploadError, ValueError) as ex:
+            return Response({"error": str(ex)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            new_offset = append_chunk(registry_code, upload_id, offset, request.data)
+        except UploadError as ex:
+            return Response({"error": str(ex), "offset": upload_offset(registry_code, upload_id)},
+                            status=status.HTTP_409_CONFLICT)
+        return Response({"offset": new_offset})
+
+    def post(self, request, registry_code, upload_id):
+        registry = get_object_or_404(Registry, code=registry_code)
+        try:
+            result = complete_upload(registry, upload_id, request.data, request.user)
+        except UploadError as ex:
+            return Response({"error": str(ex)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result.as_dict(), status=status.HTTP_200_OK if result.ok else status.HTTP_400_BAD_REQUEST)
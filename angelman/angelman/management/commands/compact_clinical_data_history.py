@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from angelman.clinical_data.history import compact
+
+
+class Command(BaseCommand):
+    help = "Moves the ClinicalData history rows into the delta compressed history (snapshots plus diffs)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", help="only compact the history of this registry code")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="only report the space the compaction would save")
+
+    def handle(self, *args, **options):
+        count, original_size, compressed_size = compact(options["registry"], options["batch_size"],
+                                                        options["dry_run"])
+        action = "Would compact" if options["dry_run"] else "Compacted"
+        ratio = compressed_size / original_size if original_size else 1
+        self.stdout.write(f"{action} {count} history rows: {original_size} bytes -> {compressed_size} bytes "
+                          f"({ratio:.1%})")
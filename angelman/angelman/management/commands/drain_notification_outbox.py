@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from angelman.notifications.outbox import drain_batch
+
+
+class Command(BaseCommand):
+    help = "Sends the notifications queued in the notification outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--concurrency", type=int, default=4, help="notifications sent in parallel")
+        parser.add_argument("--max-attempts", type=int, default=8,
+                            help="attempts after which a notification is marked as failed")
+        parser.add_argument("--loop", action="store_true", help="keep polling the outbox instead of exiting")
+        parser.add_argument("--interval", type=float, default=5.0, help="seconds between polls when idle")
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = drain_batch(options["batch_size"], options["concurrency"], options["max_attempts"])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f"sent {sent}, failed {failed}")
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+        self.stdout.write(f"outbox drained: {total_sent} sent, {total_failed} failed")
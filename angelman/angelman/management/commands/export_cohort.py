@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.report.export import DEFAULT_CHUNK_SIZE, write_csv, write_parquet
+
+
+class Command(BaseCommand):
+    help = "Exports the clinical data of a registry chunk by chunk to a CSV or Parquet file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_file")
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+        parser.add_argument("--form", action="append", dest="forms", help="only export this form (repeatable)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        writer = write_parquet if options["format"] == "parquet" else write_csv
+        try:
+            writer(options["output_file"], options["registry"], options["forms"], options["chunk_size"])
+        except RuntimeError as ex:
+            raise CommandError(str(ex))
+        self.stdout.write(f"exported {options['registry']} to {options['output_file']}")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.benchmarks.synthetic import CohortGenerator
+from rdrf.models.definition.models import Registry
+
+
+class Command(BaseCommand):
+    help = "Adds a synthetic cohort of patients, with clinical data and consents, to a registry (not for production!)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("patients", type=int, help="number of patients to add")
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--chunk-size", type=int, default=200, help="families written per transaction")
+
+    def handle(self, *args, **options):
+        try:
+            generator = CohortGenerator(options["registry"], options["seed"], options["chunk_size"])
+        except Registry.DoesNotExist:
+            raise CommandError(f"Registry {options['registry']} does not exist")
+        patient_ids = generator.generate(options["patients"])
+        self.stdout.write(f"added {len(patient_ids)} synthetic patients to {options['registry']}")
@@ -0,0 +1,38 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.registry.groups.registration.bulk_import import FamilyImporter, read_rows
+from rdrf.models.definition.models import Registry
+
+
+class Command(BaseCommand):
+    help = "Enrols families in bulk from a CSV or JSON lines file with the fields of the registration form"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input_file", help=".csv file with a header row, or .jsonl file")
+        parser.add_argument("--registry", default="ang")
+        parser.add_argument("--chunk-size", type=int, default=200, help="families written per transaction")
+        parser.add_argument("--report", default="import_families_errors.csv",
+                            help="CSV file the rows which failed validation are reported to")
+        parser.add_argument("--dry-run", action="store_true", help="only validate the rows")
+
+    def handle(self, *args, **options):
+        try:
+            importer = FamilyImporter(options["registry"], options["chunk_size"], options["dry_run"])
+        except Registry.DoesNotExist:
+            raise CommandError(f"Registry {options['registry']} does not exist")
+
+        importer.run(read_rows(options["input_file"]))
+
+        with open(options["report"], "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["row", "field", "errors"])
+            for error in importer.errors:
+                for field, messages in error.errors.items():
+                    writer.writerow([error.row_number, field, json.dumps([m["message"] for m in messages])])
+
+        action = "validated" if options["dry_run"] else "imported"
+        self.stdout.write(f"{importer.imported} families {action}, {len(importer.errors)} rows rejected "
+                          f"(see {options['report']})")
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.definition.incremental import IncrementalImportError, incremental_import
+from angelman.definition.loader import load_registry_definition
+from rdrf.services.io.defs.importer import Importer, ImportState
+
+
+class Command(BaseCommand):
+    help = "Imports a registry definition yaml file, reusing the compiled definition cache when possible"
+
+    def add_arguments(self, parser):
+        parser.add_argument("yaml_file", help="registry definition, e.g. angelman.yaml")
+        parser.add_argument("--no-cache", action="store_true", help="always parse the yaml file")
+        parser.add_argument("--cache-dir", help="overrides settings.REGISTRY_DEFINITION_CACHE_DIR")
+        parser.add_argument("--incremental", action="store_true",
+                            help="only write the cdes, pvgs, sections, forms, consent sections and email "
+                                 "notifications which differ from the ones stored, deleting the consent "
+                                 "questions no longer in the definition")
+        parser.add_argument("--dry-run", action="store_true", help="with --incremental, only report the changes")
+
+    def handle(self, *args, **options):
+        yaml_file = options["yaml_file"]
+        try:
+            definition = load_registry_definition(yaml_file,
+                                                  use_cache=not options["no_cache"],
+                                                  cache_dir=options["cache_dir"])
+        except Exception as ex:
+            raise CommandError(f"Could not load {yaml_file}: {ex}")
+
+        if options["incremental"]:
+            self.import_changes(definition, options["dry_run"])
+        elif options["dry_run"]:
+            raise CommandError("--dry-run is only supported with --incremental")
+        else:
+            self.import_definition(yaml_file, definition)
+        action = "dry run - nothing imported for" if options["dry_run"] else "Imported"
+        self.stdout.write(f"{action} registry {definition.get('code')} "
+                          f"version {definition.get('REGISTRY_VERSION')} from {yaml_file}")
+
+    def import_definition(self, yaml_file, definition):
+        importer = Importer()
+        importer.yaml_data_file = yaml_file
+        importer.data = definition
+        importer.state = ImportState.LOADED
+        importer.create_registry()
+
+    def import_changes(self, definition, dry_run):
+        try:
+            diffs = incremental_import(definition, dry_run=dry_run)
+        except IncrementalImportError as ex:
+            raise CommandError(str(ex))
+
+        prefix = "dry run - " if dry_run else ""
+        for diff in diffs:
+            self.stdout.write(f"{prefix}{diff.entity_type}: {len(diff.created)} created, "
+                              f"{len(diff.updated)} updated, {len(diff.deleted)} deleted")
+            for action, keys in (("created", diff.created), ("updated", diff.updated), ("deleted", diff.deleted)):
+                for key in keys:
+                    self.stdout.write(f"    {action} {key}")
+            if diff.orphaned:
+                self.stdout.write(f"    {len(diff.orphaned)} no longer in the definition but kept: "
+                                  f"{', '.join(map(str, diff.orphaned))}")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.cohort.query import CohortQueryError, cohort, parse
+
+
+class Command(BaseCommand):
+    help = ("Lists the patients matching a cohort expression over cde values, e.g. "
+            "'cde(\"RegistrationDiagnosis\") in [\"A\", \"B\"] and 10 <= cde(\"6MoWeight\") < 20'")
+
+    def add_arguments(self, parser):
+        parser.add_argument("expression", help="cohort expression (see angelman.cohort.query)")
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--count", action="store_true", help="only print the number of matching patients")
+
+    def handle(self, *args, **options):
+        try:
+            q = parse(options["registry"], options["expression"])
+        except CohortQueryError as ex:
+            raise CommandError(str(ex))
+        patient_ids = cohort(options["registry"], q).order_by("pk")
+        if options["count"]:
+            self.stdout.write(str(patient_ids.count()))
+            return
+        for patient_id in patient_ids.iterator():
+            self.stdout.write(str(patient_id))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from angelman.patient_indexes import INDEXES, rebuild_patient_indexes
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the per patient tables derived from clinical data and consents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--only", action="append", choices=sorted(INDEXES), help="only rebuild this index")
+        parser.add_argument("--patient", action="append", type=int, dest="patients", help="only rebuild this patient")
+
+    def handle(self, *args, **options):
+        counts = rebuild_patient_indexes(options["registry"], options["patients"], options["only"])
+        for name, count in counts.items():
+            self.stdout.write(f"{name}: rebuilt {count} patients")
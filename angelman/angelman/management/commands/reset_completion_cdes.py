@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from angelman.definition.cache import definition_cache
+from angelman.models import FormCompletionStatus, PatientDashboardSummary
+from rdrf.models.definition.models import RegistryForm
+
+ALL_REGISTRIES = "all"
+
+
+class Command(BaseCommand):
+    help = "Clears the completion CDEs of every form of a registry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", default="ang",
+                            help=f'registry code, or "{ALL_REGISTRIES}" to reset the forms of every registry')
+        parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+
+    def handle(self, *args, **options):
+        registry_code = options["registry"]
+        completion_cdes = RegistryForm.complete_form_cdes.through.objects.all()
+        completion_statuses = FormCompletionStatus.objects.all()
+        summaries = PatientDashboardSummary.objects.all()
+        if registry_code != ALL_REGISTRIES:
+            completion_cdes = completion_cdes.filter(registryform__registry__code=registry_code)
+            completion_statuses = completion_statuses.filter(registry_code=registry_code)
+            summaries = summaries.filter(registry_code=registry_code)
+
+        if options["dry_run"]:
+            per_form = (completion_cdes.values("registryform__registry__code", "registryform__name")
+                        .annotate(cde_count=Count("id"))
+                        .order_by("registryform__registry__code", "registryform__name"))
+            total = 0
+            for row in per_form:
+                total += row["cde_count"]
+                self.stdout.write(f"would reset {row['cde_count']} completion cdes on "
+                                  f"{row['registryform__registry__code']}/{row['registryform__name']}")
+            self.stdout.write(f"dry run - {total} completion cdes would be removed")
+            return
+
+        # The bulk delete sends no m2m_changed signal, so the cached completion is dropped here
+        with transaction.atomic():
+            removed, __ = completion_cdes.delete()
+            completion_statuses.delete()
+            # no form has completion cdes left, so no module progress is shown
+            summaries.exclude(module_progress={}).update(module_progress={}, updated_at=timezone.now())
+            definition_cache.invalidate_on_commit()
+        self.stdout.write(f"removed {removed} completion cdes")
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from angelman.clinical_data.archive import KEY_FIELDS, BackupArchive, record_key
+from angelman.patient_indexes import rebuild_patient_indexes
+from rdrf.models.definition.models import ClinicalData
+
+
+class Command(BaseCommand):
+    help = "Restores ClinicalData documents from a backup archive written by a data migration"
+
+    def add_arguments(self, parser):
+        parser.add_argument("archive", help="path of the backup archive (.jsonl.gz)")
+        parser.add_argument("--patient", type=int, help="only restore the documents of this patient id")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="report what would be restored")
+
+    def handle(self, *args, **options):
+        archive = BackupArchive(options["archive"])
+        self.dry_run = options["dry_run"]
+        self.restored = 0
+        self.missing = 0
+
+        # A document may have been archived more than once (e.g. by a rerun
+        # after a restore); the newest copy is the one from before the last change
+        if options["patient"] is not None:
+            entries = archive.find(django_id=options["patient"])
+            if not entries:
+                raise CommandError(f"No backup of patient {options['patient']} in {archive.path}")
+            newest = {tuple(entry[:len(KEY_FIELDS)]): entry for entry in entries}
+            records = (archive.read(entry) for entry in newest.values())
+        else:
+            newest = {tuple(entry[:len(KEY_FIELDS)]): position for position, entry in enumerate(archive.index())}
+            records = (record for position, record in enumerate(archive)
+                       if newest.get(record_key(record)) == position)
+
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == options["batch_size"]:
+                self._restore_batch(batch)
+                batch = []
+        if batch:
+            self._restore_batch(batch)
+
+        action = "Would restore" if self.dry_run else "Restored"
+        self.stdout.write(f"{action} {self.restored} documents, {self.missing} not found")
+
+    def _restore_batch(self, batch):
+        records = {record_key(record): record for record in batch}
+        with transaction.atomic():
+            changed = []
+            for collection, registry_code, django_model in {key[:3] for key in records}:
+                django_ids = {key[3] for key in records if key[:3] == (collection, registry_code, django_model)}
+                qs = ClinicalData.objects.filter(collection=collection,
+                                                 registry_code=registry_code,
+                                                 django_model=django_model,
+                                                 django_id__in=django_ids)
+                for cd in qs.select_for_update():
+                    record = records.get((collection, registry_code, django_model, cd.django_id, cd.context_id))
+                    if record is not None:
+                        cd.data = record["data"]
+                        changed.append(cd)
+
+            self.missing += len(records) - len(changed)
+            self.restored += len(changed)
+            if not self.dry_run:
+                ClinicalData.objects.bulk_update(changed, ["data"])
+                # bulk_update sends no post_save
+                restored_patients = {}
+                for cd in changed:
+                    if cd.collection == "cdes" and cd.django_model == "Patient":
+                        restored_patients.setdefault(cd.registry_code, set()).add(cd.django_id)
+                for registry_code, patient_ids in restored_patients.items():
+                    rebuild_patient_indexes(registry_code, patient_ids)
+        self.stdout.write(f"batch of {len(batch)}: {len(changed)} documents matched")
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.benchmarks.suite import Suite
+from rdrf.models.definition.models import Registry
+
+
+class Command(BaseCommand):
+    help = ("Times registration, form load/save, dashboard, followup scheduling and report export against the "
+            "cohort in the database and writes latencies and query counts to a JSON file. To compare cohort "
+            "sizes, run generate_synthetic_cohort up to 1k, 10k and 100k patients and benchmark after each.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_file")
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--only", action="append", help="only run this benchmark (repeatable)")
+        parser.add_argument("--compare", help="JSON file of an earlier run to compare the p50 latencies with")
+
+    def handle(self, *args, **options):
+        try:
+            suite = Suite(options["registry"], options["iterations"], options["seed"])
+            results = suite.run(options["only"])
+        except Registry.DoesNotExist:
+            raise CommandError(f"Registry {options['registry']} does not exist")
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        with open(options["output_file"], "w") as f:
+            json.dump(results, f, indent=2)
+
+        previous = {}
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f).get("benchmarks", {})
+        for name, result in results["benchmarks"].items():
+            line = (f"{name}: p50 {result['p50_ms']:.1f}ms p99 {result['p99_ms']:.1f}ms, "
+                    f"{result['queries_mean']:.1f} queries")
+            if name in previous and previous[name].get("p50_ms"):
+                change = 100 * (result["p50_ms"] - previous[name]["p50_ms"]) / previous[name]["p50_ms"]
+                line += f" ({change:+.0f}% p50)"
+            self.stdout.write(line)
+        self.stdout.write(f"{results['patients']} patients - results written to {options['output_file']}")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from angelman.followups import due_patient_ids, send_reminders
+from rdrf.models.definition.models import LongitudinalFollowup, LongitudinalFollowupEntry
+
+
+class Command(BaseCommand):
+    help = "Schedules the longitudinal followups due for the patients of a registry and sends their reminders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="only report how many patients each followup would be sent to")
+        parser.add_argument("--rate", type=float, default=10, help="reminders per second, 0 for no limit")
+        parser.add_argument("--max-per-connection", type=int, default=100,
+                            help="reminders sent before the SMTP connection is reopened")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        followups = (LongitudinalFollowup.objects
+                     .filter(context_form_group__registry__code=options["registry"])
+                     .select_related("context_form_group__registry")
+                     .order_by("name"))
+        total = 0
+        for followup in followups:
+            patient_ids, in_sql = due_patient_ids(followup, now)
+            total += len(patient_ids)
+            self.stdout.write(f"{followup.name}: {len(patient_ids)} patients ({'sql' if in_sql else 'python'})")
+            if options["dry_run"] or not patient_ids:
+                continue
+            with transaction.atomic():
+                LongitudinalFollowupEntry.objects.bulk_create([
+                    LongitudinalFollowupEntry(longitudinal_followup=followup, patient_id=patient_id, send_at=now)
+                    for patient_id in patient_ids
+                ])
+        action = "would be scheduled" if options["dry_run"] else "scheduled"
+        self.stdout.write(f"{total} followups {action}")
+        if options["dry_run"]:
+            return
+
+        result = send_reminders(options["registry"], now,
+                                rate=options["rate"], max_per_connection=options["max_per_connection"])
+        self.stdout.write(f"{result.sent} reminders sent, {len(result.failed)} failed")
+        for index, error in result.failed:
+            self.stderr.write(f"reminder {index + 1}: {error}")
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from angelman.notifications.batch import BatchResult, render_messages, send_batch
+
+
+class Command(BaseCommand):
+    help = "Sends an email notification to the recipients listed in a JSON lines file of template data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("notification", help="description of the email notification, e.g. account-locked")
+        parser.add_argument("recipients_file", help='one JSON object of template data per line, optionally '
+                                                    'with "email" and "language"')
+        parser.add_argument("--registry", default="ang", help="registry code")
+        parser.add_argument("--rate", type=float, default=10, help="messages per second, 0 for no limit")
+        parser.add_argument("--max-per-connection", type=int, default=100,
+                            help="messages sent before the SMTP connection is reopened")
+        parser.add_argument("--dry-run", action="store_true", help="only render the messages")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["recipients_file"]) as f:
+                recipients = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as ex:
+            raise CommandError(f"Could not read {options['recipients_file']}: {ex}")
+
+        if options["dry_run"]:
+            result = BatchResult()
+            rendered = sum(1 for __ in render_messages(options["registry"], options["notification"],
+                                                      recipients, result))
+            self.stdout.write(f"dry run - {rendered} messages rendered")
+        else:
+            result = send_batch(options["registry"], options["notification"], recipients,
+                                rate=options["rate"], max_per_connection=options["max_per_connection"])
+            self.stdout.write(f"sent {result.sent} messages")
+        for index, error in result.failed:
+            self.stderr.write(f"line {index + 1}: {error}")
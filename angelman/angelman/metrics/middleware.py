@@ -0,0 +1,85 @@
+"""
+Request instrumentation.
+
+MetricsMiddleware records the latency, database query count and query time
+of every request, labelled by view. With settings.SLOW_REQUEST_LOG_MS set,
+requests slower than that are logged with the SQL they ran.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from angelman.definition.cache import definition_cache
+from angelman.metrics.registry import registry
+
+logger = logging.getLogger(__name__)
+
+# Statements kept for the slow request log
+MAX_CAPTURED_QUERIES = 50
+
+request_seconds = registry.histogram("angelman_request_seconds", "Request latency", ["view", "method", "status"])
+request_queries = registry.histogram("angelman_request_queries", "Database queries per request", ["view"],
+                                     buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+request_query_seconds = registry.counter("angelman_request_query_seconds_total",
+                                         "Time spent in database queries", ["view"])
+registry.gauge("angelman_definition_cache_hits", "Definition cache hits in this process",
+               lambda: definition_cache.hits)
+registry.gauge("angelman_definition_cache_misses", "Definition cache misses in this process",
+               lambda: definition_cache.misses)
+registry.gauge("angelman_definition_cache_hit_ratio", "Share of definition cache lookups which were hits",
+               lambda: definition_cache.hits / ((definition_cache.hits + definition_cache.misses) or 1))
+
+
+class QueryRecorder:
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.seconds += duration
+            if self.capture and len(self.queries) < MAX_CAPTURED_QUERIES:
+                self.queries.append((duration, sql))
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.view_name or match._func_path
+
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_request_ms = getattr(settings, "SLOW_REQUEST_LOG_MS", 0)
+
+    def __call__(self, request):
+        recorder = QueryRecorder(capture=bool(self.slow_request_ms))
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        view = _view_name(request)
+        request_seconds.observe(elapsed, view=view, method=request.method, status=response.status_code)
+        request_queries.observe(recorder.count, view=view)
+        request_query_seconds.inc(recorder.seconds, view=view)
+
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            statements = "\n".join(f"  {duration * 1000:.1f}ms {sql}" for duration, sql in recorder.queries)
+            logger.warning(f"Slow request {request.method} {request.path} ({view}): {elapsed * 1000:.0f}ms, "
+                           f"{recorder.count} queries in {recorder.seconds * 1000:.0f}ms\n{statements}")
+        registry.flush()
+        return response
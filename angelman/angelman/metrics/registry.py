@@ -0,0 +1,411 @@
+"""
+In process metrics in the Prometheus text format.
+
+Counters and histograms are kept per process. Under uwsgi a scrape of
+/metrics reaches one random worker, so with settings.METRICS_DIR set every
+process writes its values to a file of its own in that directory (at most
+every METRICS_FLUSH_SECONDS, from the request middleware, and at exit), and
+/metrics renders the sum over all the files. Gauges are read per process and
+labelled with the worker pid.
+
+The counters and histograms of processes which exited are folded into
+exited.json when /metrics is rendered, and their files removed, so the sums
+do not drop when a worker is recycled and a new process reusing a pid does
+not overwrite the values of the old one. The first uwsgi worker of a new
+master empties the directory.
+
+A Lambda invocation (AWS_LAMBDA_FUNCTION_NAME is set) cannot be scraped: there
+the flush writes the metrics to the log instead, unless METRICS_DIR is set.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+EXITED_FILE = "exited.json"
+LOCK_FILE = ".lock"
+# pid of the uwsgi master which last emptied the directory
+SERVER_FILE = "server"
+
+
+def _label_text(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for __, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, __), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots):
+        values = {}
+        for __, snapshot in snapshots:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        return values
+
+    @staticmethod
+    def to_snapshot(values):
+        return [[list(key), value] for key, value in values.items()]
+
+    def samples(self, values=None):
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_label_text(self.label_names, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """
+    A value read when the metrics are collected
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+    @staticmethod
+    def merge(snapshots):
+        return {(str(pid),): value for pid, value in snapshots}
+
+    def samples(self, values=None):
+        if values is None:
+            return [f"{self.name} {self.read()}"]
+        return [f"{self.name}{_label_text(['worker'], key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value, observations + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts), total, observations]
+                    for key, (counts, total, observations) in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots):
+        values = {}
+        for __, snapshot in snapshots:
+            for key, counts, total, observations in snapshot:
+                previous = values.get(tuple(key))
+                if previous is not None:
+                    counts = [a + b for a, b in zip(previous[0], counts)]
+                    total, observations = previous[1] + total, previous[2] + observations
+                values[tuple(key)] = (counts, total, observations)
+        return values
+
+    @staticmethod
+    def to_snapshot(values):
+        return [[list(key), list(counts), total, observations]
+                for key, (counts, total, observations) in values.items()]
+
+    def samples(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {key: (list(counts), total, observations)
+                          for key, (counts, total, observations) in self._values.items()}
+        lines = []
+        for key, (counts, total, observations) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_label_text(self.label_names, key, [('le', '+Inf')])} {observations}")
+            lines.append(f"{self.name}_sum{_label_text(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.label_names, key)} {observations}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._flushed_at = 0
+        # the process which wrote the metrics file, a forked process writes a file of its own
+        self._writer_pid = None
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name, documentation, read):
+        return self.register(Gauge(name, documentation, read))
+
+    def _local_text(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def _write_snapshot(self, directory):
+        pid = os.getpid()
+        path = os.path.join(directory, f"{pid}.json")
+        if self._writer_pid == pid:
+            _write_json(path, self.snapshot())
+            return
+        with _directory_lock(directory):
+            # a file with this pid was left by an exited process the pid is reused from
+            if os.path.exists(path):
+                self._fold(directory, [pid])
+            _write_json(path, self.snapshot())
+        self._writer_pid = pid
+
+    def flush(self, force=False):
+        """
+        Writes the metrics of this process to METRICS_DIR (or, in a Lambda invocation, to the log)
+        """
+        directory = getattr(settings, "METRICS_DIR", "")
+        in_lambda = bool(os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+        if not directory and not in_lambda:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < getattr(settings, "METRICS_FLUSH_SECONDS", 5):
+            return
+        self._flushed_at = now
+        if directory:
+            self._write_snapshot(directory)
+        else:
+            logger.info(f"Metrics of Lambda process {os.getpid()}:\n{self._local_text()}")
+
+    def _fold(self, directory, pids):
+        """
+        Adds the counters and histograms in the files of exited processes to
+        exited.json and removes the files; the caller holds the directory lock
+        """
+        exited_path = os.path.join(directory, EXITED_FILE)
+        snapshots = [(0, _read_json(exited_path) or {})]
+        snapshots.extend((pid, _read_json(_pid_path(directory, pid)) or {}) for pid in pids)
+        with self._lock:
+            metrics = [metric for metric in self._metrics.values() if not isinstance(metric, Gauge)]
+        exited = {}
+        for metric in metrics:
+            values = metric.merge((pid, snapshot[metric.name]) for pid, snapshot in snapshots
+                                  if metric.name in snapshot)
+            if values:
+                exited[metric.name] = metric.to_snapshot(values)
+        _write_json(exited_path, exited)
+        for pid in pids:
+            try:
+                os.remove(_pid_path(directory, pid))
+            except FileNotFoundError:
+                pass
+
+    def _fold_exited(self, directory):
+        with _directory_lock(directory):
+            exited = [pid for pid in _pids(directory) if not _running(pid)]
+            if exited:
+                self._fold(directory, exited)
+
+    def _snapshots(self, directory):
+        """
+        (pid, metric name -> snapshot) of every process which wrote its metrics, pid 0 for the exited ones
+        """
+        for pid in _pids(directory):
+            snapshot = _read_json(_pid_path(directory, pid))
+            if snapshot is not None:
+                yield pid, snapshot
+        exited = _read_json(os.path.join(directory, EXITED_FILE))
+        if exited is not None:
+            yield 0, exited
+
+    def clear_previous_run(self):
+        """
+        Empties METRICS_DIR in the first process of a new uwsgi master, so the
+        sums start again with the server; other processes, e.g. management
+        commands, leave it alone
+        """
+        directory = getattr(settings, "METRICS_DIR", "")
+        server_pid = _uwsgi_master_pid()
+        if not directory or server_pid is None:
+            return
+        with _directory_lock(directory):
+            server_path = os.path.join(directory, SERVER_FILE)
+            try:
+                with open(server_path) as f:
+                    if f.read().strip() == str(server_pid):
+                        return
+            except OSError:
+                pass
+            for file_name in os.listdir(directory):
+                if file_name != LOCK_FILE:
+                    os.remove(os.path.join(directory, file_name))
+            with open(server_path, "w") as f:
+                f.write(str(server_pid))
+
+    def render(self):
+        directory = getattr(settings, "METRICS_DIR", "")
+        if not directory:
+            return self._local_text()
+        self.flush(force=True)
+        self._fold_exited(directory)
+        snapshots = list(self._snapshots(directory))
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            values = metric.merge((pid, snapshot[metric.name]) for pid, snapshot in snapshots
+                                  if metric.name in snapshot)
+            lines.extend(metric.header())
+            lines.extend(metric.samples(values))
+        return "\n".join(lines) + "\n"
+
+
+def _pid_path(directory, pid):
+    return os.path.join(directory, f"{pid}.json")
+
+
+def _pids(directory):
+    for file_name in os.listdir(directory):
+        pid, extension = os.path.splitext(file_name)
+        if extension == ".json" and pid.isdigit():
+            yield int(pid)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        logger.warning(f"Skipped the metrics file {path}: {ex}")
+        return None
+
+
+def _write_json(path, value):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(f"{path}.tmp", path)
+
+
+@contextmanager
+def _directory_lock(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _uwsgi_master_pid():
+    try:
+        import uwsgi
+    except ImportError:
+        return None
+    return uwsgi.masterpid()
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+atexit.register(registry.flush, force=True)
+
+span_seconds = registry.histogram("angelman_span_seconds", "Duration of instrumented code spans", ["span"])
+
+
+@contextmanager
+def span(name):
+    with span_seconds.time(span=name):
+        yield
+
+
+def timed(name):
+    """
+    Decorator version of span()
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,29 @@
+import time
+
+from django.db.models.signals import post_init, post_save, pre_save
+
+from angelman.metrics.registry import registry, span_seconds
+from rdrf.models.definition.models import ClinicalData
+
+clinical_data_loaded = registry.counter("angelman_clinical_data_loaded_total", "ClinicalData documents loaded")
+
+
+def clinical_data_initialised(sender, instance, **kwargs):
+    if instance.pk is not None:
+        clinical_data_loaded.inc()
+
+
+def clinical_data_saving(sender, instance, **kwargs):
+    instance._metrics_save_started = time.perf_counter()
+
+
+def clinical_data_saved(sender, instance, **kwargs):
+    started = getattr(instance, "_metrics_save_started", None)
+    if started is not None:
+        span_seconds.observe(time.perf_counter() - started, span="clinical_data.save")
+
+
+def connect_signals():
+    post_init.connect(clinical_data_initialised, sender=ClinicalData, dispatch_uid="angelman_metrics_cd_loaded")
+    pre_save.connect(clinical_data_saving, sender=ClinicalData, dispatch_uid="angelman_metrics_cd_saving")
+    post_save.connect(clinical_data_saved, sender=ClinicalData, dispatch_uid="angelman_metrics_cd_saved")
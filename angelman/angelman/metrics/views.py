@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from angelman.metrics.registry import registry
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics_view(request):
+    """
+    The metrics of all workers (of this process without settings.METRICS_DIR), for a scraper holding
+    settings.METRICS_TOKEN or a staff user
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    authorised = (token and constant_time_compare(authorization, f"Bearer {token}")) or request.user.is_staff
+    if not authorised:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
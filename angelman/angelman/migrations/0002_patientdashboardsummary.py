@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_dashboard_summaries(apps, schema_editor):
+    # the summaries are derived data: build them with the code which maintains
+    # them, as "django-admin rebuild_patient_indexes --only dashboard" does
+    from angelman.patient_indexes import rebuild_patient_indexes
+
+    Registry = apps.get_model('rdrf', 'Registry')
+    for registry_code in Registry.objects.values_list('code', flat=True):
+        rebuild_patient_indexes(registry_code, only=['dashboard'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '__first__'),
+        ('rdrf', '__first__'),
+        ('angelman', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientDashboardSummary',
+            fields=[
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dashboard_summary', serialize=False, to='patients.patient')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('cde_values', models.JSONField(default=dict)),
+                ('module_progress', models.JSONField(default=dict)),
+                ('consents', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_dashboard_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_consent_answers(apps, schema_editor):
+    # the index is derived data: build it with the code which maintains it,
+    # as "django-admin rebuild_patient_indexes --only consents" does
+    from angelman.patient_indexes import rebuild_patient_indexes
+
+    Registry = apps.get_model('rdrf', 'Registry')
+    for registry_code in Registry.objects.values_list('code', flat=True):
+        rebuild_patient_indexes(registry_code, only=['consents'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '__first__'),
+        ('rdrf', '__first__'),
+        ('angelman', '0002_patientdashboardsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientConsentAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('section_code', models.CharField(max_length=100)),
+                ('question_code', models.CharField(max_length=100)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='consent_answers', to='patients.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['registry_code', 'section_code', 'question_code', 'patient'], name='ang_consent_answer_q_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='patientconsentanswer',
+            constraint=models.UniqueConstraint(fields=('patient', 'registry_code', 'section_code', 'question_code'), name='ang_consent_answer_unique'),
+        ),
+        migrations.RunPython(backfill_consent_answers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '__first__'),
+        ('rdrf', '__first__'),
+        ('angelman', '0003_patientconsentanswer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FormCompletionStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('form_name', models.CharField(max_length=80)),
+                ('filled', models.PositiveIntegerField(default=0)),
+                ('required', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('context', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rdrf.rdrfcontext')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='form_completion', to='patients.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['registry_code', 'form_name'], name='ang_form_completion_form_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='formcompletionstatus',
+            constraint=models.UniqueConstraint(fields=('patient', 'context', 'form_name'), name='ang_form_completion_unique'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_cde_value_index(apps, schema_editor):
+    # the index is derived data: build it with the code which maintains it,
+    # as "django-admin rebuild_patient_indexes --only cde_values" does
+    from angelman.patient_indexes import rebuild_patient_indexes
+
+    Registry = apps.get_model('rdrf', 'Registry')
+    for registry_code in Registry.objects.values_list('code', flat=True):
+        rebuild_patient_indexes(registry_code, only=['cde_values'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '__first__'),
+        ('rdrf', '__first__'),
+        ('angelman', '0004_formcompletionstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CdeValueIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('form_name', models.CharField(max_length=80)),
+                ('section_code', models.CharField(max_length=100)),
+                ('cde_code', models.CharField(max_length=100)),
+                ('item', models.PositiveIntegerField(default=0)),
+                ('value', models.CharField(max_length=255)),
+                ('number', models.FloatField(null=True)),
+                ('context', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rdrf.rdrfcontext')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cde_values', to='patients.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['registry_code', 'cde_code', 'value'], name='ang_cde_value_idx'), models.Index(fields=['registry_code', 'cde_code', 'number'], name='ang_cde_value_number_idx'), models.Index(fields=['patient', 'context'], name='ang_cde_value_document_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_cde_value_index, migrations.RunPython.noop),
+    ]
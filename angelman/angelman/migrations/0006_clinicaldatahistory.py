@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('angelman', '0005_cdevalueindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinicalDataHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('registry_code', models.CharField(max_length=10)),
+                ('django_model', models.CharField(max_length=80)),
+                ('django_id', models.IntegerField()),
+                ('context_id', models.IntegerField(null=True)),
+                ('version', models.PositiveIntegerField()),
+                ('snapshot', models.BooleanField(default=False)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='clinicaldatahistory',
+            constraint=models.UniqueConstraint(condition=models.Q(('context_id__isnull', False)), fields=('registry_code', 'django_model', 'django_id', 'context_id', 'version'), name='ang_cd_history_version_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='clinicaldatahistory',
+            constraint=models.UniqueConstraint(condition=models.Q(('context_id__isnull', True)), fields=('registry_code', 'django_model', 'django_id', 'version'), name='ang_cd_history_no_context_version_unique'),
+        ),
+    ]
@@ -0,0 +1,166 @@
+from django.db import models
+from django.utils import timezone
+
+
+class NotificationOutbox(models.Model):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    )
+
+    registry_code = models.CharField(max_length=10)
+    event_type = models.CharField(max_length=80)
+    template_data = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"], name="ang_outbox_due_idx")]
+
+    def __str__(self):
+        return f"{self.event_type} for {self.registry_code} ({self.status})"
+
+
+class PatientDashboardSummary(models.Model):
+    """
+    What the registry dashboard widgets show for a patient, kept up to date by
+    angelman.dashboard.signals when clinical data or consents are saved
+    """
+    patient = models.OneToOneField("patients.Patient", on_delete=models.CASCADE, primary_key=True,
+                                   related_name="dashboard_summary")
+    registry_code = models.CharField(max_length=10)
+    # cde code -> {"value": ..., "context_id": ...}
+    cde_values = models.JSONField(default=dict)
+    # form name -> percentage of its completion cdes filled in
+    module_progress = models.JSONField(default=dict)
+    # consent section code -> whether all its questions are answered yes
+    consents = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Dashboard summary of patient {self.patient_id}"
+
+
+class PatientConsentAnswer(models.Model):
+    """
+    One row per consent question a patient answered yes to, kept in sync with
+    ConsentValue by angelman.consents.signals so consent checks are a join
+    """
+    patient = models.ForeignKey("patients.Patient", on_delete=models.CASCADE, related_name="consent_answers")
+    registry_code = models.CharField(max_length=10)
+    section_code = models.CharField(max_length=100)
+    question_code = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["patient", "registry_code", "section_code", "question_code"],
+                                    name="ang_consent_answer_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["registry_code", "section_code", "question_code", "patient"],
+                         name="ang_consent_answer_q_idx"),
+        ]
+
+    def __str__(self):
+        return f"Patient {self.patient_id} consented to {self.registry_code}.{self.section_code}.{self.question_code}"
+
+
+class FormCompletionStatus(models.Model):
+    """
+    How many of the completion cdes of a form a patient filled in, per context,
+    computed when the clinical data is saved
+    """
+    patient = models.ForeignKey("patients.Patient", on_delete=models.CASCADE, related_name="form_completion")
+    context = models.ForeignKey("rdrf.RDRFContext", on_delete=models.CASCADE, related_name="+")
+    registry_code = models.CharField(max_length=10)
+    form_name = models.CharField(max_length=80)
+    filled = models.PositiveIntegerField(default=0)
+    required = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["patient", "context", "form_name"], name="ang_form_completion_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["registry_code", "form_name"], name="ang_form_completion_form_idx"),
+        ]
+
+    @property
+    def percentage(self):
+        return round(100 * self.filled / self.required) if self.required else 0
+
+    def __str__(self):
+        return f"{self.form_name} of patient {self.patient_id} in context {self.context_id}: {self.percentage}%"
+
+
+class CdeValueIndex(models.Model):
+    """
+    One row per value of a cde in the clinical data of a patient context (one
+    per item of multiple sections and per value of multi valued cdes), kept in
+    sync with ClinicalData by angelman.cohort.signals so cohorts are selected
+    with index lookups instead of reading the documents
+    """
+    patient = models.ForeignKey("patients.Patient", on_delete=models.CASCADE, related_name="cde_values")
+    context = models.ForeignKey("rdrf.RDRFContext", null=True, on_delete=models.CASCADE, related_name="+")
+    registry_code = models.CharField(max_length=10)
+    form_name = models.CharField(max_length=80)
+    section_code = models.CharField(max_length=100)
+    cde_code = models.CharField(max_length=100)
+    # item of a multiple section, 0 for single sections
+    item = models.PositiveIntegerField(default=0)
+    # the value as text (dates as YYYY-MM-DD), cut to the column length
+    value = models.CharField(max_length=255)
+    # the value of numeric cdes
+    number = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["registry_code", "cde_code", "value"], name="ang_cde_value_idx"),
+            models.Index(fields=["registry_code", "cde_code", "number"], name="ang_cde_value_number_idx"),
+            models.Index(fields=["patient", "context"], name="ang_cde_value_document_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.cde_code} = {self.value} for patient {self.patient_id} in context {self.context_id}"
+
+
+class ClinicalDataHistory(models.Model):
+    """
+    A version of the history of a ClinicalData document: the whole history
+    record for snapshots, a list of diff operations against the previous
+    version otherwise (see angelman.clinical_data.history)
+    """
+    registry_code = models.CharField(max_length=10)
+    django_model = models.CharField(max_length=80)
+    django_id = models.IntegerField()
+    context_id = models.IntegerField(null=True)
+    version = models.PositiveIntegerField()
+    snapshot = models.BooleanField(default=False)
+    data = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # NULLs are distinct in a unique constraint, documents without a context need their own
+        constraints = [
+            models.UniqueConstraint(fields=["registry_code", "django_model", "django_id", "context_id", "version"],
+                                    condition=models.Q(context_id__isnull=False),
+                                    name="ang_cd_history_version_unique"),
+            models.UniqueConstraint(fields=["registry_code", "django_model", "django_id", "version"],
+                                    condition=models.Q(context_id__isnull=True),
+                                    name="ang_cd_history_no_context_version_unique"),
+        ]
+
+    def __str__(self):
+        kind = "snapshot" if self.snapshot else "diff"
+        return f"{self.django_model} {self.django_id} context {self.context_id} version {self.version} ({kind})"
@@ -0,0 +1,127 @@
+"""
+Batch delivery of an email notification to many recipients.
+
+Messages are rendered with the compiled notification templates and sent
+over one SMTP connection, reopened every max_per_connection messages, at no
+more than rate messages per second. The connection comes from Django's
+EMAIL_BACKEND / EMAIL_HOST settings, so a local SMTP stand-in such as
+
+    python -m aiosmtpd -n -l localhost:1025
+
+(with EMAIL_HOST=localhost and EMAIL_PORT=1025) receives everything during testing.
+
+Every enabled notification with the description is sent to each recipient;
+the members of a notification's group recipient get a blind copy.
+"""
+import logging
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+
+from angelman.metrics.registry import span
+from angelman.notifications.templates import NotificationTemplateMissing, get_compiled_notifications
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult:
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+
+    def fail(self, index, error):
+        self.failed.append((index, str(error)))
+
+
+class _RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self.next_at:
+            time.sleep(self.next_at - now)
+        self.next_at = max(now, self.next_at) + self.interval
+
+
+def _group_emails(registry_code, group_id, cache):
+    if group_id not in cache:
+        cache[group_id] = sorted(set(get_user_model().objects.filter(
+            groups__pk=group_id, registry__code=registry_code, is_active=True,
+        ).exclude(email="").values_list("email", flat=True)))
+    return cache[group_id]
+
+
+def _language(template_data):
+    # the preferred language of the parent a registration notification goes to
+    user = getattr(template_data.get("parent"), "user", None)
+    return template_data.get("language") or getattr(user, "preferred_language", None)
+
+
+def render_messages(registry_code, description, recipients, result):
+    """
+    Yields (index, EmailMessage) for recipients given as dicts of template
+    data, with an optional "language" (otherwise the parent's preferred
+    language), one message per notification with the description; the
+    address comes from the notification's recipient template unless the dict
+    has an "email"
+    """
+    group_emails = {}
+    for index, template_data in enumerate(recipients):
+        try:
+            notifications = get_compiled_notifications(registry_code, description, _language(template_data))
+        except NotificationTemplateMissing as ex:
+            result.fail(index, ex)
+            continue
+        for compiled in notifications:
+            try:
+                rendered = compiled.render(template_data)
+                to = template_data.get("email") or rendered["recipient"]
+                bcc = (_group_emails(registry_code, compiled.group_recipient_id, group_emails)
+                       if compiled.group_recipient_id else [])
+                if not to and not bcc:
+                    raise ValueError("no recipient address")
+                message = EmailMessage(rendered["subject"], rendered["body"], compiled.email_from,
+                                       [to] if to else [], bcc=bcc)
+                message.content_subtype = "html"
+                yield index, message
+            except Exception as ex:
+                # a template or recipient that fails to render only fails this recipient
+                logger.warning(f"Rendering {description} for recipient {index} failed: {ex}")
+                result.fail(index, ex)
+
+
+def send_batch(registry_code, description, recipients, rate=10, max_per_connection=100, connection=None):
+    result = BatchResult()
+    limiter = _RateLimiter(rate)
+    connection = connection or get_connection()
+    sent_on_connection = 0
+    connection.open()
+    try:
+        for index, message in render_messages(registry_code, description, recipients, result):
+            if sent_on_connection == max_per_connection:
+                connection.close()
+                connection.open()
+                sent_on_connection = 0
+            limiter.wait()
+            try:
+                with span("notification.send"):
+                    result.sent += connection.send_messages([message]) or 0
+                sent_on_connection += 1
+            except Exception as ex:
+                logger.warning(f"Sending {description} to {message.to} failed: {ex}")
+                result.fail(index, ex)
+                # the connection may be unusable after an SMTP error
+                connection.close()
+                connection.open()
+                sent_on_connection = 0
+    finally:
+        connection.close()
+    logger.info(f"Sent {result.sent} {description} notifications, {len(result.failed)} failed")
+    return result
@@ -0,0 +1,158 @@
+"""
+Durable outbox for notifications.
+
+enqueue_notification() stores the event in the NotificationOutbox table, in
+the caller's transaction, instead of rendering and sending the email there
+and then. The drain_notification_outbox command sends the stored events in
+batches, retrying failures with exponential backoff. The messages are
+rendered with the compiled notification templates and each worker sends its
+share of a batch over one mail connection.
+
+Model instances in the template data are stored as references and fetched
+again when the notification is sent.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.mail import get_connection
+from django.db import close_old_connections, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from angelman.metrics.registry import span
+from angelman.models import NotificationOutbox
+from angelman.notifications.batch import BatchResult, render_messages
+
+logger = logging.getLogger(__name__)
+
+MODEL_REFERENCE = "__model__"
+
+# How long a claimed batch is reserved for the worker that claimed it
+CLAIM_TIMEOUT = timedelta(minutes=10)
+BACKOFF_BASE = timedelta(minutes=1)
+BACKOFF_MAX = timedelta(hours=6)
+
+
+class NotificationNotSent(Exception):
+    pass
+
+
+def _serialise(value):
+    if isinstance(value, models.Model):
+        return {MODEL_REFERENCE: value._meta.label_lower, "pk": value.pk}
+    if isinstance(value, dict):
+        return {key: _serialise(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_serialise(v) for v in value]
+    return value
+
+
+def _deserialise(value):
+    if isinstance(value, dict):
+        if MODEL_REFERENCE in value:
+            return apps.get_model(value[MODEL_REFERENCE]).objects.get(pk=value["pk"])
+        return {key: _deserialise(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [_deserialise(v) for v in value]
+    return value
+
+
+def enqueue_notification(registry_code, event_type, template_data):
+    return NotificationOutbox.objects.create(
+        registry_code=registry_code,
+        event_type=event_type,
+        template_data=_serialise(template_data),
+    )
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+def claim_batch(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        due = (NotificationOutbox.objects
+               .filter(Q(status=NotificationOutbox.PENDING) | Q(status=NotificationOutbox.SENDING),
+                       next_attempt_at__lte=now)
+               .order_by("next_attempt_at", "id")
+               .select_for_update(skip_locked=True))
+        batch = list(due[:batch_size])
+        for entry in batch:
+            entry.status = NotificationOutbox.SENDING
+            entry.next_attempt_at = now + CLAIM_TIMEOUT
+        NotificationOutbox.objects.bulk_update(batch, ["status", "next_attempt_at"])
+    return batch
+
+
+def _send(entry, connection):
+    try:
+        with span("notification.send"):
+            result = BatchResult()
+            template_data = _deserialise(entry.template_data)
+            messages = [message for __, message in
+                        render_messages(entry.registry_code, entry.event_type, [template_data], result)]
+            if result.failed:
+                raise NotificationNotSent(result.failed[0][1])
+            connection.open()
+            for message in messages:
+                if not connection.send_messages([message]):
+                    raise NotificationNotSent(f"{entry.event_type} notification to {message.to} not sent")
+        return entry, None
+    except Exception as ex:
+        logger.exception(f"Sending outbox notification {entry.pk} failed")
+        # the connection may be unusable after an SMTP error, the next entry reopens it
+        connection.close()
+        return entry, ex
+
+
+def _send_entries(entries):
+    connection = get_connection()
+    try:
+        return [_send(entry, connection) for entry in entries]
+    finally:
+        connection.close()
+
+
+def _send_in_thread(entries):
+    try:
+        return _send_entries(entries)
+    finally:
+        # the pool threads have database connections of their own
+        close_old_connections()
+
+
+def drain_batch(batch_size=50, concurrency=4, max_attempts=8):
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0, 0
+
+    if concurrency > 1:
+        shares = [share for share in (batch[start::concurrency] for start in range(concurrency)) if share]
+        with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+            results = [result for share_results in pool.map(_send_in_thread, shares) for result in share_results]
+    else:
+        results = _send_entries(batch)
+
+    now = timezone.now()
+    sent = failed = 0
+    for entry, error in results:
+        entry.attempts += 1
+        if error is None:
+            entry.status = NotificationOutbox.SENT
+            entry.sent_at = now
+            entry.last_error = ""
+            sent += 1
+        else:
+            entry.last_error = str(error)
+            if entry.attempts >= max_attempts:
+                entry.status = NotificationOutbox.FAILED
+            else:
+                entry.status = NotificationOutbox.PENDING
+                entry.next_attempt_at = now + backoff(entry.attempts)
+            failed += 1
+    NotificationOutbox.objects.bulk_update(
+        [entry for entry, __ in results], ["status", "attempts", "sent_at", "last_error", "next_attempt_at"])
+    return sent, failed
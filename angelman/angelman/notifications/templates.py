@@ -0,0 +1,87 @@
+"""
+Compiled email notification templates.
+
+The subject, body and recipient templates of the enabled email
+notifications with a description are compiled once per (registry,
+description, language) and reused until the registry definition changes (the
+generation of the definition cache moves on when EmailNotification or
+EmailTemplate rows are saved). A description can have several notifications,
+e.g. one to the patient's parent and one to a group of curators; all of them
+are sent.
+"""
+import logging
+import threading
+
+from django.template import Context, engines
+
+from angelman.definition.cache import definition_cache
+from rdrf.models.definition.models import EmailNotification
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANGUAGE = "en"
+
+
+class NotificationTemplateMissing(Exception):
+    pass
+
+
+class CompiledNotification:
+
+    def __init__(self, email_notification, email_template):
+        engine = engines["django"].engine
+        self.email_from = email_notification.email_from
+        self.group_recipient_id = email_notification.group_recipient_id
+        self.language = email_template.language
+        self.subject = engine.from_string(email_template.subject)
+        self.body = engine.from_string(email_template.body)
+        self.recipient = engine.from_string(email_notification.recipient or "")
+
+    def render(self, template_data):
+        context = Context(template_data, autoescape=False)
+        return {
+            "subject": " ".join(self.subject.render(context).split()),
+            "body": self.body.render(Context(template_data)),
+            "recipient": self.recipient.render(context).strip(),
+        }
+
+
+_compiled = {}
+_compiled_generation = None
+_lock = threading.Lock()
+
+
+def _compile(registry_code, description, language):
+    email_notifications = (EmailNotification.objects
+                           .filter(registry__code=registry_code, description=description, disabled=False)
+                           .prefetch_related("email_templates")
+                           .order_by("pk"))
+    compiled = []
+    for email_notification in email_notifications:
+        templates = {template.language: template for template in email_notification.email_templates.all()}
+        template = templates.get(language) or templates.get(DEFAULT_LANGUAGE)
+        if template is not None:
+            compiled.append(CompiledNotification(email_notification, template))
+    if not compiled:
+        raise NotificationTemplateMissing(f"No enabled {description} notification with a {language} template")
+    return tuple(compiled)
+
+
+def get_compiled_notifications(registry_code, description, language=DEFAULT_LANGUAGE):
+    """
+    The CompiledNotification of every enabled notification with the description
+    """
+    global _compiled, _compiled_generation
+    generation = definition_cache.generation
+    key = (registry_code, description, language or DEFAULT_LANGUAGE)
+    with _lock:
+        if generation != _compiled_generation:
+            _compiled, _compiled_generation = {}, generation
+        compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compile(*key)
+        with _lock:
+            if generation == _compiled_generation:
+                _compiled[key] = compiled
+        logger.debug(f"Compiled the {description} notification templates for {registry_code}/{key[2]}")
+    return compiled
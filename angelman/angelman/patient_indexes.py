@@ -0,0 +1,24 @@
+"""
+The per patient tables derived from clinical data and consents.
+
+Signals keep them up to date on saves; bulk writes, which send no signals,
+rebuild them for the patients they wrote.
+"""
+from angelman.cohort import index as cde_value_index
+from angelman.consents import index as consent_index
+from angelman.dashboard import completion, summary
+
+# name -> function rebuilding that index for a registry (and optionally some patients)
+INDEXES = {
+    "cde_values": cde_value_index.rebuild,
+    "completion": completion.rebuild,
+    "consents": consent_index.rebuild,
+    "dashboard": summary.rebuild,
+}
+
+
+def rebuild_patient_indexes(registry_code, patient_ids=None, only=None):
+    """
+    Rebuilds the indexes (all, or the names in only), returns index name -> number of patients rebuilt
+    """
+    return {name: INDEXES[name](registry_code, patient_ids) for name in only or INDEXES}
@@ -0,0 +1,64 @@
+"""
+Patient listing of a registry for the signed in user.
+
+Superusers see every patient of the registry, parents their own children and
+other users the patients of their working groups; the consent rules of the
+user's groups are then applied as EXISTS filters on the consent index (see
+angelman.consents.index), so the listing is one query whatever the size of
+the cohort. The clinician and curator listing of RDRF gets the same filters
+through ConsentFilteredPatientsListingView.
+"""
+from django.shortcuts import get_object_or_404
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from angelman.consents.index import filter_by_consent_rules
+from rdrf.models.definition.models import Registry
+from rdrf.views.patients_listing import PatientsListingView
+from registry.patients.models import ParentGuardian, Patient
+
+PATIENT_FIELDS = ("id", "given_names", "family_name", "date_of_birth", "sex")
+
+
+class PatientPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
+def visible_patients(user, registry, capability="see_patient"):
+    """
+    The Patient queryset of the registry the user may see
+    """
+    patients = Patient.objects.filter(rdrf_registry=registry)
+    if user.is_superuser:
+        return patients
+    parent = ParentGuardian.objects.filter(user=user).first()
+    if parent is not None:
+        patients = patients.filter(pk__in=parent.patient.values("pk"))
+    else:
+        patients = patients.filter(working_groups__in=user.working_groups.all()).distinct()
+    return filter_by_consent_rules(patients, user, registry, capability)
+
+
+class ConsentFilteredPatientsListingView(PatientsListingView):
+    """
+    The RDRF patients listing with the consent rules applied in the query
+    """
+
+    def filter_by_user_group(self):
+        super().filter_by_user_group()
+        self.patients = filter_by_consent_rules(self.patients, self.user, self.registry_model)
+
+
+class PatientListView(APIView):
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, registry_code):
+        registry = get_object_or_404(Registry, code=registry_code)
+        patients = visible_patients(request.user, registry).order_by("family_name", "given_names", "pk")
+        paginator = PatientPagination()
+        page = paginator.paginate_queryset(patients.values(*PATIENT_FIELDS), request, view=self)
+        return paginator.get_paginated_response(page)
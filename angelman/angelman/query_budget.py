@@ -0,0 +1,43 @@
+import logging
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget:
+    """
+    Counts the database queries run inside the block and reports when they
+    exceed the budget: a warning is logged, or QueryBudgetExceeded is raised
+    when settings.QUERY_BUDGET_STRICT is set (as it is in the test settings).
+    """
+
+    def __init__(self, name, budget, using=DEFAULT_DB_ALIAS):
+        self.name = name
+        self.budget = budget
+        self.using = using
+        self.count = 0
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connections[self.using].execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._wrapper.__exit__(exc_type, exc_value, tb)
+        if exc_type is not None or self.count <= self.budget:
+            return
+        msg = f"{self.name} ran {self.count} queries, over its budget of {self.budget}"
+        if getattr(settings, "QUERY_BUDGET_STRICT", False):
+            raise QueryBudgetExceeded(msg)
+        logger.warning(msg)
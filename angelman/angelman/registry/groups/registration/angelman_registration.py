@@ -1,14 +1,21 @@
 import logging
 from operator import itemgetter
 
+from django.conf import settings
+from django.db import transaction
 from django.utils.translation import get_language
 
+from angelman.clinical_data.partial import CdeWrite, set_cde_values
+from angelman.definition.cache import definition_cache
+from angelman.metrics.registry import span
+from angelman.notifications.outbox import enqueue_notification
+from angelman.query_budget import QueryBudget
 from rdrf.events.events import EventType
 from rdrf.models.definition.models import CommonDataElement, ContextFormGroup, RDRFContext
 from rdrf.services.io.notifications.email_notification import process_notification
 
 from registration.models import RegistrationProfile
-from registry.patients.models import ParentGuardian, PatientAddress, AddressType
+from registry.patients.models import ParentGuardian, Patient, PatientAddress, AddressType
 from registry.groups import GROUPS
 
 
@@ -25,53 +32,114 @@ DIAGNOSIS_CDE = dict(
     cde_code='RegistrationDiagnosis',
 )
 
+# Upper bound of the queries a registration should take once the definition cache is warm
+REGISTRATION_QUERY_BUDGET = 40
 
-class AngelmanRegistration(BaseRegistration):
 
-    def process(self, user):
-        registry_code = self.form.cleaned_data['registry_code']
-        registry = self._get_registry_object(registry_code)
+def get_diagnosis_options():
+    """
+    The permitted values of the diagnosis CDE, or None when the CDE does not exist
+    """
+    def load():
+        cde = CommonDataElement.objects.filter(code=DIAGNOSIS_CDE['cde_code']).select_related('pv_group').first()
+        if cde is None:
+            return None
+        return cde.pv_group.options if cde.pv_group else []
 
-        user = self.update_django_user(user, registry)
+    return definition_cache.get('registration:diagnosis_options', load)
 
-        working_group = self._get_unallocated_working_group(registry)
-        user.working_groups.set([working_group])
-        user.save()
 
-        logger.info(f"Registration process - created user {user.username}")
-        patient = self._create_patient(registry, working_group, user, set_link_to_user=False)
-        logger.info(f"Registration process - created patient {patient}")
-        patient.home_phone = self.form.cleaned_data["phone_number"]
-        patient.save(update_fields=['home_phone'])
+def get_address_type(address_type):
+    address_type_obj = definition_cache.get(f'registration:address_type:{address_type}',
+                                            lambda: AddressType.objects.filter(type=address_type).first())
+    if address_type_obj is None:
+        # not cached: the transaction creating it may still roll back
+        address_type_obj, created = AddressType.objects.get_or_create(type=address_type)
+    return address_type_obj
 
-        self._save_diagnosis(registry, patient)
 
-        address = self._create_patient_address(patient)
-        address.save()
-        logger.info("Registration process - created patient address")
+def get_context_form_group(code):
+    return definition_cache.get(f'registration:context_form_group:{code}',
+                                lambda: ContextFormGroup.objects.get(code=code))
 
-        parent_guardian = self._create_parent()
 
-        parent_guardian.patient.add(patient)
-        parent_guardian.user = user
-        parent_guardian.save()
-        logger.info(f"Registration process - created parent {parent_guardian}")
+class AngelmanRegistration(BaseRegistration):
 
-        registration = RegistrationProfile.objects.get(user=user)
-        template_data = {
-            "patient": patient,
-            "parent": parent_guardian,
-            "registration": registration,
-            "activation_url": self.get_registration_activation_url(registration),
-        }
+    def process(self, user):
+        registry_code = self.form.cleaned_data['registry_code']
+        registry = self._get_registry_object(registry_code)
 
-        process_notification(registry_code, EventType.NEW_PATIENT_USER_REGISTERED, template_data)
+        with span("registration"), transaction.atomic(), QueryBudget("registration", REGISTRATION_QUERY_BUDGET):
+            with span("registration.user"):
+                user = self.update_django_user(user, registry)
+
+                working_group = self._get_unallocated_working_group(registry)
+                user.working_groups.set([working_group])
+                # setup_django_user sets the names, is_staff and the language without saving them
+                user.save()
+            logger.info(f"Registration process - created user {user.username}")
+
+            with span("registration.patient"):
+                patient = self._create_patient(registry, working_group, user, set_link_to_user=False)
+            logger.info(f"Registration process - created patient {patient}")
+
+            with span("registration.diagnosis"):
+                self._save_diagnosis(registry, patient)
+
+            with span("registration.address"):
+                self._create_patient_address(patient)
+            logger.info("Registration process - created patient address")
+
+            with span("registration.parent"):
+                parent_guardian = self._create_parent(user)
+                parent_guardian.patient.add(patient)
+            logger.info(f"Registration process - created parent {parent_guardian}")
+
+            registration = RegistrationProfile.objects.get(user=user)
+            template_data = {
+                "patient": patient,
+                "parent": parent_guardian,
+                "registration": registration,
+                "activation_url": self.get_registration_activation_url(registration),
+            }
+
+            if settings.NOTIFICATION_OUTBOX_ENABLED:
+                enqueue_notification(registry_code, EventType.NEW_PATIENT_USER_REGISTERED, template_data)
+                logger.info("Registration process - queued notification for NEW_PATIENT_USER_REGISTERED")
+            else:
+                transaction.on_commit(lambda: self._send_notification(registry_code, template_data))
+
+    def _send_notification(self, registry_code, template_data):
+        with span("notification.send"):
+            process_notification(registry_code, EventType.NEW_PATIENT_USER_REGISTERED, template_data)
         logger.info(f"Registration process - sent notification for NEW_PATIENT_USER_REGISTERED {template_data}")
 
-    def _create_patient_address(self, patient, address_type="Postal"):
+    def _build_patient(self, user, set_link_to_user=True):
+        form_data = self.form.cleaned_data
+        return Patient(
+            consent=True,
+            family_name=form_data["surname"],
+            given_names=form_data["first_name"],
+            date_of_birth=form_data["date_of_birth"],
+            sex=form_data["gender"],
+            email=user.username,
+            home_phone=form_data["phone_number"],
+            user=user if set_link_to_user else None,
+        )
+
+    def _create_patient(self, registry, working_group, user, set_link_to_user=True):
+        # Writes the patient row once with all its fields, instead of the
+        # create and update of the base registration
+        patient = self._build_patient(user, set_link_to_user)
+        patient.save()
+        patient.rdrf_registry.add(registry)
+        patient.working_groups.add(working_group)
+        return patient
+
+    def _build_patient_address(self, patient, address_type="Postal"):
         form_data = self.form.cleaned_data
         same_address = form_data.get("same_address", False)
-        return PatientAddress.objects.create(
+        return PatientAddress(
             patient=patient,
             address_type=self.get_address_type(address_type),
             address=form_data["parent_guardian_address"] if same_address else form_data["address"],
@@ -81,13 +149,17 @@ class AngelmanRegistration(BaseRegistration):
             country=form_data["parent_guardian_country"] if same_address else form_data["country"]
         )
 
+    def _create_patient_address(self, patient, address_type="Postal"):
+        address = self._build_patient_address(patient, address_type)
+        address.save()
+        return address
+
     def get_address_type(self, address_type):
-        address_type_obj, created = AddressType.objects.get_or_create(type=address_type)
-        return address_type_obj
+        return get_address_type(address_type)
 
-    def _create_parent(self):
+    def _build_parent(self, user=None):
         form_data = self.form.cleaned_data
-        parent_guardian = ParentGuardian.objects.create(
+        return ParentGuardian(
             first_name=form_data["parent_guardian_first_name"],
             last_name=form_data["parent_guardian_last_name"],
             date_of_birth=form_data["parent_guardian_date_of_birth"],
@@ -98,18 +170,24 @@ class AngelmanRegistration(BaseRegistration):
             postcode=form_data["parent_guardian_postcode"],
             country=form_data["parent_guardian_country"],
             phone=form_data["parent_guardian_phone"],
+            user=user,
         )
+
+    def _create_parent(self, user=None):
+        parent_guardian = self._build_parent(user)
+        parent_guardian.save()
         return parent_guardian
 
     def _save_diagnosis(self, registry, patient):
         context_form_group_code, form_name, section_code, cde_code = itemgetter(
             'context_form_group_code', 'form_name', 'section_code', 'cde_code')(DIAGNOSIS_CDE)
 
-        context_form_group = ContextFormGroup.objects.get(code=context_form_group_code)
-        context = RDRFContext.objects.get(registry=registry, context_form_group=context_form_group, object_id=patient.pk)
+        context_form_group = get_context_form_group(context_form_group_code)
+        context = RDRFContext.objects.get(registry=registry, context_form_group=context_form_group,
+                                          object_id=patient.pk)
 
         diagnosis = self.form.cleaned_data['diagnosis']
-        patient.set_form_value(registry.code, form_name, section_code, cde_code, diagnosis, context)
+        set_cde_values(registry.code, patient.pk, context.pk, [CdeWrite(form_name, section_code, cde_code, diagnosis)])
 
     def update_django_user(self, django_user, registry):
         form_data = self.form.cleaned_data
@@ -127,7 +205,7 @@ class AngelmanRegistration(BaseRegistration):
 
     def registration_allowed(self):
         cde_code = DIAGNOSIS_CDE["cde_code"]
-        is_allowed = CommonDataElement.objects.filter(code=cde_code).exists()
+        is_allowed = get_diagnosis_options() is not None
         if not is_allowed:
             logger.warning(f'CDE with code {cde_code} does NOT exits. Disabling registration!')
         return is_allowed
@@ -0,0 +1,222 @@
+"""
+Bulk onboarding of families.
+
+Every row is validated with ANGRegistrationForm, the form of the web
+registration, and the rows are then written in chunks, each in one
+transaction, with a bulk insert per table instead of running
+AngelmanRegistration.process for every family. Bulk inserts send no signals,
+so each chunk rebuilds the patient indexes (consents, completion, dashboard,
+cde values) of its patients. When a chunk fails in the database its rows are
+written one by one, to report the rows which fail.
+
+Imported parents get an active account without a usable password; they set
+one through the password reset (login assistance) flow.
+"""
+import csv
+import json
+import logging
+import secrets
+from operator import itemgetter
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError, transaction
+
+from angelman.forms.angelman_registration_form import ANGRegistrationForm
+from angelman.patient_indexes import rebuild_patient_indexes
+from angelman.registry.groups.registration.angelman_registration import (
+    AngelmanRegistration, DIAGNOSIS_CDE, get_context_form_group,
+)
+from rdrf.models.definition.models import ClinicalData, ContextFormGroup, RDRFContext, Registry
+from registry.groups import GROUPS
+from registry.patients.models import ParentGuardian, Patient, PatientAddress
+
+logger = logging.getLogger(__name__)
+
+
+class RowError:
+
+    def __init__(self, row_number, errors):
+        self.row_number = row_number
+        self.errors = errors
+
+
+def read_rows(path):
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, newline="") as f:
+            yield from csv.DictReader(f)
+
+
+class FamilyImporter:
+
+    def __init__(self, registry_code, chunk_size=200, dry_run=False, rebuild_indexes=True):
+        self.registry = Registry.objects.get(code=registry_code)
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        # callers writing more data for the patients rebuild the indexes themselves
+        self.rebuild_indexes = rebuild_indexes
+        self.errors = []
+        self.imported = 0
+        self._usernames = set()
+
+        self.parent_group = Group.objects.get(name__iexact=GROUPS.PARENT)
+        self.working_group = AngelmanRegistration(None)._get_unallocated_working_group(self.registry)
+        self.fixed_context_form_groups = list(ContextFormGroup.objects.filter(registry=self.registry,
+                                                                             context_type="F"))
+        self.patient_content_type = ContentType.objects.get_for_model(Patient)
+
+    def validate(self, row_number, row):
+        data = {key: value for key, value in row.items() if value not in (None, "")}
+        data["registry_code"] = self.registry.code
+        if "password1" not in data:
+            # parents set their password through the password reset flow
+            data["password1"] = data["password2"] = secrets.token_urlsafe(24)
+
+        form = ANGRegistrationForm(data=data)
+        if not form.is_valid():
+            self.errors.append(RowError(row_number, form.errors.get_json_data()))
+            return None
+        username = form.cleaned_data["username"].lower()
+        if username in self._usernames:
+            self.errors.append(RowError(row_number, {"username": [{"message": "Duplicate email in import file"}]}))
+            return None
+        self._usernames.add(username)
+        return form
+
+    def run(self, rows):
+        chunk = []
+        for row_number, row in enumerate(rows, start=1):
+            form = self.validate(row_number, row)
+            if form is not None:
+                chunk.append((row_number, form))
+            if len(chunk) == self.chunk_size:
+                self._import_rows(chunk)
+                chunk = []
+        if chunk:
+            self._import_rows(chunk)
+
+    def _import_rows(self, chunk):
+        try:
+            self.import_chunk([form for __, form in chunk])
+            return
+        except DatabaseError as ex:
+            if len(chunk) == 1:
+                row_number, __ = chunk[0]
+                logger.warning(f"Bulk family import - row {row_number} failed: {ex}")
+                self.errors.append(RowError(row_number, {"__all__": [{"message": str(ex)}]}))
+                return
+            logger.warning(f"Bulk family import - chunk of {len(chunk)} rows failed, importing them one by one: {ex}")
+        for row in chunk:
+            self._import_rows([row])
+
+    def import_chunk(self, forms):
+        if self.dry_run:
+            self.imported += len(forms)
+            return []
+
+        registrations = [AngelmanRegistration(None, form=form) for form in forms]
+        with transaction.atomic():
+            users = self._create_users(forms)
+            patients = Patient.objects.bulk_create([
+                registration._build_patient(user, set_link_to_user=False)
+                for registration, user in zip(registrations, users)
+            ])
+            self._link(Patient, "rdrf_registry", [(patient.pk, self.registry.pk) for patient in patients])
+            self._link(Patient, "working_groups", [(patient.pk, self.working_group.pk) for patient in patients])
+
+            PatientAddress.objects.bulk_create([
+                registration._build_patient_address(patient)
+                for registration, patient in zip(registrations, patients)
+            ])
+            parents = ParentGuardian.objects.bulk_create([
+                registration._build_parent(user) for registration, user in zip(registrations, users)
+            ])
+            self._link(ParentGuardian, "patient",
+                       [(parent.pk, patient.pk) for parent, patient in zip(parents, patients)])
+
+            contexts = self._create_contexts(patients)
+            self._save_diagnoses(forms, patients, contexts)
+            if self.rebuild_indexes:
+                rebuild_patient_indexes(self.registry.code, [patient.pk for patient in patients])
+        self.imported += len(forms)
+        logger.info(f"Bulk family import - imported {len(forms)} families into {self.registry.code}")
+        return patients
+
+    def _create_users(self, forms):
+        user_model = get_user_model()
+        users = []
+        for form in forms:
+            form_data = form.cleaned_data
+            user = user_model(
+                username=form_data["username"],
+                email=form_data["username"],
+                first_name=form_data["parent_guardian_first_name"],
+                last_name=form_data["parent_guardian_last_name"],
+                preferred_language=form_data.get("preferred_languages") or "en",
+                is_active=True,
+                is_staff=False,
+            )
+            user.set_unusable_password()
+            users.append(user)
+        users = user_model.objects.bulk_create(users)
+
+        self._link(user_model, "groups", [(user.pk, self.parent_group.pk) for user in users])
+        self._link(user_model, "registry", [(user.pk, self.registry.pk) for user in users])
+        self._link(user_model, "working_groups", [(user.pk, self.working_group.pk) for user in users])
+        return users
+
+    @staticmethod
+    def _link(model, m2m_name, id_pairs):
+        # Bulk inserts the through rows of a many to many field for (source id, target id) pairs
+        field = model._meta.get_field(m2m_name)
+        through = field.remote_field.through
+        source_column, target_column = f"{field.m2m_field_name()}_id", f"{field.m2m_reverse_field_name()}_id"
+        through.objects.bulk_create([through(**{source_column: source_id, target_column: target_id})
+                                     for source_id, target_id in id_pairs])
+
+    def _create_contexts(self, patients):
+        contexts = RDRFContext.objects.bulk_create([
+            RDRFContext(registry=self.registry,
+                        content_type=self.patient_content_type,
+                        object_id=patient.pk,
+                        context_form_group=cfg,
+                        display_name=cfg.name)
+            for patient in patients
+            for cfg in self.fixed_context_form_groups
+        ])
+        return {(context.object_id, context.context_form_group_id): context for context in contexts}
+
+    def _save_diagnoses(self, forms, patients, contexts):
+        context_form_group_code, form_name, section_code, cde_code = itemgetter(
+            'context_form_group_code', 'form_name', 'section_code', 'cde_code')(DIAGNOSIS_CDE)
+        context_form_group = get_context_form_group(context_form_group_code)
+
+        ClinicalData.objects.bulk_create([
+            ClinicalData(
+                registry_code=self.registry.code,
+                collection="cdes",
+                django_model="Patient",
+                django_id=patient.pk,
+                context_id=contexts[(patient.pk, context_form_group.pk)].pk,
+                data={
+                    "django_model": "Patient",
+                    "django_id": patient.pk,
+                    "context_id": contexts[(patient.pk, context_form_group.pk)].pk,
+                    "forms": [{
+                        "name": form_name,
+                        "sections": [{
+                            "code": section_code,
+                            "allow_multiple": False,
+                            "cdes": [{"code": cde_code, "value": form.cleaned_data["diagnosis"]}],
+                        }],
+                    }],
+                },
+            )
+            for form, patient in zip(forms, patients)
+        ])
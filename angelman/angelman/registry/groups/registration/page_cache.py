@@ -0,0 +1,153 @@
+"""
+Cache of the anonymous registration pages.
+
+The registration page, and its embedded version shown in an iframe on
+angelmanregistry.info, render the whole registration form (diagnosis
+options, countries, languages) for every public visit. The middleware keeps
+the rendered page of an anonymous GET per (path, language, registry
+definition generation, app version) in a django cache and serves it from
+there, answering conditional requests with 304.
+
+The rendered page holds two per request values: the CSRF tokens of the forms
+(every {% csrf_token %} renders a differently masked token) and the CSP nonce
+of the inline scripts. They are replaced by placeholders before the page is
+cached and filled in again for each response, so every visitor gets their
+own token (and CSRF cookie) and a nonce matching the
+Content-Security-Policy header. Pages without a CSRF form field are not
+cached. The reCAPTCHA widget only needs the site key, which is part of the
+cached page.
+
+Without a shared definition cache (settings.DEFINITION_CACHE_ALIAS) the
+definition generation only counts the changes seen by one process, so the
+pages are then cached per worker process.
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.translation import get_language
+
+from angelman.definition.cache import definition_cache
+from angelman.metrics.registry import registry
+
+logger = logging.getLogger(__name__)
+
+CSRF_PLACEHOLDER = "__angelman_csrf_token__"
+NONCE_PLACEHOLDER = "__angelman_csp_nonce__"
+
+_CSRF_FIELD = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+page_cache_requests = registry.counter("angelman_registration_page_cache_total",
+                                       "Anonymous registration page requests by cache result", ["result"])
+
+
+def _cache():
+    return caches[settings.REGISTRATION_PAGE_CACHE_ALIAS]
+
+
+def _definition_version():
+    if settings.DEFINITION_CACHE_ALIAS:
+        return definition_cache.generation
+    return f"{os.getpid()}.{definition_cache.generation}"
+
+
+def _cache_key(request):
+    return (f"angelman:registration_page:{_definition_version()}:{settings.VERSION}:"
+            f"{get_language()}:{request.path}")
+
+
+def _cacheable_request(request, view_name):
+    return (settings.REGISTRATION_PAGE_CACHE_TIMEOUT
+            and view_name in settings.REGISTRATION_PAGE_CACHE_URL_NAMES
+            and request.method == "GET"
+            and not request.GET
+            and not request.user.is_authenticated)
+
+
+def _template(request, response):
+    """
+    The page with placeholders for the per request values, or None when it cannot be cached
+    """
+    if response.status_code != 200 or not response.get("Content-Type", "").startswith("text/html"):
+        return None
+    content = response.content.decode(response.charset)
+    content, tokens = _CSRF_FIELD.subn(f'name="csrfmiddlewaretoken" value="{CSRF_PLACEHOLDER}"', content)
+    if not tokens:
+        return None
+    # django-csp only creates a nonce when the page used it
+    nonce = getattr(request, "_csp_nonce", None)
+    if nonce:
+        content = content.replace(nonce, NONCE_PLACEHOLDER)
+    return content
+
+
+def _fill(request, content):
+    content = content.replace(CSRF_PLACEHOLDER, get_token(request))
+    if NONCE_PLACEHOLDER in content:
+        content = content.replace(NONCE_PLACEHOLDER, str(request.csp_nonce))
+    return content
+
+
+def _headers(response, page):
+    response["ETag"] = page["etag"]
+    response["Last-Modified"] = http_date(page["last_modified"])
+    # revalidated on every visit, and never stored by shared caches: the page holds a CSRF token
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Cookie", "Accept-Language"])
+    return response
+
+
+class RegistrationPageCacheMiddleware:
+    """
+    Has to come after the session, csrf, locale, authentication and csp middleware
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        key = getattr(request, "_registration_page_key", None)
+        if key is None:
+            return response
+        content = _template(request, response)
+        if content is None:
+            page_cache_requests.inc(result="uncacheable")
+            return response
+        page = {
+            "content": content,
+            "content_type": response["Content-Type"],
+            "etag": f'W/"{hashlib.sha1(content.encode("utf-8")).hexdigest()}"',
+            "last_modified": int(time.time()),
+        }
+        _cache().set(key, page, settings.REGISTRATION_PAGE_CACHE_TIMEOUT)
+        return _headers(response, page)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not _cacheable_request(request, request.resolver_match.url_name):
+            return None
+        key = _cache_key(request)
+        page = _cache().get(key)
+        if page is None:
+            page_cache_requests.inc(result="miss")
+            # rendered by the view, stored on the way out
+            request._registration_page_key = key
+            return None
+
+        # a 304 keeps the token of the page the browser has, valid only with its csrf cookie
+        if settings.CSRF_COOKIE_NAME in request.COOKIES:
+            not_modified = get_conditional_response(request, etag=page["etag"], last_modified=page["last_modified"])
+            if not_modified is not None:
+                page_cache_requests.inc(result="not_modified")
+                return _headers(not_modified, page)
+        page_cache_requests.inc(result="hit")
+        response = HttpResponse(_fill(request, page["content"]), content_type=page["content_type"])
+        return _headers(response, page)
@@ -0,0 +1,109 @@
+"""
+Streaming export of the clinical data of a registry.
+
+The clinical data is read with a server side cursor (QuerySet.iterator) and
+written out one chunk at a time as rows of
+
+    patient_id, context_id, form, section, item, cde, value
+
+(item is the index of the entry of a multiple section), so memory use is
+bounded by the chunk size whatever the size of the cohort. CSV is always
+available; Parquet needs pyarrow.
+"""
+import csv
+import io
+import json
+
+from rdrf.models.definition.models import ClinicalData
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ["patient_id", "context_id", "form", "section", "item", "cde", "value"]
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def _value(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _section_rows(patient_id, context_id, form_name, section):
+    if section.get("allow_multiple"):
+        items = enumerate(section.get("cdes") or [], start=1)
+    else:
+        items = [(None, section.get("cdes") or [])]
+    for item, cdes in items:
+        for cde in cdes:
+            yield [patient_id, context_id, form_name, section["code"], item, cde["code"], _value(cde.get("value"))]
+
+
+def iter_rows(registry_code, forms=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    clinical_data = (ClinicalData.objects
+                     .filter(registry_code=registry_code, collection="cdes", django_model="Patient")
+                     .order_by("django_id", "context_id")
+                     .values_list("django_id", "context_id", "data"))
+    for patient_id, context_id, data in clinical_data.iterator(chunk_size=chunk_size):
+        for form in (data or {}).get("forms", []):
+            if forms and form["name"] not in forms:
+                continue
+            for section in form.get("sections", []):
+                yield from _section_rows(patient_id, context_id, form["name"], section)
+
+
+def iter_chunks(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv(registry_code, forms=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the export as CSV text one chunk at a time, e.g. for a StreamingHttpResponse
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in iter_chunks(iter_rows(registry_code, forms, chunk_size), chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_csv(path, registry_code, forms=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(path, "w", newline="") as f:
+        for text in iter_csv(registry_code, forms, chunk_size):
+            f.write(text)
+
+
+def write_parquet(path, registry_code, forms=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+    schema = pyarrow.schema([
+        ("patient_id", pyarrow.int64()),
+        ("context_id", pyarrow.int64()),
+        ("form", pyarrow.string()),
+        ("section", pyarrow.string()),
+        ("item", pyarrow.int32()),
+        ("cde", pyarrow.string()),
+        ("value", pyarrow.string()),
+    ])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in iter_chunks(iter_rows(registry_code, forms, chunk_size), chunk_size):
+            columns = dict(zip(COLUMNS, (list(column) for column in zip(*chunk))))
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
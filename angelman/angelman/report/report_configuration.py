@@ -1,10 +1,19 @@
+import copy
+from functools import lru_cache
+
 from report.report_configuration import get_configuration
 
 
-def get_angelman_configuration():
+@lru_cache(maxsize=None)
+def _angelman_configuration():
     angelman_report_configuration = get_configuration()
     demographic_model = angelman_report_configuration['demographic_model']
     if 'patientEmailPreferences' in demographic_model:
         del demographic_model['patientEmailPreferences']
 
     return angelman_report_configuration
+
+
+def get_angelman_configuration():
+    # Built once per process; callers get their own copy so they can't change the shared one
+    return copy.deepcopy(_angelman_configuration())
@@ -0,0 +1,33 @@
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework.authentication import BasicAuthentication, SessionAuthentication
+from rest_framework.permissions import BasePermission
+from rest_framework.views import APIView
+
+from angelman.report.export import iter_csv
+from rdrf.models.definition.models import Registry
+
+
+class IsSuperuser(BasePermission):
+    """
+    The export holds every patient of the registry, whatever the working groups
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_superuser)
+
+
+class ClinicalDataExportView(APIView):
+    """
+    Downloads the clinical data of a registry as CSV, streamed one chunk at a
+    time (see angelman.report.export); ?form= (repeatable) limits it to some forms
+    """
+    authentication_classes = [SessionAuthentication, BasicAuthentication]
+    permission_classes = [IsSuperuser]
+
+    def get(self, request, registry_code):
+        registry = get_object_or_404(Registry, code=registry_code)
+        forms = request.query_params.getlist("form") or None
+        response = StreamingHttpResponse(iter_csv(registry.code, forms), content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="{registry.code}_clinical_data.csv"'
+        return response
@@ -15,6 +15,9 @@ INSTALLED_APPS = [
 
 ROOT_URLCONF = '%s.urls' % FALLBACK_REGISTRY_CODE
 
+# First, so the request metrics include the time spent in the other middleware
+MIDDLEWARE = ['angelman.metrics.middleware.MetricsMiddleware'] + list(MIDDLEWARE)
+
 SEND_ACTIVATION_EMAIL = False
 
 RECAPTCHA_SITE_KEY = env.get("recaptcha_site_key", "")
@@ -52,3 +55,44 @@ SCHEMA_MODULE = 'report.schema'
 SCHEMA_METHOD_PATIENT_FIELDS = 'get_patient_fields'
 REPORT_CONFIG_MODULE = 'angelman.report.report_configuration'
 REPORT_CONFIG_METHOD_GET = 'get_angelman_configuration'
+
+# Compiled registry definition cache (see angelman.definition.loader)
+REGISTRY_DEFINITION_CACHE_DIR = env.get("registry_definition_cache_dir", "/data/cache/registry_definitions")
+
+# Optional django cache alias used to share the registry definition lookup cache between processes
+DEFINITION_CACHE_ALIAS = env.get("definition_cache_alias", "")
+
+# Seconds after which a process drops its definition lookups when no shared alias is set (0: never)
+DEFINITION_CACHE_TIMEOUT = env.get("definition_cache_timeout", 300)
+
+# Queue notifications in the outbox table, to be sent by the drain_notification_outbox command
+NOTIFICATION_OUTBOX_ENABLED = env.get("notification_outbox_enabled", False)
+
+# Where partially uploaded files of the batch ingestion api are kept until they are complete
+INGEST_UPLOAD_DIR = env.get("ingest_upload_dir", "/data/ingest_uploads")
+
+# Bearer token a Prometheus scraper sends to read /metrics (staff users can always read it)
+METRICS_TOKEN = env.get("metrics_token", "")
+# Directory shared by the worker processes of a host, each writes its metrics there for /metrics to sum (see
+# angelman.metrics.registry); without it /metrics shows the worker which answered
+METRICS_DIR = env.get("metrics_dir", "")
+# Seconds between writes of a worker's metrics to METRICS_DIR
+METRICS_FLUSH_SECONDS = env.get("metrics_flush_seconds", 5)
+
+# Requests slower than this many milliseconds are logged with their SQL, 0 disables the slow request log
+SLOW_REQUEST_LOG_MS = env.get("slow_request_log_ms", 0)
+
+# Store ClinicalData history as periodic full snapshots plus diffs (see angelman.clinical_data.history);
+# compact the existing history rows with the compact_clinical_data_history command
+CLINICAL_DATA_HISTORY_DELTAS = env.get("clinical_data_history_deltas", True)
+# Versions between full snapshots of the compressed history
+CLINICAL_DATA_HISTORY_SNAPSHOT_INTERVAL = env.get("clinical_data_history_snapshot_interval", 10)
+
+# Cache the anonymous registration pages (see angelman.registry.groups.registration.page_cache), innermost
+MIDDLEWARE += ['angelman.registry.groups.registration.page_cache.RegistrationPageCacheMiddleware']
+# Seconds a rendered registration page is kept, 0 disables the cache
+REGISTRATION_PAGE_CACHE_TIMEOUT = env.get("registration_page_cache_timeout", 3600)
+REGISTRATION_PAGE_CACHE_ALIAS = env.get("registration_page_cache_alias", "default")
+# url names of the registration pages served from the cache
+REGISTRATION_PAGE_CACHE_URL_NAMES = env.getlist("registration_page_cache_url_names",
+                                                ["registration_register", "embedded_registration_register"])
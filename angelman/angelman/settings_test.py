@@ -18,3 +18,6 @@ GHERKIN_TEST_CLASS = 'aloe.testclass.TestCase'
 
 MIGRATION_MODULES = {"iprestrict": None}
 IPRESTRICT_GEOIP_ENABLED = False
+
+# Fail instead of warn when a code path exceeds its query budget (see angelman.query_budget)
+QUERY_BUDGET_STRICT = True
@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from unittest import mock
+
+from django.db.models import Q
+from django.test import SimpleTestCase
+
+from angelman.cohort.query import CohortQueryError, parse
+
+DATATYPES = {
+    "ANGDNAMethylAbnormalResult": "range",
+    "RegistrationDiagnosis": "range",
+    "6MoWeight": "float",
+    "ANGDateOfDiagnosis": "date",
+    "ANGNotes": "string",
+}
+
+
+@dataclass(frozen=True)
+class Match:
+    """
+    Stands in for the EXISTS expression of a cde, so parsed expressions compare by value
+    """
+    cde_code: str
+    form_name: str = None
+    lookups: tuple = ()
+
+
+def _match(registry_code, cde_code, form_name=None, patient_ref=None, **lookups):
+    return Match(cde_code, form_name, tuple(sorted(lookups.items())))
+
+
+def _q(cde_code, form_name=None, **lookups):
+    return Q(_match("ang", cde_code, form_name, **lookups))
+
+
+@mock.patch("angelman.cohort.query._datatype", lambda registry_code, cde_code: DATATYPES.get(cde_code))
+@mock.patch("angelman.cohort.query.cde_matches", _match)
+class ParseTest(SimpleTestCase):
+
+    def test_and_or_not(self):
+        self.assertEqual(
+            parse("ang", 'cde("ANGDNAMethylAbnormalResult") == "X" and '
+                         '(cde("RegistrationDiagnosis") == "AS" or not filled("ANGNotes"))'),
+            _q("ANGDNAMethylAbnormalResult", value="X") & (_q("RegistrationDiagnosis", value="AS") | ~_q("ANGNotes")))
+
+    def test_in_and_not_equal(self):
+        self.assertEqual(parse("ang", 'cde("RegistrationDiagnosis") in ["AS", "UPD"]'),
+                         Q(pk__in=[]) | _q("RegistrationDiagnosis", value="AS")
+                         | _q("RegistrationDiagnosis", value="UPD"))
+        self.assertEqual(parse("ang", 'cde("RegistrationDiagnosis") not in ["AS"]'),
+                         ~(Q(pk__in=[]) | _q("RegistrationDiagnosis", value="AS")))
+        self.assertEqual(parse("ang", 'cde("6MoWeight", "CheckUp6Months") != 21'),
+                         ~_q("6MoWeight", "CheckUp6Months", number=21.0))
+
+    def test_all_of(self):
+        self.assertEqual(parse("ang", 'all_of("RegistrationDiagnosis", ["AS", "UPD"])'),
+                         Q() & _q("RegistrationDiagnosis", value="AS") & _q("RegistrationDiagnosis", value="UPD"))
+
+    def test_ranges(self):
+        self.assertEqual(parse("ang", '10 <= cde("6MoWeight", "CheckUp6Months") < 20'),
+                         _q("6MoWeight", "CheckUp6Months", number__gte=10.0, number__lt=20.0))
+        self.assertEqual(parse("ang", 'cde("6MoWeight") > 10'), _q("6MoWeight", number__gt=10.0))
+        # the cde on the right mirrors the operator
+        self.assertEqual(parse("ang", '10 > cde("6MoWeight")'), _q("6MoWeight", number__lt=10.0))
+        self.assertEqual(parse("ang", 'cde("6MoWeight") <= 20.5'), _q("6MoWeight", number__lte=20.5))
+
+    def test_text_ranges(self):
+        self.assertEqual(parse("ang", '"2020-01-01" <= cde("ANGDateOfDiagnosis") <= "31-12-2020"'),
+                         _q("ANGDateOfDiagnosis", value__gte="2020-01-01", value__lte="2020-12-31"))
+
+    def test_number_literal_of_a_text_cde_compares_as_text(self):
+        self.assertEqual(parse("ang", 'cde("ANGNotes") == 3'), _q("ANGNotes", value="3"))
+
+    def test_other_chains_are_and_of_comparisons(self):
+        self.assertEqual(parse("ang", '10 < cde("6MoWeight") > 5'),
+                         Q() & _q("6MoWeight", number__gt=10.0) & _q("6MoWeight", number__gt=5.0))
+
+    def test_unsupported_expressions(self):
+        for expression in [
+            'cde("6MoWeight") >',
+            '1 == 2',
+            'cde("6MoWeight") == weight',
+            'cde("6MoWeight") is None',
+            'cde("RegistrationDiagnosis") in "AS"',
+            'cde() == 1',
+            'cde("6MoWeight", form="CheckUp6Months") == 1',
+            'value("6MoWeight") == 1',
+            'filled()',
+            'cde("6MoWeight") + 1 > 2',
+        ]:
+            with self.subTest(expression=expression):
+                with self.assertRaises(CohortQueryError):
+                    parse("ang", expression)
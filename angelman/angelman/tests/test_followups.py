@@ -0,0 +1,65 @@
+from datetime import date
+
+from django.db.models import Exists, Q
+from django.test import SimpleTestCase
+
+from angelman.followups import compile_condition
+
+TODAY = date(2026, 10, 17)
+
+
+class CompileConditionTest(SimpleTestCase):
+
+    def _compile(self, condition, today=TODAY):
+        return compile_condition(condition, today=today)
+
+    def test_empty_condition_matches_everyone(self):
+        self.assertEqual(self._compile(""), Q())
+        self.assertEqual(self._compile("  "), Q())
+
+    def test_field_comparisons(self):
+        self.assertEqual(self._compile("patient.living_status == 'Alive'"), Q(living_status__exact="Alive"))
+        self.assertEqual(self._compile("patient.living_status != 'Deceased'"), ~Q(living_status="Deceased"))
+        self.assertEqual(self._compile("patient.date_of_birth >= '2015-01-01'"),
+                         Q(date_of_birth__gte="2015-01-01"))
+
+    def test_boolean_operators(self):
+        self.assertEqual(
+            self._compile("patient.living_status == 'Alive' and (patient.sex == '1' or not patient.sex == '2')"),
+            Q(living_status__exact="Alive") & (Q(sex__exact="1") | ~Q(sex__exact="2")))
+
+    def test_age_is_compared_on_the_date_of_birth(self):
+        self.assertEqual(self._compile("patient.age < 10"), Q(date_of_birth__gt=date(2016, 10, 17)))
+        self.assertEqual(self._compile("patient.age <= 10"), Q(date_of_birth__gt=date(2015, 10, 17)))
+        self.assertEqual(self._compile("patient.age >= 10"), Q(date_of_birth__lte=date(2016, 10, 17)))
+        self.assertEqual(self._compile("patient.age > 10"), Q(date_of_birth__lte=date(2015, 10, 17)))
+        self.assertEqual(self._compile("patient.age == 10"),
+                         Q(date_of_birth__lte=date(2016, 10, 17)) & Q(date_of_birth__gt=date(2015, 10, 17)))
+
+    def test_age_on_the_29th_of_february(self):
+        self.assertEqual(self._compile("patient.age < 1", today=date(2024, 2, 29)),
+                         Q(date_of_birth__gt=date(2023, 2, 28)))
+
+    def test_consents_are_checked_against_the_consent_index(self):
+        q = self._compile("consents.get('ang.AngNewConsentSection.angnewconsent6b') and patient.age < 10")
+
+        consent, age = q.children
+        self.assertIsInstance(consent, Exists)
+        self.assertEqual(age, ("date_of_birth__gt", date(2016, 10, 17)))
+
+    def test_unsupported_conditions_are_left_to_python(self):
+        for condition in [
+            "patient.get_age() > 3",
+            "patient.age < 9.5",
+            "patient.age in [1, 2]",
+            "1 < patient.age",
+            "1 < patient.age < 5",
+            "patient.no_such_field == 'x'",
+            "patient.living_status.lower() == 'alive'",
+            "patient.living_status == other.living_status",
+            "consents.get('angnewconsent6b')",
+            "consents.get('ang.AngNewConsentSection.angnewconsent6b', False)",
+            "len(consents) > 0",
+        ]:
+            with self.subTest(condition=condition):
+                self.assertIsNone(self._compile(condition))
@@ -0,0 +1,97 @@
+from django.test import SimpleTestCase
+
+from angelman.definition.form_index import CdeSpec, FormIndex, FormSpec, SectionSpec
+
+
+def _cde(code="ANGCde", datatype="string", options=(), allow_multiple=False, min_value=None, max_value=None,
+         max_length=None, pattern=None):
+    return CdeSpec(code=code, name=code, datatype=datatype, widget_name="", allow_multiple=allow_multiple,
+                   options=options, option_codes=frozenset(option_code for option_code, __ in options),
+                   min_value=min_value, max_value=max_value, max_length=max_length, pattern=pattern)
+
+
+class CdeSpecValidateTest(SimpleTestCase):
+
+    def test_empty_values_are_valid(self):
+        for datatype in ("integer", "float", "date", "boolean", "string"):
+            with self.subTest(datatype=datatype):
+                self.assertEqual(_cde(datatype=datatype).validate(None), [])
+                self.assertEqual(_cde(datatype=datatype).validate(""), [])
+
+    def test_integer(self):
+        cde = _cde(datatype="integer", min_value=0, max_value=120)
+        self.assertEqual(cde.validate("21"), [])
+        self.assertEqual(cde.validate(0), [])
+        self.assertEqual(cde.validate(120), [])
+        self.assertEqual(cde.validate("2.5"), ["ANGCde must be a whole number"])
+        self.assertEqual(cde.validate("-1"), ["ANGCde must be at least 0"])
+        self.assertEqual(cde.validate(121), ["ANGCde must be at most 120"])
+
+    def test_float_and_decimal(self):
+        for datatype in ("float", "decimal"):
+            with self.subTest(datatype=datatype):
+                cde = _cde(datatype=datatype, min_value=0.5, max_value=250)
+                self.assertEqual(cde.validate("21.4"), [])
+                self.assertEqual(cde.validate("heavy"), ["ANGCde must be a number"])
+                self.assertEqual(cde.validate(0.4), ["ANGCde must be at least 0.5"])
+                self.assertEqual(cde.validate("250.1"), ["ANGCde must be at most 250"])
+
+    def test_date(self):
+        cde = _cde(datatype="date")
+        self.assertEqual(cde.validate("2020-02-29"), [])
+        self.assertEqual(cde.validate("29-02-2020"), [])
+        self.assertEqual(cde.validate("2021-02-29"), ["ANGCde must be a date (YYYY-MM-DD)"])
+        self.assertEqual(cde.validate("yesterday"), ["ANGCde must be a date (YYYY-MM-DD)"])
+
+    def test_boolean(self):
+        cde = _cde(datatype="boolean")
+        for value in (True, False, "True", "false"):
+            with self.subTest(value=value):
+                self.assertEqual(cde.validate(value), [])
+        self.assertEqual(cde.validate("yes"), ["ANGCde must be true or false"])
+
+    def test_string_length_and_pattern(self):
+        cde = _cde(datatype="string", max_length=5, pattern=r"[A-Z]+")
+        self.assertEqual(cde.validate("ABC"), [])
+        self.assertEqual(cde.validate("ABCDEF"), ["ANGCde is longer than 5 characters"])
+        self.assertEqual(cde.validate("AB1"), ["ANGCde does not match [A-Z]+"])
+
+    def test_permitted_values(self):
+        cde = _cde(datatype="range", options=(("AS", "Angelman syndrome"), ("UPD", "Uniparental disomy")))
+        self.assertEqual(cde.validate("AS"), [])
+        self.assertEqual(cde.validate("Angelman syndrome"), ["'Angelman syndrome' is not a permitted value of ANGCde"])
+
+    def test_multiple_permitted_values(self):
+        cde = _cde(datatype="range", allow_multiple=True, options=(("A", "a"), ("B", "b")))
+        self.assertEqual(cde.validate(["A", "B"]), [])
+        self.assertEqual(cde.validate(["A", "C"]), ["'C' is not a permitted value of ANGCde"])
+        self.assertEqual(cde.validate("A"), ["ANGCde takes a list of values"])
+
+
+class FormIndexValidateTest(SimpleTestCase):
+
+    def setUp(self):
+        self.index = FormIndex(
+            "ang", "1.0",
+            forms={"CheckUp6Months": FormSpec("CheckUp6Months", "6 month check up", ("6moAgehw", "6moSeizures"),
+                                              frozenset())},
+            sections={"6moAgehw": SectionSpec("6moAgehw", "Weight", False, ("6MoWeight",)),
+                      "6moSeizures": SectionSpec("6moSeizures", "Seizures", True, ("SeizureType",))},
+            cdes={"6MoWeight": _cde("6MoWeight", datatype="float", min_value=0),
+                  "SeizureType": _cde("SeizureType")},
+            fixed_context_form_groups={},
+        )
+
+    def test_value_is_checked_against_the_cde(self):
+        self.assertEqual(self.index.validate("CheckUp6Months", "6moAgehw", "6MoWeight", "21"), [])
+        self.assertEqual(self.index.validate("CheckUp6Months", "6moAgehw", "6MoWeight", "-1"),
+                         ["6MoWeight must be at least 0"])
+
+    def test_unknown_or_unsupported_targets(self):
+        self.assertEqual(self.index.validate("History", "6moAgehw", "6MoWeight", "21"), ["unknown form History"])
+        self.assertEqual(self.index.validate("CheckUp6Months", "6moHeight", "6MoWeight", "21"),
+                         ["section 6moHeight is not in form CheckUp6Months"])
+        self.assertEqual(self.index.validate("CheckUp6Months", "6moSeizures", "SeizureType", "tonic"),
+                         ["section 6moSeizures is a multiple section"])
+        self.assertEqual(self.index.validate("CheckUp6Months", "6moAgehw", "6MoHeight", "95"),
+                         ["cde 6MoHeight is not in section 6moAgehw"])
@@ -0,0 +1,103 @@
+import copy
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from angelman.clinical_data.history import HistoryWriter, cde_history, diff, materialise, patch
+from angelman.models import ClinicalDataHistory
+
+KEY = dict(registry_code="ang", django_model="Patient", django_id=1, context_id=1)
+
+
+def _record(weight, seizures=(), notes=None):
+    record = {
+        "forms": [{
+            "name": "CheckUp6Months",
+            "sections": [
+                {"code": "6moAgehw", "allow_multiple": False, "cdes": [{"code": "6MoWeight", "value": weight}]},
+                {"code": "6moSeizures", "allow_multiple": True,
+                 "cdes": [[{"code": "SeizureType", "value": seizure}] for seizure in seizures]},
+            ],
+        }],
+    }
+    if notes is not None:
+        record["notes"] = notes
+    return {"record": record, "timestamp": "2026-01-01T10:00:00", "username": "curator"}
+
+
+def _round_trip(old, new):
+    operations = diff(old, new)
+    return patch(copy.deepcopy(old), operations), operations
+
+
+class DiffPatchTest(SimpleTestCase):
+
+    def test_unchanged_documents_have_no_operations(self):
+        self.assertEqual(diff(_record("21"), _record("21")), [])
+
+    def test_changed_value_is_set_at_its_path(self):
+        patched, operations = _round_trip(_record("21"), _record("22"))
+
+        self.assertEqual(patched, _record("22"))
+        self.assertEqual(operations, [["s", ["record", "forms", 0, "sections", 0, "cdes", 0, "value"], "22"]])
+
+    def test_added_and_removed_keys(self):
+        for old, new in ((_record("21"), _record("21", notes="walks")), (_record("21", notes="walks"), _record("21"))):
+            with self.subTest(old=old, new=new):
+                patched, __ = _round_trip(old, new)
+                self.assertEqual(patched, new)
+
+    def test_lists_changing_length_are_replaced(self):
+        for old, new in (((), ("absence",)), (("absence",), ("absence", "tonic")), (("absence", "tonic"), ("tonic",)),
+                         (("absence",), ())):
+            with self.subTest(old=old, new=new):
+                patched, operations = _round_trip(_record("21", old), _record("21", new))
+                self.assertEqual(patched, _record("21", new))
+                self.assertEqual([operation[1] for operation in operations],
+                                 [["record", "forms", 0, "sections", 1, "cdes"]])
+
+    def test_lists_of_the_same_length_are_diffed_per_item(self):
+        patched, operations = _round_trip(_record("21", ("absence", "tonic")), _record("21", ("absence", "atonic")))
+
+        self.assertEqual(patched, _record("21", ("absence", "atonic")))
+        self.assertEqual(operations, [["s", ["record", "forms", 0, "sections", 1, "cdes", 1, 0, "value"], "atonic"]])
+
+    def test_replaced_root(self):
+        self.assertEqual(_round_trip([1, 2], [1, 2, 3])[0], [1, 2, 3])
+        self.assertEqual(_round_trip({"a": 1}, "text")[0], "text")
+
+
+class HistoryWriterTest(TestCase):
+
+    def _write(self, versions, snapshot_interval):
+        writer = HistoryWriter(snapshot_interval=snapshot_interval)
+        for data in versions:
+            writer.entry(KEY, data, timezone.now()).save()
+
+    def test_versions_are_materialised_across_snapshot_intervals(self):
+        versions = [
+            _record(str(20 + number), ("absence",) * (number % 3), notes="note" if number % 2 else None)
+            for number in range(7)
+        ]
+        self._write(versions, snapshot_interval=3)
+
+        self.assertEqual(list(ClinicalDataHistory.objects.filter(**KEY).order_by("version").values_list(
+            "version", "snapshot")), [(1, True), (2, False), (3, False), (4, True), (5, False), (6, False), (7, True)])
+        for version, data in enumerate(versions, start=1):
+            with self.subTest(version=version):
+                self.assertEqual(materialise(version=version, **KEY), data)
+        self.assertEqual(materialise(**KEY), versions[-1])
+        self.assertIsNone(materialise(version=8, **KEY))
+
+    def test_cde_history(self):
+        self._write([_record("21"), _record("22"), _record("22", ("absence",))], snapshot_interval=2)
+
+        self.assertEqual([entry["value"] for entry in cde_history(
+            "ang", 1, 1, "CheckUp6Months", "6moAgehw", "6MoWeight")], ["21", "22", "22"])
+        self.assertEqual([entry["value"] for entry in cde_history(
+            "ang", 1, 1, "CheckUp6Months", "6moSeizures", "SeizureType", formset_index=0)], [None, None, "absence"])
+
+    def test_version_without_a_snapshot_is_not_materialised(self):
+        ClinicalDataHistory.objects.create(version=1, snapshot=False, data=[], **KEY)
+
+        self.assertIsNone(materialise(version=1, **KEY))
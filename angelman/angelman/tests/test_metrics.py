@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from angelman.metrics.registry import EXITED_FILE, Registry
+
+
+def _exited_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def _counter_file(directory, pid, value):
+    with open(os.path.join(directory, f"{pid}.json"), "w") as f:
+        json.dump({"requests_total": [[[], value]]}, f)
+
+
+class MetricsDirectoryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        metrics_dir = override_settings(METRICS_DIR=self.directory)
+        metrics_dir.enable()
+        self.addCleanup(metrics_dir.disable)
+        self.registry = Registry()
+        self.requests = self.registry.counter("requests_total", "Requests")
+
+    def _total(self):
+        lines = [line for line in self.registry.render().splitlines() if line.startswith("requests_total ")]
+        return float(lines[0].split()[1])
+
+    def test_files_of_exited_processes_are_folded_once(self):
+        pid = _exited_pid()
+        _counter_file(self.directory, pid, 3)
+        self.requests.inc(2)
+
+        self.assertEqual(self._total(), 5)
+        self.assertNotIn(f"{pid}.json", os.listdir(self.directory))
+        self.assertIn(EXITED_FILE, os.listdir(self.directory))
+
+        _counter_file(self.directory, _exited_pid(), 1)
+        self.assertEqual(self._total(), 6)
+        self.assertEqual(self._total(), 6)
+
+    def test_reused_pid_keeps_the_values_of_the_exited_process(self):
+        _counter_file(self.directory, os.getpid(), 7)
+        self.requests.inc()
+
+        self.assertEqual(self._total(), 8)
+        self.requests.inc()
+        self.assertEqual(self._total(), 9)
+
+    def test_first_worker_of_a_new_server_clears_the_directory(self):
+        _counter_file(self.directory, _exited_pid(), 3)
+
+        with mock.patch("angelman.metrics.registry._uwsgi_master_pid", return_value=100):
+            self.registry.clear_previous_run()
+            self.assertEqual(sorted(os.listdir(self.directory)), [".lock", "server"])
+
+            self.requests.inc()
+            self.registry.flush(force=True)
+            # the other workers of the same master leave it alone
+            self.registry.clear_previous_run()
+
+        self.assertEqual(self._total(), 1)
+
+    def test_processes_outside_uwsgi_leave_the_directory_alone(self):
+        pid = _exited_pid()
+        _counter_file(self.directory, pid, 3)
+
+        self.registry.clear_previous_run()
+
+        self.assertIn(f"{pid}.json", os.listdir(self.directory))
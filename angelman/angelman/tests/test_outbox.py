@@ -0,0 +1,64 @@
+import smtplib
+
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from angelman.models import NotificationOutbox
+from angelman.notifications.outbox import drain_batch, enqueue_notification
+from rdrf.models.definition.models import EmailNotification, EmailTemplate, Registry
+
+EVENT_TYPE = "outbox-test"
+
+
+class FailingEmailBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        raise smtplib.SMTPException("connection refused")
+
+
+class DrainBatchTest(TestCase):
+
+    def setUp(self):
+        registry = Registry.objects.create(code="ang", name="Angelman", desc="", splash_screen="", version="1.0")
+        template = EmailTemplate.objects.create(language="en", description="Outbox test", subject="Hello",
+                                                body="Hello {{ name }}")
+        notification = EmailNotification.objects.create(registry=registry, description=EVENT_TYPE,
+                                                        email_from="registry@example.com",
+                                                        recipient="parent@example.com")
+        notification.email_templates.add(template)
+        self.template = template
+        self.entry = enqueue_notification("ang", EVENT_TYPE, {"name": "Sam"})
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_sent_notification_is_marked_sent(self):
+        self.assertEqual(drain_batch(concurrency=1), (1, 0))
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.status, NotificationOutbox.SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_BACKEND="angelman.tests.test_outbox.FailingEmailBackend")
+    def test_failed_email_is_retried_with_backoff(self):
+        self.assertEqual(drain_batch(concurrency=1, max_attempts=2), (0, 1))
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.status, NotificationOutbox.PENDING)
+        self.assertEqual(self.entry.attempts, 1)
+        self.assertNotEqual(self.entry.last_error, "")
+        self.assertGreater(self.entry.next_attempt_at, timezone.now())
+
+        # due again after the backoff, then failed for good
+        NotificationOutbox.objects.filter(pk=self.entry.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(drain_batch(concurrency=1, max_attempts=2), (0, 1))
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.status, NotificationOutbox.FAILED)
+
+    @override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    def test_template_that_fails_to_render_is_a_failure(self):
+        self.template.body = "{% url 'no-such-view' %}"
+        self.template.save()
+
+        self.assertEqual(drain_batch(concurrency=1), (0, 1))
+        self.entry.refresh_from_db()
+        self.assertIn("no-such-view", self.entry.last_error)
+        self.assertEqual(len(mail.outbox), 0)
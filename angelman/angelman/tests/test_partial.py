@@ -0,0 +1,124 @@
+from django.test import TestCase
+
+from angelman.clinical_data.partial import CdeWrite, cde_values_written, set_cde_values
+from rdrf.models.definition.models import ClinicalData
+
+REGISTRY_CODE = "ang"
+PATIENT_ID = 1
+CONTEXT_ID = 1
+
+
+def _document(cdes):
+    return {
+        "django_model": "Patient",
+        "django_id": PATIENT_ID,
+        "context_id": CONTEXT_ID,
+        "forms": [{
+            "name": "CheckUp6Months",
+            "sections": [{
+                "code": "6moAgehw",
+                "allow_multiple": False,
+                "cdes": [{"code": code, "value": value} for code, value in cdes.items()],
+            }],
+        }],
+    }
+
+
+class SetCdeValuesTest(TestCase):
+
+    def setUp(self):
+        self.clinical_data = ClinicalData.objects.create(
+            registry_code=REGISTRY_CODE, collection="cdes", django_model="Patient", django_id=PATIENT_ID,
+            context_id=CONTEXT_ID, data=_document({"6MoWeight": "21", "6MoHeight": 95, "6MoNotes": None}),
+        )
+        self.sent = []
+        cde_values_written.connect(self._receiver)
+        self.addCleanup(cde_values_written.disconnect, self._receiver)
+
+    def _receiver(self, sender, **kwargs):
+        self.sent.append(kwargs)
+
+    def _write(self, cde_code, value):
+        return set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID,
+                              [CdeWrite("CheckUp6Months", "6moAgehw", cde_code, value)])
+
+    def test_unchanged_values_are_not_written(self):
+        for cde_code, value in (("6MoWeight", "21"), ("6MoHeight", 95), ("6MoNotes", None)):
+            result = self._write(cde_code, value)
+            self.assertEqual(result.changes, [])
+            self.assertEqual(result.errors, {})
+        self.assertEqual(self.sent, [])
+        self.clinical_data.refresh_from_db()
+        self.assertNotIn("CheckUp6Months_timestamp", self.clinical_data.data)
+
+    def test_changed_value_reports_the_old_value(self):
+        result = self._write("6MoWeight", "22")
+        self.assertEqual([(write.cde, old_value) for write, old_value in result.changes], [("6MoWeight", "21")])
+        self.clinical_data.refresh_from_db()
+        cdes = self.clinical_data.data["forms"][0]["sections"][0]["cdes"]
+        self.assertEqual(cdes[0], {"code": "6MoWeight", "value": "22"})
+        self.assertIn("CheckUp6Months_timestamp", self.clinical_data.data)
+
+    def test_last_write_of_a_cde_wins(self):
+        result = set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID, [
+            CdeWrite("CheckUp6Months", "6moAgehw", "6MoWeight", "22"),
+            CdeWrite("CheckUp6Months", "6moAgehw", "6MoHeight", 96),
+            CdeWrite("CheckUp6Months", "6moAgehw", "6MoWeight", "23"),
+        ])
+
+        self.assertTrue(result.in_place)
+        self.assertEqual([(write.cde, write.value, old_value) for write, old_value in result.changes],
+                         [("6MoWeight", "23", "21"), ("6MoHeight", 96, 95)])
+        self.assertEqual(len(self.sent), 1)
+        self.clinical_data.refresh_from_db()
+        self.assertEqual(self.clinical_data.data["forms"][0]["sections"][0]["cdes"][:2],
+                         [{"code": "6MoWeight", "value": "23"}, {"code": "6MoHeight", "value": 96}])
+
+    def test_cde_missing_from_the_document_is_added(self):
+        result = set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID, [
+            CdeWrite("CheckUp6Months", "6moAgehw", "6MoWeight", "22"),
+            CdeWrite("CheckUp6Months", "6moAgehw", "6MoHead", 48),
+        ])
+
+        self.assertFalse(result.in_place)
+        self.assertEqual([(write.cde, old_value) for write, old_value in result.changes],
+                         [("6MoWeight", "21"), ("6MoHead", None)])
+        self.clinical_data.refresh_from_db()
+        self.assertEqual(self.clinical_data.data["forms"][0]["sections"][0]["cdes"],
+                         [{"code": "6MoWeight", "value": "22"}, {"code": "6MoHeight", "value": 95},
+                          {"code": "6MoNotes", "value": None}, {"code": "6MoHead", "value": 48}])
+        self.assertIn("CheckUp6Months_timestamp", self.clinical_data.data)
+
+    def test_missing_form_and_section_are_created(self):
+        result = set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID,
+                                [CdeWrite("AngelmanRegistryHistory", "ANGHISTORY", "ANGDNAMethylAbnormalResult", "X")])
+
+        self.assertFalse(result.in_place)
+        self.assertEqual(result.errors, {})
+        self.clinical_data.refresh_from_db()
+        self.assertEqual([form["name"] for form in self.clinical_data.data["forms"]],
+                         ["CheckUp6Months", "AngelmanRegistryHistory"])
+        self.assertEqual(self.clinical_data.data["forms"][1]["sections"],
+                         [{"code": "ANGHISTORY", "allow_multiple": False,
+                           "cdes": [{"code": "ANGDNAMethylAbnormalResult", "value": "X"}]}])
+
+    def test_document_is_created_when_missing(self):
+        result = set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID + 1,
+                                [CdeWrite("CheckUp6Months", "6moAgehw", "6MoWeight", "22")])
+
+        self.assertFalse(result.in_place)
+        document = ClinicalData.objects.get(registry_code=REGISTRY_CODE, collection="cdes", django_id=PATIENT_ID,
+                                            context_id=CONTEXT_ID + 1)
+        self.assertEqual(document.data["forms"][0]["sections"][0]["cdes"], [{"code": "6MoWeight", "value": "22"}])
+
+    def test_write_to_a_multiple_section_is_an_error(self):
+        self.clinical_data.data["forms"][0]["sections"].append(
+            {"code": "6moSeizures", "allow_multiple": True, "cdes": [[{"code": "SeizureType", "value": "absence"}]]})
+        self.clinical_data.save()
+
+        result = set_cde_values(REGISTRY_CODE, PATIENT_ID, CONTEXT_ID,
+                                [CdeWrite("CheckUp6Months", "6moSeizures", "SeizureType", "tonic")])
+
+        self.assertFalse(result.in_place)
+        self.assertEqual(list(result.errors), [0])
+        self.assertEqual(result.changes, [])
@@ -0,0 +1,111 @@
+from datetime import date
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.test import RequestFactory, TestCase, override_settings
+
+from angelman.definition.cache import definition_cache
+from angelman.registry.groups.registration.angelman_registration import (
+    DIAGNOSIS_CDE, AngelmanRegistration, get_address_type, get_context_form_group, get_diagnosis_options,
+)
+from rdrf.models.definition.models import (
+    CDEPermittedValue, CDEPermittedValueGroup, ClinicalData, CommonDataElement, ContextFormGroup,
+    ContextFormGroupItem, Registry, RegistryForm, Section,
+)
+from registration.models import RegistrationProfile
+from registry.groups import GROUPS
+from registry.patients.models import AddressType, ParentGuardian, Patient
+
+# The queries of a registration once the definition cache is warm and the
+# unallocated working group exists; a change to it should be deliberate
+REGISTRATION_QUERIES = 36
+
+
+def _registration_data(email):
+    return {
+        "registry_code": "ang",
+        "username": email,
+        "preferred_languages": "en",
+        "first_name": "Alex",
+        "surname": "Smith",
+        "date_of_birth": date(2015, 3, 1),
+        "gender": "1",
+        "phone_number": "0400000000",
+        "address": "1 Test Street",
+        "suburb": "Perth",
+        "state": "AU-WA",
+        "postcode": "6000",
+        "country": "AU",
+        "same_address": False,
+        "diagnosis": "AS",
+        "parent_guardian_first_name": "Sam",
+        "parent_guardian_last_name": "Smith",
+        "parent_guardian_date_of_birth": date(1985, 6, 1),
+        "parent_guardian_gender": "2",
+        "parent_guardian_address": "1 Test Street",
+        "parent_guardian_suburb": "Perth",
+        "parent_guardian_state": "AU-WA",
+        "parent_guardian_postcode": "6000",
+        "parent_guardian_country": "AU",
+        "parent_guardian_phone": "0400000000",
+    }
+
+
+@override_settings(QUERY_BUDGET_STRICT=True, NOTIFICATION_OUTBOX_ENABLED=True)
+class RegistrationQueryBudgetTest(TestCase):
+
+    def setUp(self):
+        self.registry = Registry.objects.create(code="ang", name="Angelman", desc="", splash_screen="",
+                                                version="1.0")
+        Group.objects.get_or_create(name=GROUPS.PARENT)
+
+        pv_group = CDEPermittedValueGroup.objects.create(code="ANGDiagnosis")
+        CDEPermittedValue.objects.create(pv_group=pv_group, code="AS", value="Angelman syndrome")
+        CommonDataElement.objects.create(code=DIAGNOSIS_CDE["cde_code"], name="Diagnosis", datatype="range",
+                                         pv_group=pv_group)
+        Section.objects.create(code=DIAGNOSIS_CDE["section_code"], display_name="Extra information",
+                               elements=DIAGNOSIS_CDE["cde_code"])
+        form = RegistryForm.objects.create(registry=self.registry, name=DIAGNOSIS_CDE["form_name"],
+                                           sections=DIAGNOSIS_CDE["section_code"])
+        context_form_group = ContextFormGroup.objects.create(
+            registry=self.registry, code=DIAGNOSIS_CDE["context_form_group_code"],
+            name=DIAGNOSIS_CDE["context_form_group_code"], context_type="F")
+        ContextFormGroupItem.objects.create(context_form_group=context_form_group, registry_form=form)
+        AddressType.objects.create(type="Postal")
+
+        # the test transaction never commits, so the invalidation of the saves above does not run
+        definition_cache.invalidate()
+        # the budget holds once the definition lookups are cached
+        get_diagnosis_options()
+        get_context_form_group(DIAGNOSIS_CDE["context_form_group_code"])
+        get_address_type("Postal")
+
+    def _registration(self, email):
+        user = get_user_model().objects.create_user(username=email, email=email, password="Secret-password-1")
+        RegistrationProfile.objects.create(user=user, activation_key=email)
+        request = RequestFactory().post("/ang/register/")
+        request.user = user
+        return user, AngelmanRegistration(request, form=SimpleNamespace(cleaned_data=_registration_data(email)))
+
+    def test_registration_runs_a_fixed_number_of_queries(self):
+        # the first registration creates the unallocated working group and fills the remaining caches
+        user, registration = self._registration("first@example.com")
+        registration.process(user)
+        user, registration = self._registration("parent@example.com")
+        with self.assertNumQueries(REGISTRATION_QUERIES):
+            registration.process(user)
+
+        user.refresh_from_db()
+        self.assertEqual((user.first_name, user.last_name), ("Sam", "Smith"))
+        self.assertTrue(user.is_staff)
+        self.assertEqual(user.preferred_language, "en")
+        self.assertTrue(user.groups.filter(name=GROUPS.PARENT).exists())
+
+        parent = ParentGuardian.objects.get(user=user)
+        patient = Patient.objects.get(pk__in=parent.patient.values("pk"))
+        self.assertEqual(list(patient.rdrf_registry.values_list("code", flat=True)), ["ang"])
+        document = ClinicalData.objects.get(registry_code="ang", collection="cdes", django_model="Patient",
+                                            django_id=patient.pk)
+        cdes = document.data["forms"][0]["sections"][0]["cdes"]
+        self.assertEqual(cdes, [{"code": DIAGNOSIS_CDE["cde_code"], "value": "AS"}])
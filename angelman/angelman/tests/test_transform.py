@@ -0,0 +1,98 @@
+import copy
+
+from django.test import SimpleTestCase
+
+from angelman.clinical_data.transform import (
+    DeleteCde, MoveCde, MoveSection, Plan, RenameCde, SetCde, TransformError,
+)
+
+OLD_FORM = "AngelmanRegistryBehaviourAndDevelopment"
+NEW_FORM = "AngelmanRegistryCommunication"
+
+
+def _document():
+    return {
+        "django_model": "Patient",
+        "django_id": 1,
+        "context_id": 1,
+        "forms": [
+            {"name": OLD_FORM, "sections": [
+                {"code": "ANGBEHDEVSPEECHLANGUAGE", "allow_multiple": False,
+                 "cdes": [{"code": "ANGSpeech", "value": "words"}]},
+                {"code": "ANGBEHDEVMOTOR", "allow_multiple": False,
+                 "cdes": [{"code": "ANGWalks", "value": True}]},
+            ]},
+            {"name": "CheckUp6Months", "sections": [
+                {"code": "6moAgehw", "allow_multiple": False,
+                 "cdes": [{"code": "6MoWeight", "value": "21"}]},
+                {"code": "6moSeizures", "allow_multiple": True,
+                 "cdes": [[{"code": "SeizureType", "value": "absence"}],
+                          [{"code": "SeizureType", "value": "tonic"}]]},
+            ]},
+        ],
+    }
+
+
+class PlanTest(SimpleTestCase):
+
+    def setUp(self):
+        self.data = _document()
+        self.original = copy.deepcopy(self.data)
+
+    def test_move_section_copies_only_what_it_writes(self):
+        result = Plan([MoveSection("ANGBEHDEVSPEECHLANGUAGE", OLD_FORM, NEW_FORM)]).apply(self.data)
+
+        self.assertTrue(result.changed)
+        self.assertEqual(self.data, self.original)
+        old_form, untouched_form, new_form = result.data["forms"]
+        self.assertEqual([section["code"] for section in old_form["sections"]], ["ANGBEHDEVMOTOR"])
+        self.assertEqual(new_form["name"], NEW_FORM)
+        self.assertEqual([section["code"] for section in new_form["sections"]], ["ANGBEHDEVSPEECHLANGUAGE"])
+        # the forms and sections not written to are shared with the input
+        self.assertIs(untouched_form, self.data["forms"][1])
+        self.assertIs(old_form["sections"][0], self.data["forms"][0]["sections"][1])
+        self.assertIs(new_form["sections"][0], self.data["forms"][0]["sections"][0])
+
+    def test_cde_operations_leave_the_input_unchanged(self):
+        result = Plan([
+            SetCde("CheckUp6Months", "6moAgehw", "6MoWeight", "22"),
+            RenameCde("CheckUp6Months", "6moSeizures", "SeizureType", "ANGSeizureType"),
+            MoveCde("ANGWalks", OLD_FORM, "ANGBEHDEVMOTOR", NEW_FORM, "ANGMOTOR"),
+        ]).apply(self.data)
+
+        self.assertTrue(result.changed)
+        self.assertEqual(self.data, self.original)
+        checkup = result.data["forms"][1]
+        self.assertEqual(checkup["sections"][0]["cdes"], [{"code": "6MoWeight", "value": "22"}])
+        self.assertEqual([cde["code"] for item in checkup["sections"][1]["cdes"] for cde in item],
+                         ["ANGSeizureType", "ANGSeizureType"])
+        self.assertEqual(result.data["forms"][0]["sections"][1]["cdes"], [])
+        self.assertEqual(result.data["forms"][2]["sections"],
+                         [{"code": "ANGMOTOR", "allow_multiple": False, "cdes": [{"code": "ANGWalks", "value": True}]}])
+
+    def test_unchanged_document_is_returned_as_is(self):
+        result = Plan([SetCde("CheckUp6Months", "6moAgehw", "6MoWeight", "21")]).apply(self.data)
+
+        self.assertFalse(result.changed)
+        self.assertIs(result.data, self.data)
+
+    def test_document_without_the_source_forms_is_skipped(self):
+        result = Plan([DeleteCde("AngelmanRegistryHistory", "ANGHISTORY", "ANGDNAMethylAbnormalResult")]).apply(
+            self.data)
+
+        self.assertEqual(result, (self.data, False, []))
+
+    def test_problems_are_reported_and_change_nothing(self):
+        result = Plan([MoveSection("ANGBEHDEVHEARING", OLD_FORM, NEW_FORM),
+                       SetCde("CheckUp6Months", "6moSeizures", "SeizureType", "atonic")]).apply(self.data)
+
+        self.assertFalse(result.changed)
+        self.assertEqual([level for level, __ in result.messages], ["WARN", "ERROR"])
+
+    def test_invalid_plans_are_rejected(self):
+        with self.assertRaises(TransformError):
+            Plan([])
+        with self.assertRaises(TransformError):
+            Plan(["MoveSection"])
+        with self.assertRaises(TransformError):
+            MoveSection("ANGBEHDEVSPEECHLANGUAGE", OLD_FORM, OLD_FORM)
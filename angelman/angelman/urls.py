@@ -2,7 +2,28 @@ from django.conf.urls import include
 from django.urls import re_path
 from django.views.generic import RedirectView
 
+from angelman.clinical_data.views import CompressedFormFieldHistoryView
+from angelman.dashboard.views import PatientDashboardView
+from angelman.ingest.views import BatchIngestView, UploadView
+from angelman.metrics.views import metrics_view
+from angelman.patients.views import ConsentFilteredPatientsListingView, PatientListView
+from angelman.report.views import ClinicalDataExportView
+
 urlpatterns = [
     re_path(r'^$', RedirectView.as_view(url='router/', permanent=False)),
+    re_path(r'^api/ingest/(?P<registry_code>\w+)/records/?$', BatchIngestView.as_view(), name='ingest_records'),
+    re_path(r'^api/ingest/(?P<registry_code>\w+)/uploads/(?P<upload_id>[0-9a-f]{64})/?$', UploadView.as_view(),
+            name='ingest_upload'),
+    re_path(r'^api/dashboard/(?P<registry_code>\w+)/patients/(?P<patient_id>\d+)/?$', PatientDashboardView.as_view(),
+            name='patient_dashboard_summary'),
+    re_path(r'^api/patients/(?P<registry_code>\w+)/?$', PatientListView.as_view(), name='patient_list'),
+    re_path(r'^api/export/(?P<registry_code>\w+)/clinical_data\.csv$', ClinicalDataExportView.as_view(),
+            name='clinical_data_export'),
+    re_path(r'^metrics$', metrics_view, name='metrics'),
+    # ahead of rdrf.urls, which routes these pages to the views they extend
+    re_path(r'^patientslisting/?$', ConsentFilteredPatientsListingView.as_view(), name='patientslisting'),
+    re_path(r'^(?P<registry_code>\w+)/forms/(?P<form_id>\w+)/(?P<patient_id>\d+)/(?P<context_id>\d+)/history/'
+            r'(?P<section_code>\w+)/(?P<cde_code>\w+)(?:/(?P<formset_index>\d+))?/?$',
+            CompressedFormFieldHistoryView.as_view(), name='registry_form_field_history'),
     re_path(r'', include('rdrf.urls')),
 ]